@@ -0,0 +1,106 @@
+import os
+import pickle
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Dict
+
+import joblib
+import numpy as np
+from aem.logger import aemlogger as log
+
+# arrays of at least this many bytes are stored in their own .npy file
+min_array_bytes = 1 << 20
+
+
+class _ArrayPickler(pickle.Pickler):
+    """Pickles the plain numeric arrays of at least min_bytes by reference, each saved to a .npy file in directory
+
+    The persistent ids are the file names relative to the parent of directory. Persistent ids bypass the pickle memo,
+    so an array referenced more than once is saved once and given the same id each time.
+    """
+
+    def __init__(self, file, directory: Path, min_bytes: int):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.directory = directory
+        self.min_bytes = min_bytes
+        self.names = {}
+
+    def persistent_id(self, obj):
+        # structured arrays, like the nodes of sklearn trees, are copied by their owners on unpickling anyway, as
+        # are the values of the trees, which are small in any case
+        if not isinstance(obj, np.ndarray) or obj.dtype.fields is not None or obj.dtype.hasobject \
+                or obj.nbytes < self.min_bytes:
+            return None
+        if id(obj) not in self.names:
+            name = f"{self.directory.name}/{len(self.names):06d}.npy"
+            np.save(self.directory.parent.joinpath(name), obj, allow_pickle=False)
+            # the array is kept alive so that its id is not reused by a temporary array made while pickling
+            self.names[id(obj)] = (name, obj)
+        return self.names[id(obj)][0]
+
+
+class _ArrayUnpickler(pickle.Unpickler):
+
+    def __init__(self, file, directory: Path):
+        super().__init__(file)
+        self.directory = directory
+        self.arrays = {}
+
+    def persistent_load(self, pid):
+        # one memory map per file, so arrays shared in the pickled state are shared once loaded
+        if pid not in self.arrays:
+            self.arrays[pid] = np.load(self.directory.joinpath(pid), mmap_mode='r')
+        return self.arrays[pid]
+
+
+def model_arrays_dir(model_file: Path) -> Path:
+    return model_file.with_suffix('.arrays')
+
+
+def dump_model_state(state: Dict, model_file: Path, min_bytes: int = min_array_bytes):
+    """
+    Writes state to model_file with its large plain numeric arrays uncompressed in .npy files under the
+    model_arrays_dir directory, whose data is 64 byte aligned so that load_model_state memory maps them instead of
+    reading them. These are the arrays of the models themselves, like the leaf ranks of quantileforest. The nodes and
+    values of sklearn trees are pickled inline, sklearn copies them into each tree on unpickling.
+
+    The arrays go to a new subdirectory and the model file is written to a temporary file, then replaced, so a
+    concurrent or interrupted dump leaves readers with the previous model file and its arrays. The arrays of the
+    previous dumps are removed once the new model file is in place.
+    """
+    parent = model_arrays_dir(model_file)
+    parent.mkdir(parents=True, exist_ok=True)
+    directory = Path(tempfile.mkdtemp(dir=parent))
+    tmp = model_file.with_suffix(f'.{os.getpid()}.tmp')
+    try:
+        with open(tmp, 'wb') as f:
+            pickler = _ArrayPickler(f, directory, min_bytes)
+            pickler.dump(state)
+        os.replace(tmp, model_file)
+    except BaseException:
+        shutil.rmtree(directory, ignore_errors=True)
+        if tmp.exists():
+            tmp.unlink()
+        raise
+    for p in parent.iterdir():
+        if p == directory:
+            continue
+        if p.is_dir():
+            shutil.rmtree(p, ignore_errors=True)
+        else:
+            p.unlink()
+    log.info(f"Wrote model on disc {model_file} with {len(pickler.names)} arrays in {directory}")
+
+
+def load_model_state(model_file: Path) -> Dict:
+    """
+    Reads the state written by dump_model_state, its large arrays are read only memory maps of their files, so
+    processes loading the same model share one copy of them in the page cache. Model files written by joblib
+    before the arrays were split out are read with joblib.
+    """
+    directory = model_arrays_dir(model_file)
+    with open(model_file, 'rb') as f:
+        if not directory.exists():
+            return joblib.load(f)
+        return _ArrayUnpickler(f, directory).load()
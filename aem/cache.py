@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import shutil
+import socket
+import hashlib
+from pathlib import Path
+from typing import Optional, Union, List, Dict
+
+import pandas as pd
+import pyarrow.feather as feather
+from aem.logger import aemlogger as log
+
+shapefile_sidecars = ['.shp', '.shx', '.dbf', '.prj', '.cpg']
+index_col = '__index__'
+# feature stores are directories with this prefix in the cache directory, see aem.features.FeatureStore
+feature_store_prefix = 'features_'
+owner_file = 'owner.json'
+# age after which a feature store of another host, or without an owner, is considered abandoned
+stale_seconds = 7 * 24 * 3600
+
+
+def file_fingerprint(path: Union[str, Path]) -> Dict:
+    """
+    Cheap fingerprint of a file based on its path, size and modification time. Only the file metadata is read.
+    """
+    path = Path(path)
+    st = path.stat()
+    return {'path': path.resolve().as_posix(), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def shapefile_fingerprint(path: Union[str, Path]) -> List[Dict]:
+    """
+    Fingerprint of a shapefile and the sidecar files that exist next to it.
+    """
+    path = Path(path)
+    return [file_fingerprint(path.with_suffix(s)) for s in shapefile_sidecars if path.with_suffix(s).exists()]
+
+
+def hash_key(*parts) -> str:
+    """
+    Stable hash of json serialisable parts, used as a content address for the cache entries.
+    """
+    s = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(s.encode()).hexdigest()[:32]
+
+
+class ColumnarCache:
+    """Least recently used cache of dataframes stored as uncompressed feather (arrow ipc) files
+
+    Entries are memory mapped on read so reloading does not deserialise or copy the numeric columns. Reading an
+    entry refreshes its modification time, which is used as the recency for eviction.
+
+    Parameters
+    ----------
+    directory : Path
+        The directory the cache entries are stored in.
+    max_entries : int
+        Maximum number of entries kept on disc.
+    max_bytes : int, optional
+        Maximum total size of the entries kept on disc.
+    """
+
+    suffix = '.feather'
+
+    def __init__(self, directory: Union[str, Path], max_entries: int = 8, max_bytes: Optional[int] = None):
+        self.directory = Path(directory)
+        self.directory.mkdir(exist_ok=True, parents=True)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        remove_stale_feature_stores(self.directory)
+
+    def path(self, key: str) -> Path:
+        return self.directory.joinpath(key + self.suffix)
+
+    def get(self, key: str) -> Optional[pd.DataFrame]:
+        path = self.path(key)
+        if not path.exists():
+            return None
+        os.utime(path)  # mark as recently used
+        table = feather.read_table(path.as_posix(), memory_map=True)
+        df = table.to_pandas(split_blocks=True)
+        df = df.set_index(index_col).rename_axis(None)
+        log.info(f"Loaded cached data from {path}")
+        return df
+
+    def put(self, key: str, df: pd.DataFrame) -> Optional[Path]:
+        path = self.path(key)
+        tmp = path.with_suffix('.tmp')
+        try:
+            feather.write_feather(df.rename_axis(index_col).reset_index(), tmp.as_posix(),
+                                  compression='uncompressed')
+        except Exception as e:  # caching is best effort, never fail the run because of it
+            log.warning(f"Could not cache data in {path}: {e}")
+            if tmp.exists():
+                tmp.unlink()
+            return None
+        os.replace(tmp, path)
+        log.info(f"Cached data in {path}")
+        self.evict()
+        return path
+
+    def evict(self):
+        entries = sorted(self.directory.glob('*' + self.suffix), key=lambda p: p.stat().st_mtime_ns, reverse=True)
+        total = 0
+        for i, p in enumerate(entries):
+            total += p.stat().st_size
+            # always keep the most recently used entry
+            if i > 0 and (i >= self.max_entries or (self.max_bytes is not None and total > self.max_bytes)):
+                log.info(f"Evicting cached data {p}")
+                p.unlink()
+
+
+def write_owner(directory: Path):
+    """
+    Records the process using directory, so that remove_stale_feature_stores leaves it alone while it runs.
+    """
+    Path(directory).joinpath(owner_file).write_text(json.dumps({'pid': os.getpid(), 'host': socket.gethostname()}))
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # the process exists but belongs to another user
+        return True
+    return True
+
+
+def _is_stale(directory: Path) -> bool:
+    owner = directory.joinpath(owner_file)
+    try:
+        record = json.loads(owner.read_text())
+    except (OSError, ValueError):
+        record = None
+    if record is not None and record['host'] == socket.gethostname():
+        return not _process_alive(record['pid'])
+    path = owner if record is not None else directory
+    return time.time() - path.stat().st_mtime > stale_seconds
+
+
+def remove_stale_feature_stores(directory: Union[str, Path]):
+    """
+    Removes the feature stores in directory left behind by runs that were killed before they could clean up: those
+    whose owning process on this host has exited, and those of other hosts or without an owner older than
+    stale_seconds.
+    """
+    for d in Path(directory).glob(feature_store_prefix + '*'):
+        try:
+            stale = d.is_dir() and _is_stale(d)
+        except OSError:  # removed by another process meanwhile
+            continue
+        if stale:
+            log.info(f"Removing abandoned feature store {d}")
+            shutil.rmtree(d, ignore_errors=True)
@@ -4,17 +4,20 @@ import click
 import json
 from collections import Counter
 import numpy as np
-import geopandas as gpd
 from sklearn.model_selection import cross_val_predict
 from sklearn.metrics import r2_score, explained_variance_score, mean_squared_error, mean_absolute_error
 from aem import __version__
 from aem.config import Config, cluster_line_segment_id
 from aem import utils
-from aem.data import load_data, load_covariates, split_flight_lines_into_multiple_segments
+from aem.features import FeatureStore
+from aem.data import load_data, load_covariates
 from aem.training import setup_validation_data
-from aem.prediction import add_pred_to_data
+from aem.prediction import add_pred_to_data, predict_aem_files
 from aem.models import modelmaps
+from aem.writers import write_output
+from aem.serve import serve_model
 from aem import hpopt
+from aem import profiling
 from aem.logger import configure_logging, aemlogger as log
 from aem.utils import import_model
 
@@ -24,9 +27,21 @@ from aem.utils import import_model
 @click.option("-v", "--verbosity",
               type=click.Choice(["DEBUG", "INFO", "WARNING", "ERROR"]),
               default="INFO", help="Level of logging")
-def main(verbosity: str) -> int:
+@click.option("--profile", is_flag=True, default=False,
+              help="Write cProfile and tracemalloc reports of each pipeline stage to the profile directory of the "
+                   "output directory")
+@click.pass_context
+def main(ctx: click.Context, verbosity: str, profile: bool) -> int:
     """Train a model and use it to make predictions."""
     configure_logging(verbosity)
+    if profile:
+        profiler = profiling.enable_profiling()
+
+        def write_profiles():
+            profiler.write()
+            profiling.disable_profiling()
+
+        ctx.call_on_close(write_profiles)
     return 0
 
 
@@ -46,6 +61,7 @@ def learn(config: str) -> None:
 
     log.info(f"Training Model using config {config}")
     conf = Config(config)
+    profiling.profile_to(conf.output_dir)
     np.random.seed(conf.numpy_seed)
 
     X, y, weights = load_data(conf)
@@ -64,9 +80,10 @@ def learn(config: str) -> None:
         #                             groups=le_groups, cv=cv, scoring={'score': }, n_jobs=-1)
         # print("==" * 50)
         # print(cv_results['test_score'].mean())
-        predictions = cross_val_predict(model, X[model_cols], y, le_groups,
-                                        fit_params={'sample_weight': w}, n_jobs=-1, verbose=1000,
-                                        cv=cv)
+        with profiling.stage('cross_validation'), \
+                FeatureStore.create(conf, X[model_cols], y, w, le_groups, cv) as store:
+            predictions = cross_val_predict(model, store.X, store.y, fit_params={'sample_weight': store.w},
+                                            n_jobs=-1, verbose=1000, cv=store.folds)
         scores = {v.__name__: v(y_true=y, y_pred=predictions, sample_weight=w) for v in regression_metrics}
         log.info(f"Finished {conf.algorithm} cross validation")
 
@@ -84,14 +101,15 @@ def learn(config: str) -> None:
         X['cv_pred'] = predictions
 
     log.info("Fit final model with all training data")
-    model.fit(X[model_cols], y, sample_weight=w)
+    with profiling.stage('fit'):
+        model.fit(X[model_cols], y, sample_weight=w)
 
     utils.export_model(model, conf, model_type='learn')
 
     X = add_pred_to_data(X, conf, model)
     X['target'] = y
     X['weights'] = w
-    X.to_csv(conf.train_data, index=False)
+    write_output(X, conf, conf.train_data)
     log.info(f"Saved training data and target and prediction at {conf.train_data}")
 
 
@@ -108,9 +126,12 @@ def learn(config: str) -> None:
               required=False,
               default=13,
               help="The random seed to use while taking fraction")
-def optimise(config: str, frac, random_state) -> None:
+@click.option("--resume", is_flag=True, default=False,
+              help="Continue the hyperopt optimisation from the trials saved by a previous run")
+def optimise(config: str, frac, random_state, resume) -> None:
     """Optimise model parameters using Bayesian regression."""
     conf = Config(config)
+    profiling.profile_to(conf.output_dir)
     X, y, w = load_data(conf)
     if frac < 1.0:
         log.info(f"using {frac*100} percent of the original data for optimisation")
@@ -119,13 +140,13 @@ def optimise(config: str, frac, random_state) -> None:
         w = w[X.index]
         log.info(f"shape of training data {X.shape}")
 
-    model = hpopt.optimise_model(X, y, w, X[cluster_line_segment_id], conf)
+    model = hpopt.optimise_model(X, y, w, X[cluster_line_segment_id], conf, resume=resume)
     utils.export_model(model, conf, model_type='optimise')
 
     X = add_pred_to_data(X, conf, model)
     X['target'] = y
     X['weights'] = w
-    X.to_csv(conf.optimisation_data, index=False)
+    write_output(X, conf, conf.optimisation_data)
 
     log.info("Finished optimisation of model parameters!")
 
@@ -138,6 +159,7 @@ def optimise(config: str, frac, random_state) -> None:
 def validate(config: str, model_type: str) -> None:
     """validate an oos shapefile using a model saved on disc."""
     conf = Config(config)
+    profiling.profile_to(conf.output_dir)
     conf.oos_validation = True
     model, _ = import_model(conf, model_type)
 
@@ -162,7 +184,7 @@ def validate(config: str, model_type: str) -> None:
     with open(conf.oos_validation_scores, 'w') as f:
         json.dump(scores, f, sort_keys=True, indent=4)
 
-    X.to_csv(conf.oos_data, index=False)
+    write_output(X, conf, conf.oos_data)
     log.info(f"Saved oos data and target and oos predictions at {conf.oos_data}")
 
 
@@ -171,25 +193,46 @@ def validate(config: str, model_type: str) -> None:
               help="The model configuration file")
 @click.option('--model-type', required=True,
               type=click.Choice(['learn', 'optimised'], case_sensitive=False))
-def predict(config: str, model_type: str) -> None:
+@click.option("--tile-rows", type=click.IntRange(min=1), required=False, default=None,
+              help="Predict each file in tiles of this many rows, bounding memory by the tile size. "
+                   "An interrupted tiled prediction resumes from its last completed tile.")
+@click.option("--halo-rows", type=click.IntRange(min=0), required=False, default=1000,
+              help="Rows read either side of a tile so that line segmentation and smoothing are consistent at tile "
+                   "edges")
+@click.option("-j", "--jobs", type=click.IntRange(min=-1), required=False, default=1,
+              help="Number of processes to predict the apply_model files with, -1 to use all cores")
+def predict(config: str, model_type: str, tile_rows: int, halo_rows: int, jobs: int) -> None:
     """Predict using a model saved on disc."""
     conf = Config(config)
+    profiling.profile_to(conf.output_dir)
     conf.predict = True
-    model, _ = import_model(conf, model_type)
-    conducitivity_dervs_and_thickness_cols = conf.conductivity_and_derivatives_cols[:] + conf.thickness_cols[:]
+    if jobs != 1 and profiling.is_enabled():
+        log.warning("Only the main process is profiled, use --jobs 1 to profile the prediction stages")
+    failures = predict_aem_files(conf, model_type, jobs=jobs, tile_rows=tile_rows, halo_rows=halo_rows)
+    if failures:
+        raise click.ClickException(f"Prediction failed for {', '.join(p.as_posix() for p in failures)}")
+    log.info(f"Finished predicting using {conf.algorithm} model")
 
-    for p, r in zip(conf.aem_pred_data, conf.pred_data):
-        log.info(f"Predicting {p} using {conf.algorithm} model")
-        aem_data = gpd.GeoDataFrame.from_file(p, rows=conf.shapefile_rows)
-        pred_aem_data = split_flight_lines_into_multiple_segments(aem_data, is_train=False, conf=conf)
 
-        X = utils.prepare_aem_data(conf, pred_aem_data)[utils.select_required_data_cols(conf)]
-
-        X = add_pred_to_data(X, conf, model)
-        log.info(f"Finished predicting {p} using {conf.algorithm} model")
-        X.to_csv(r, index=False)
-        # X[[c for c in X.columns if c not in conducitivity_dervs_and_thickness_cols]].to_csv(r, index=False)
-        log.info(f"Saved training data and target and prediction at {r.as_posix()}")
+@main.command()
+@click.option("-c", "--config", type=click.Path(exists=True), required=True,
+              help="The model configuration file")
+@click.option('--model-type', required=True,
+              type=click.Choice(['learn', 'optimised'], case_sensitive=False))
+@click.option("--host", type=click.STRING, required=False, default='127.0.0.1',
+              help="Address the prediction service listens on")
+@click.option("--port", type=click.IntRange(min=0, max=65535), required=False, default=8765,
+              help="Port the prediction service listens on")
+@click.option("--max-batch-rows", type=click.IntRange(min=1), required=False, default=100000,
+              help="Rows above which concurrent requests are no longer coalesced into the same batch")
+@click.option("--max-wait-ms", type=click.FloatRange(min=0), required=False, default=5.0,
+              help="Milliseconds a batch waits for concurrent requests after its first one")
+def serve(config: str, model_type: str, host: str, port: int, max_batch_rows: int, max_wait_ms: float) -> None:
+    """Serve predictions of a model saved on disc over http until interrupted."""
+    conf = Config(config)
+    conf.predict = True
+    model, _ = import_model(conf, model_type)
+    serve_model(conf, model, host, port, max_batch_rows=max_batch_rows, max_wait=max_wait_ms / 1000)
 
 
 if __name__ == "__main__":
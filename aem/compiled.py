@@ -0,0 +1,307 @@
+import ctypes
+import json
+import os
+import subprocess
+import tempfile
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import joblib
+import numpy as np
+from numpy.ctypeslib import ndpointer
+from scipy.stats import norm
+from sklearn.dummy import DummyRegressor
+from sklearn.ensemble import GradientBoostingRegressor, RandomForestRegressor
+from xgboost.sklearn import XGBRegressor
+from aem.models import QuantileRandomForestRegressor, QuantileGradientBoosting, QuantileXGB, dist_from_quantiles
+from aem.logger import aemlogger as log
+
+# how the trees of a group are combined, and compared with the features
+sklearn_sum, xgboost_sum, sklearn_mean_variance = 0, 1, 2
+
+Tree = Dict[str, np.ndarray]
+# kind, base, scale and trees of a group of trees, each group is an output of the library, two for mean_variance
+Group = Tuple[int, float, float, List[Tree]]
+
+# the node arrays are embedded in the library with .incbin rather than as C initializers, so the source and the
+# compilation time stay small however many nodes the model has
+source_template = """\
+#include <math.h>
+#include <stdint.h>
+
+#define N_FEATURES {n_features}
+#define N_GROUPS {n_groups}
+#define N_OUTPUTS {n_outputs}
+
+#define EMBED(name, type, file) \\
+    __asm__(".section .rodata\\n.balign 8\\n.global " #name "\\n.hidden " #name "\\n" #name ":\\n" \\
+            ".incbin \\"" file "\\"\\n.previous\\n"); \\
+    extern const type name[] __attribute__((visibility("hidden")))
+
+EMBED(feature, int32_t, "{data_dir}/feature.bin");
+EMBED(threshold, double, "{data_dir}/threshold.bin");
+EMBED(left, int32_t, "{data_dir}/left.bin");
+EMBED(right, int32_t, "{data_dir}/right.bin");
+EMBED(default_left, uint8_t, "{data_dir}/default_left.bin");
+EMBED(value, double, "{data_dir}/value.bin");
+
+static const int32_t tree_root[] = {{{tree_root}}};
+
+/* group g is the trees [group_start[g], group_start[g + 1]) combined as group_kind[g] */
+static const int32_t group_start[] = {{{group_start}}};
+static const int32_t group_kind[] = {{{group_kind}}};
+static const double group_base[] = {{{group_base}}};
+static const double group_scale[] = {{{group_scale}}};
+
+static double leaf_value(int32_t n, const double *x, int xgboost) {{
+    while (feature[n] >= 0) {{
+        double v = x[feature[n]];
+        int go_left;
+        if (isnan(v))
+            go_left = default_left[n];
+        else if (xgboost)
+            go_left = (float) v < (float) threshold[n];
+        else
+            go_left = (double) (float) v <= threshold[n];
+        n = go_left ? left[n] : right[n];
+    }}
+    return value[n];
+}}
+
+int aem_n_features(void) {{ return N_FEATURES; }}
+
+int aem_n_outputs(void) {{ return N_OUTPUTS; }}
+
+void aem_predict(const double *X, int64_t n_rows, double *out, int n_threads) {{
+    int64_t i;
+#ifdef _OPENMP
+    #pragma omp parallel for num_threads(n_threads) schedule(static)
+#endif
+    for (i = 0; i < n_rows; i++) {{
+        const double *x = X + i * N_FEATURES;
+        double *o = out + i * N_OUTPUTS;
+        int32_t g, t;
+        for (g = 0; g < N_GROUPS; g++) {{
+            if (group_kind[g] == {sklearn_mean_variance}) {{
+                double mean = 0, m2 = 0;
+                for (t = group_start[g]; t < group_start[g + 1]; t++) {{
+                    double p = leaf_value(tree_root[t], x, 0);
+                    double delta = p - mean;
+                    mean += delta / (t - group_start[g] + 1);
+                    m2 += delta * (p - mean);
+                }}
+                *o++ = mean;
+                *o++ = m2 / (group_start[g + 1] - group_start[g]);
+            }} else if (group_kind[g] == {xgboost_sum}) {{
+                float s = (float) group_base[g];
+                for (t = group_start[g]; t < group_start[g + 1]; t++)
+                    s += (float) leaf_value(tree_root[t], x, 1);
+                *o++ = s;
+            }} else {{
+                double s = group_base[g];
+                for (t = group_start[g]; t < group_start[g + 1]; t++)
+                    s += group_scale[g] * leaf_value(tree_root[t], x, 0);
+                *o++ = s;
+            }}
+        }}
+    }}
+}}
+"""
+
+
+def _sklearn_tree(dt) -> Tree:
+    tree = dt.tree_
+    return {
+        'feature': tree.feature,
+        'threshold': tree.threshold,
+        'left': tree.children_left,
+        'right': tree.children_right,
+        'default_left': np.zeros(tree.node_count, dtype=np.uint8),
+        'value': tree.value[:, 0, 0],
+    }
+
+
+def _gradient_boosting_group(gb: GradientBoostingRegressor) -> Group:
+    if gb.init_ == 'zero':
+        base = 0.0
+    elif isinstance(gb.init_, DummyRegressor):
+        base = float(np.ravel(gb.init_.constant_)[0])
+    else:
+        raise TypeError(f"Gradient boosting with init {gb.init_} can not be compiled")
+    return sklearn_sum, base, gb.learning_rate, [_sklearn_tree(e[0]) for e in gb.estimators_]
+
+
+def _xgboost_groups(xgb: XGBRegressor) -> List[Group]:
+    """
+    A group per target of the booster of xgb, from its json model.
+    """
+    with tempfile.TemporaryDirectory() as d:
+        path = Path(d).joinpath('model.json')
+        xgb.get_booster().save_model(path.as_posix())
+        learner = json.loads(path.read_text())['learner']
+    booster = learner['gradient_booster']
+    if booster['name'] != 'gbtree':
+        raise TypeError(f"xgboost {booster['name']} boosters can not be compiled")
+    base_score = learner['learner_model_param']['base_score']
+    base_scores = np.atleast_1d(json.loads(base_score) if base_score.startswith('[') else float(base_score))
+    trees = booster['model']['trees']
+    tree_info = np.asarray(booster['model']['tree_info'])
+    groups = []
+    for target in range(int(tree_info.max()) + 1 if len(trees) else 1):
+        group_trees = []
+        for i in np.flatnonzero(tree_info == target):
+            tree = trees[i]
+            left = np.asarray(tree['left_children'], dtype=np.int32)
+            group_trees.append({
+                'feature': np.where(left < 0, -1, np.asarray(tree['split_indices'], dtype=np.int32)),
+                'threshold': np.asarray(tree['split_conditions'], dtype=np.float32).astype(np.float64),
+                'left': left,
+                'right': np.asarray(tree['right_children'], dtype=np.int32),
+                'default_left': np.asarray(tree['default_left'], dtype=np.uint8),
+                # leaves hold their value in split_conditions
+                'value': np.asarray(tree['split_conditions'], dtype=np.float32).astype(np.float64),
+            })
+        groups.append((xgboost_sum, float(base_scores[min(target, base_scores.shape[0] - 1)]), 1.0, group_trees))
+    return groups
+
+
+def model_groups(model) -> List[Group]:
+    """
+    The groups of trees of model, in the order of the outputs of its compiled library. Raises TypeError for models
+    that can not be compiled.
+    """
+    if isinstance(model, QuantileRandomForestRegressor):
+        return [(sklearn_mean_variance, 0.0, 1.0, [_sklearn_tree(dt) for dt in model.estimators_])]
+    if type(model) is RandomForestRegressor:
+        return [(sklearn_sum, 0.0, 1.0 / len(model.estimators_), [_sklearn_tree(dt) for dt in model.estimators_])]
+    if isinstance(model, GradientBoostingRegressor):
+        return [_gradient_boosting_group(model)]
+    if isinstance(model, QuantileGradientBoosting):
+        return [_gradient_boosting_group(gb) for gb in [model.gb, model.gb_quantile_lower, model.gb_quantile_upper]]
+    if isinstance(model, XGBRegressor):
+        return _xgboost_groups(model)
+    if isinstance(model, QuantileXGB):
+        return [g for m in [model.gb] + model.quantile_models for g in _xgboost_groups(m)]
+    raise TypeError(f"{type(model).__name__} models can not be compiled")
+
+
+def _c_array(a: np.ndarray) -> str:
+    return ','.join(repr(float(v)) if a.dtype.kind == 'f' else str(int(v)) for v in a)
+
+
+def generate_source(model, n_features: int, data_dir: Path) -> str:
+    """
+    C source of a library predicting the trees of model, writing the node arrays it embeds to data_dir. The nodes
+    of all trees are in flat arrays, a tree is walked from its root until a leaf, a node with a negative feature.
+    """
+    if '"' in data_dir.as_posix() or '\\' in data_dir.as_posix():
+        raise ValueError(f"Can not embed files from {data_dir}")
+    groups = model_groups(model)
+    trees = [t for _, _, _, group_trees in groups for t in group_trees]
+    offsets = np.r_[0, np.cumsum([t['feature'].shape[0] for t in trees])[:-1]].astype(np.int64)
+    arrays = {
+        'feature': (np.int32, [np.where(t['feature'] >= 0, t['feature'], -1) for t in trees]),
+        'threshold': (np.float64, [t['threshold'] for t in trees]),
+        'left': (np.int32, [np.where(t['left'] >= 0, t['left'] + o, -1) for t, o in zip(trees, offsets)]),
+        'right': (np.int32, [np.where(t['right'] >= 0, t['right'] + o, -1) for t, o in zip(trees, offsets)]),
+        'default_left': (np.uint8, [t['default_left'] for t in trees]),
+        'value': (np.float64, [t['value'] for t in trees]),
+    }
+    for name, (dtype, parts) in arrays.items():
+        np.concatenate(parts).astype(dtype).tofile(data_dir.joinpath(name + '.bin').as_posix())
+
+    return source_template.format(
+        n_features=n_features,
+        n_groups=len(groups),
+        n_outputs=sum(2 if kind == sklearn_mean_variance else 1 for kind, _, _, _ in groups),
+        data_dir=data_dir.as_posix(),
+        tree_root=_c_array(offsets),
+        group_start=_c_array(np.r_[0, np.cumsum([len(g[3]) for g in groups])]),
+        group_kind=_c_array(np.array([g[0] for g in groups])),
+        group_base=_c_array(np.array([g[1] for g in groups], dtype=np.float64)),
+        group_scale=_c_array(np.array([g[2] for g in groups], dtype=np.float64)),
+        sklearn_mean_variance=sklearn_mean_variance,
+        xgboost_sum=xgboost_sum,
+    )
+
+
+def compile_model(model, n_features: int, library: Path) -> Path:
+    """
+    Compiles the trees of model into a shared library at library with a C compiler, $CC or cc, with OpenMP when
+    the compiler supports it.
+
+    Raises TypeError when the model can not be compiled, CalledProcessError when compilation fails.
+    """
+    with tempfile.TemporaryDirectory() as d:
+        build_dir = Path(d).resolve()
+        source = build_dir.joinpath('model.c')
+        source.write_text(generate_source(model, n_features, build_dir))
+        tmp = library.with_suffix('.tmp')
+        command = [os.environ.get('CC', 'cc'), '-O2', '-shared', '-fPIC', '-o', tmp.as_posix(), source.as_posix(),
+                   '-lm']
+        try:
+            subprocess.run(command[:1] + ['-fopenmp'] + command[1:], check=True, stdout=subprocess.PIPE,
+                           stderr=subprocess.PIPE)
+        except subprocess.CalledProcessError:
+            log.warning("Compiling the model without OpenMP, compiled predictions use a single thread")
+            subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    os.replace(tmp, library)
+    log.info(f"Compiled {type(model).__name__} model into {library}")
+    return library
+
+
+class CompiledRegressor:
+    """Predictions of a model from its library compiled by compile_model
+
+    Parameters
+    ----------
+    model :
+        The model the library was compiled from.
+    library : Path
+        The compiled library.
+    n_jobs : int
+        Threads the library predicts with, -1 for all cores.
+    """
+
+    def __init__(self, model, library: Path, n_jobs: int = -1):
+        self.model = model
+        self.library = Path(library)
+        self.n_jobs = n_jobs
+        self.lib = ctypes.CDLL(self.library.as_posix())
+        self.lib.aem_predict.argtypes = [ndpointer(np.float64, flags='C_CONTIGUOUS'), ctypes.c_int64,
+                                         ndpointer(np.float64, flags='C_CONTIGUOUS'), ctypes.c_int]
+        self.lib.aem_predict.restype = None
+        self.n_features = self.lib.aem_n_features()
+        self.n_outputs = self.lib.aem_n_outputs()
+
+    def __reduce__(self):
+        # libraries are loaded again rather than pickled
+        return self.__class__, (self.model, self.library, self.n_jobs)
+
+    def predict_outputs(self, X) -> np.ndarray:
+        X = np.ascontiguousarray(X, dtype=np.float64)
+        if X.ndim != 2 or X.shape[1] != self.n_features:
+            raise ValueError(f"Compiled model expects {self.n_features} features, got an array of shape {X.shape}")
+        out = np.empty((X.shape[0], self.n_outputs))
+        # ctypes releases the GIL for the duration of the call
+        self.lib.aem_predict(X, X.shape[0], out, joblib.effective_n_jobs(self.n_jobs))
+        return out
+
+    def predict(self, X, *args, **kwargs):
+        return self.predict_outputs(X)[:, 0]
+
+
+class CompiledDistRegressor(CompiledRegressor):
+
+    def predict_dist(self, X, interval=0.95, **kwargs):
+        out = self.predict_outputs(X)
+        if isinstance(self.model, QuantileRandomForestRegressor):
+            Ey, Vy = out[:, 0], out[:, 1]
+            ql, qu = norm.interval(interval, loc=Ey, scale=np.sqrt(Vy))
+            return Ey, Vy, ql, qu
+        return dist_from_quantiles(out[:, 0], out[:, 1], out[:, 2], self.model.lower_alpha, self.model.upper_alpha,
+                                   interval)
+
+
+def load_compiled_model(model, library: Path) -> CompiledRegressor:
+    return (CompiledDistRegressor if hasattr(model, 'predict_dist') else CompiledRegressor)(model, library)
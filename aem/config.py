@@ -1,6 +1,11 @@
+import os
+import json
+import struct
 import yaml
 from pathlib import Path
-import geopandas as gpd
+from typing import Dict, List, Tuple, Union
+from aem.cache import file_fingerprint, hash_key
+from aem.logger import aemlogger as log
 
 twod_coords = ['POINT_X', 'POINT_Y']
 threed_coords = twod_coords + ['Z_coor']
@@ -8,6 +13,7 @@ cluster_line_no = 'cluster_line_no'
 cluster_line_segment_id = 'cluster_line_segment_id'
 additional_cols_for_tracking = ['fiducial', 'uniqueid', 'flight', 'line', cluster_line_no, 'd',
                                 cluster_line_segment_id]
+output_suffixes = {'csv': '.csv', 'parquet': '.parquet', 'feather': '.feather', 'gpkg': '.gpkg'}
 
 
 class Config:
@@ -44,9 +50,20 @@ class Config:
         self.aem_pred_data = [Path(self.aem_folder).joinpath(p) for p in s['data']['apply_model']]
         self.shapefile_rows = s['data']['rows']
         self.aem_line_scan_eps = s['data']['aem_line_scan_radius']
+        self.aem_line_segmentation = s['data']['aem_line_segmentation'] if 'aem_line_segmentation' in s['data'] \
+            else 'auto'
+        if self.aem_line_segmentation not in {'auto', 'attributes', 'grid'}:
+            raise ConfigException("aem_line_segmentation must be one of 'auto', 'attributes' or 'grid'")
         self.aem_line_splits = s['data']['aem_line_splits']
         self.cutoff_radius = s['data']['cutoff_radius']
         self.group_col = s['data']['group_col'] if 'group_col' in s['data'] else cluster_line_segment_id
+
+        # covariates/targets cache
+        cache = s['data']['cache'] if 'cache' in s['data'] else {}
+        self.cache_data = cache['enabled'] if 'enabled' in cache else True
+        self.cache_max_entries = cache['max_entries'] if 'max_entries' in cache else 8
+        self.cache_max_bytes = int(cache['max_size_gb'] * 1024 ** 3) if 'max_size_gb' in cache else None
+        self.cache_dir = Path(self.output_dir).joinpath('cache')
         # oos_validation
         self.oos_validation = False
         self.oos_validation_data = [Path(self.aem_folder).joinpath(p)
@@ -109,17 +126,9 @@ class Config:
         self.thickness_columns_prefix = s['data']['thickness_columns_prefix']
         self.aem_covariate_cols = s['data']['aem_covariate_cols']
 
-        original_aem_data = gpd.GeoDataFrame.from_file(self.aem_train_data[0].as_posix(), rows=1)
-
-        conductivity_cols = [c for c in original_aem_data.columns if c.startswith(self.conductivity_columns_prefix)]
-        d_conductivities = ['d_' + c for c in conductivity_cols]
-        conductivity_and_derivatives_cols = conductivity_cols + d_conductivities
-        thickness_cols = [t for t in original_aem_data.columns if t.startswith(self.thickness_columns_prefix)]
-
-        self.thickness_cols = thickness_cols
-        self.conductivity_cols = conductivity_cols
-        self.conductivity_derivatives_cols = d_conductivities
-        self.conductivity_and_derivatives_cols = conductivity_and_derivatives_cols
+        # column discovery is deferred until the columns are needed, see the schema property
+        self._schema = None
+        self.schema_cache = Path(self.output_dir).joinpath('schema_cache.json')
 
         # co-ordination
         self.model_file = Path(self.output_dir).joinpath(self.name + ".model")
@@ -130,13 +139,25 @@ class Config:
         self.optimised_model_scores = Path(self.output_dir).joinpath(self.name + "_searchcv_scores.json")
 
         # outputs
-        self.train_data = Path(self.output_dir).joinpath(self.name + "_train.csv")
-        self.optimisation_data = Path(self.output_dir).joinpath(self.name + "_optimisation.csv")
+        self.output_format = s['output']['format'] if 'format' in s['output'] else 'csv'
+        if self.output_format not in output_suffixes:
+            raise ConfigException(f"output format must be one of {list(output_suffixes)}")
+        self.output_compression = s['output']['compression'] if 'compression' in s['output'] else None
+        self.output_columns = s['output']['columns'] if 'columns' in s['output'] else 'all'
+        if not (self.output_columns in {'all', 'predictions'} or isinstance(self.output_columns, list)):
+            raise ConfigException("output columns must be 'all', 'predictions' or a list of columns")
+        self.output_chunk_rows = s['output']['chunk_rows'] if 'chunk_rows' in s['output'] else 100000
+        suffix = output_suffixes[self.output_format]
+        self.train_data = Path(self.output_dir).joinpath(self.name + "_train" + suffix)
+        self.optimisation_data = Path(self.output_dir).joinpath(self.name + "_optimisation" + suffix)
         self.optimisation_output_hpopt = Path(self.output_dir).joinpath(self.name + '_optimisation_hpopt.csv')
-        self.pred_data = [Path(self.output_dir).joinpath(self.name + f"_pred_{p.stem}.csv")
+        self.optimisation_trials_log = Path(self.output_dir).joinpath(self.name + '_optimisation_trials.jsonl')
+        self.pred_data = [Path(self.output_dir).joinpath(self.name + f"_pred_{p.stem}" + suffix)
                           for p in self.aem_pred_data]
-        self.oos_data = Path(self.output_dir).joinpath(self.name + "_oos.csv")
+        self.oos_data = Path(self.output_dir).joinpath(self.name + "_oos" + suffix)
         self.quantiles = s['output']['pred']['quantiles']
+        self.plot_survey_lines = s['output']['plot_survey_lines'] if 'plot_survey_lines' in s['output'] else True
+        self.compile_model = s['output']['compile_model'] if 'compile_model' in s['output'] else False
         self.aem_lines_plot_train = Path(self.output_dir).joinpath('aem_survey_lines_train.jpg')
         self.aem_lines_plot_oos = Path(self.output_dir).joinpath('aem_survey_lines_oos.jpg')
         self.aem_lines_plot_pred = Path(self.output_dir).joinpath('aem_survey_lines_pred.jpg')
@@ -147,6 +168,79 @@ class Config:
         self.test_fraction = s['data']['test_train_split']['test']
         self.val_fraction = s['data']['test_train_split']['val']
 
+    @property
+    def schema(self) -> Dict[str, List[str]]:
+        """conductivity and thickness columns of the aem data, discovered from the first aem training file on first
+        use. Prediction sets this from the exported model so the training inputs are never opened."""
+        if getattr(self, '_schema', None) is None:
+            self._schema = discover_schema(self)
+        return self._schema
+
+    @schema.setter
+    def schema(self, schema: Dict[str, List[str]]):
+        self._schema = schema
+
+    @property
+    def conductivity_cols(self) -> List[str]:
+        return self.schema['conductivity_cols']
+
+    @property
+    def thickness_cols(self) -> List[str]:
+        return self.schema['thickness_cols']
+
+    @property
+    def conductivity_derivatives_cols(self) -> List[str]:
+        return ['d_' + c for c in self.conductivity_cols]
+
+    @property
+    def conductivity_and_derivatives_cols(self) -> List[str]:
+        return self.conductivity_cols + self.conductivity_derivatives_cols
+
 
 class ConfigException(Exception):
     pass
+
+
+def read_dbf_header(path: Union[str, Path]) -> Tuple[int, List[str]]:
+    """
+    Reads only the header of a dbase (.dbf) file, i.e. the attribute table of a shapefile.
+    :param path: path to the .dbf file, or the .shp file next to it
+    :return: number of records and the field names
+    """
+    path = Path(path).with_suffix('.dbf')
+    with open(path, 'rb') as f:
+        header = f.read(32)
+        n_records, header_length = struct.unpack('<IH', header[4:10])
+        descriptors = f.read(header_length - 32)
+    fields = []
+    for i in range(0, len(descriptors) - 31, 32):
+        if descriptors[i] == 0x0D:  # field descriptor array terminator
+            break
+        fields.append(descriptors[i:i + 11].split(b'\x00')[0].decode('latin-1'))
+    return n_records, fields
+
+
+def discover_schema(conf: Config) -> Dict[str, List[str]]:
+    """
+    Finds the conductivity and thickness columns in the first aem training file from its dbf header. Results are
+    cached in conf.schema_cache keyed on the file fingerprint so the header is read once per file version.
+    :param conf: Config instance
+    """
+    dbf = conf.aem_train_data[0].with_suffix('.dbf')
+    key = hash_key(file_fingerprint(dbf))
+    cache = json.loads(conf.schema_cache.read_text()) if conf.schema_cache.exists() else {}
+    if key in cache:
+        fields = cache[key]
+    else:
+        log.info(f"Reading aem columns from {dbf}")
+        _, fields = read_dbf_header(dbf)
+        cache[key] = fields
+        # written to a temporary file and moved into place, so concurrent runs sharing the output directory never
+        # read a partly written cache
+        tmp = conf.schema_cache.with_suffix(f'.{os.getpid()}.tmp')
+        tmp.write_text(json.dumps(cache, indent=4))
+        os.replace(tmp, conf.schema_cache)
+    return {
+        'conductivity_cols': [c for c in fields if c.startswith(conf.conductivity_columns_prefix)],
+        'thickness_cols': [t for t in fields if t.startswith(conf.thickness_columns_prefix)],
+    }
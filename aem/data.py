@@ -1,114 +1,288 @@
-from typing import Tuple
+from concurrent.futures import ThreadPoolExecutor, Future, wait
 from pathlib import Path
-import geopandas as gpd
+from typing import Tuple, List, Union
 import joblib
+import geopandas as gpd
 from itertools import cycle, islice
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-from sklearn.cluster import DBSCAN
+import matplotlib
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.colors import ListedColormap
+from matplotlib.figure import Figure
+from sklearn.neighbors import KDTree
 from aem.config import Config, cluster_line_no
 from aem import utils
+from aem.cache import ColumnarCache, shapefile_fingerprint, hash_key
+from aem.targets import TargetIndex
+from aem.profiling import profiled
 from aem.logger import aemlogger as log
 
+# bump when the way the covariates/targets matrix is built changes, so stale cache entries are not reused
+cache_version = 2
+target_col = '__target__'
+weight_col = '__weight__'
+line_attribute_cols = ['flight', 'line']
+# diagnostics plots are rendered and saved off the main thread, one at a time
+_diagnostics_executor = ThreadPoolExecutor(max_workers=1)
+_diagnostics = set()
+# offsets of the cells, half of the neighbourhood as each pair is visited from one side, that can hold points
+# within eps of a point in a cell of diagonal eps
+_neighbour_cell_offsets = [(di, dj) for di in range(0, 3) for dj in range(-2, 3)
+                           if (di > 0 or dj > 0) and (max(abs(di) - 1, 0) ** 2 + max(abs(dj) - 1, 0) ** 2 < 2)]
 
-def split_flight_lines_into_multiple_segments(aem_data: pd.DataFrame, is_train: bool, conf: Config) -> pd.DataFrame:
+
+@profiled('segment')
+def split_flight_lines_into_multiple_segments(aem_data: Union[pd.DataFrame, List[pd.DataFrame]], is_train: bool,
+                                              conf: Config) -> pd.DataFrame:
     """
     Accepts aem covariates with 'POINT_X', 'POINT_Y as coordinates and assigns a cluster number to each row of
     covariates/observations. These
 
     :param is_train: train or predict
-    :param aem_data: aem training data
+    :param aem_data: aem training data, or a list of aem datasets whose flight lines are found in parallel
     :param conf: Config instance
     :return: aem_data with line_no added based on
     """
-    log.info("Segmenting aem lines using DBSCAN clustering algorithm")
-    from matplotlib.colors import ListedColormap
-
-    _X = aem_data.loc[:, utils.twod_coords]
-    dbscan = DBSCAN(eps=conf.aem_line_scan_eps, n_jobs=-1, min_samples=10)
-    # t0 = time.time()
-    dbscan.fit(_X)
-    line_no = dbscan.labels_.astype(np.uint16)
-    rc_colors = plt.rcParams["axes.prop_cycle"].by_key()["color"]  # list of colours
-    colors = np.array(list(islice(cycle(rc_colors), int(max(line_no) + 1))))
-    # add black color for outliers (if any)
-    colors = np.append(colors, ["#000000"])
-    # colors = ListedColormap(colors)
-    plt.figure(figsize=(16, 10))
-    plt.xlabel("longitude")
-    plt.ylabel("latitude")
-    # lines = np.unique(line_no)
-    scatter = plt.scatter(_X.iloc[:, 0], _X.iloc[:, 1], s=10, c=colors[line_no], cmap=colors)
-    # plt.legend(handles=scatter.legend_elements()[0], labels=list(np.unique(lines)))
-    if is_train:
-        if conf.oos_validation:
-            fig_file = conf.aem_lines_plot_oos
+    log.info(f"Segmenting aem lines using {conf.aem_line_segmentation} segmentation")
+    aem_datasets = aem_data if isinstance(aem_data, list) else [aem_data]
+    line_no = find_flight_lines(aem_datasets, conf)
+    aem_data = pd.concat(aem_datasets, axis=0) if isinstance(aem_data, list) else aem_data
+    if conf.plot_survey_lines:
+        if is_train:
+            if conf.oos_validation:
+                fig_file = conf.aem_lines_plot_oos
+            else:
+                fig_file = conf.aem_lines_plot_train
         else:
-            fig_file = conf.aem_lines_plot_train
-    else:
-        fig_file = conf.aem_lines_plot_pred
-
-    plt.savefig(fig_file)
-    log.info(f"Saved segments in {fig_file}")
+            fig_file = conf.aem_lines_plot_pred
+        plot_survey_lines(aem_data[utils.twod_coords].to_numpy(dtype=np.float64), line_no, fig_file)
     aem_data[cluster_line_no] = line_no
 
-    aem_data = aem_data.groupby(cluster_line_no).apply(utils.add_delta, conf=conf)
+    aem_data = utils.add_line_distance_and_segments(aem_data, conf)
     log.info(f"Found {len(np.unique(line_no))} groups via clustering")
     log.info("Finished segmentation")
     return aem_data
 
 
-def load_data(conf: Config) -> Tuple[pd.DataFrame, pd.Series, pd.Series]:
+def plot_survey_lines(xy: np.ndarray, line_no: np.ndarray, fig_file: Path, bins: Tuple[int, int] = (1600, 1000)):
     """
-    Loads covariates specified in the config file
-    :param conf: Config class instance
+    Plots the soundings coloured by line number in the background. The soundings are binned onto a raster of bins
+    cells here, each cell taking the line number of a sounding in it, so rendering costs the same for any survey
+    size. The raster is rendered and saved by the diagnostics worker, see wait_for_diagnostics.
     """
-    smooth = '_smooth_' if conf.smooth_twod_covariates else '_'
-    # data = utils.convert_to_xy(conf, aem_xy_and_other_covs, interp_data)
-    data_path = f'covariates_targets_2d{smooth}weights.data'
-    if (not Path(data_path).exists()) or conf.oos_validation:
-        original_aem_data = load_covariates(is_train=True, conf=conf)
-        if conf.oos_validation:
-            all_interp_training_datasets = [gpd.GeoDataFrame.from_file(i, rows=conf.shapefile_rows) for i in
-                                            conf.oos_interp_data]
-        else:
-            all_interp_training_datasets = [gpd.GeoDataFrame.from_file(i, rows=conf.shapefile_rows) for i in
-                                            conf.interp_data]
+    if not xy.shape[0]:
+        return
+    raster, extent = survey_lines_raster(xy, line_no, bins)
+    future = _diagnostics_executor.submit(_render_survey_lines, raster, extent, fig_file)
+    _diagnostics.add(future)
+    future.add_done_callback(_diagnostics_done)
 
-        log.info("reading interp data...")
 
-        train_weights = conf.train_data_weights
+def survey_lines_raster(xy: np.ndarray, line_no: np.ndarray, bins: Tuple[int, int]) \
+        -> Tuple[np.ndarray, Tuple[float, float, float, float]]:
+    """
+    Raster of bins cells over the extent of xy, rows along y, holding the line number of a sounding in each cell and
+    -1 in the empty cells.
+    """
+    x_min, y_min = xy.min(axis=0)
+    x_max, y_max = xy.max(axis=0)
+    ix = np.minimum(((xy[:, 0] - x_min) / max(x_max - x_min, 1e-9) * bins[0]).astype(np.int64), bins[0] - 1)
+    iy = np.minimum(((xy[:, 1] - y_min) / max(y_max - y_min, 1e-9) * bins[1]).astype(np.int64), bins[1] - 1)
+    raster = np.full((bins[1], bins[0]), -1, dtype=np.int32)
+    raster[iy, ix] = line_no
+    return raster, (x_min, x_max, y_min, y_max)
+
+
+def _render_survey_lines(raster: np.ndarray, extent: Tuple[float, float, float, float], fig_file: Path):
+    rc_colors = matplotlib.rcParams["axes.prop_cycle"].by_key()["color"]  # list of colours
+    colors = list(islice(cycle(rc_colors), int(raster.max()) + 1))
+    # empty cells are white
+    cmap = ListedColormap(["#ffffff"] + colors)
+    fig = Figure(figsize=(16, 10))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    ax.set_xlabel("longitude")
+    ax.set_ylabel("latitude")
+    ax.imshow(raster + 1, origin='lower', extent=extent, cmap=cmap, vmin=0, vmax=len(colors), aspect='auto',
+              interpolation='nearest')
+    fig.savefig(fig_file)
+    fig.clf()
+    log.info(f"Saved segments in {fig_file}")
+
+
+def _diagnostics_done(future: Future):
+    _diagnostics.discard(future)
+    if future.exception() is not None:
+        log.warning(f"Could not save diagnostics plot: {future.exception()}")
+
+
+def wait_for_diagnostics():
+    """
+    Waits for the diagnostics plots submitted so far to be saved.
+    """
+    wait(list(_diagnostics))
+
+
+def find_flight_lines(aem_datasets: List[pd.DataFrame], conf: Config, n_jobs: int = -1) -> np.ndarray:
+    """
+    Line numbers of every row of the concatenated aem_datasets. Each dataset is segmented separately, in parallel,
+    and its line numbers are offset by the number of lines found in the datasets before it.
+
+    With aem_line_segmentation 'attributes', or 'auto' when the flight and line columns are present, a line is a
+    unique (flight, line) pair. Otherwise lines are the connected components of the soundings within
+    aem_line_scan_radius of each other, see grid_connected_components.
+    """
+    use_attributes = [_use_line_attributes(a, conf) for a in aem_datasets]
+    n_jobs = min(joblib.effective_n_jobs(n_jobs), len(aem_datasets))
+    labels = joblib.Parallel(n_jobs=n_jobs)(
+        joblib.delayed(_label_flight_lines)(
+            a[line_attribute_cols].to_numpy() if attrs else a[utils.twod_coords].to_numpy(dtype=np.float64),
+            attrs, conf.aem_line_scan_eps)
+        for a, attrs in zip(aem_datasets, use_attributes)
+    )
+    offset = 0
+    for i, l in enumerate(labels):
+        labels[i] = l + offset
+        offset += int(l.max()) + 1 if len(l) else 0
+    return np.concatenate(labels).astype(np.uint32)
 
-        # apply the weights due to confidence levels assigned by the interpreter on the interpretation/target values
-        # plus the weights due to the datasets themselves
-        if conf.weighted_model:
-            for a, w in zip(all_interp_training_datasets, train_weights):
-                if conf.weight_col not in a.columns:
-                    a[conf.weight_col] = 1  # this takes care of the drillhole files
-                if conf.weights_map:
-                    a['weight'] = a[conf.weight_col].map(conf.weights_map) * w
-                else:
-                    a['weight'] = a[conf.weight_col] * w
 
-        all_interp_training_data = pd.concat(all_interp_training_datasets, axis=0, ignore_index=True)
-        # how many lines in interp data
-        interp_data = utils.create_interp_data(conf, all_interp_training_data)
+def _use_line_attributes(aem_data: pd.DataFrame, conf: Config) -> bool:
+    has_attributes = all(c in aem_data.columns for c in line_attribute_cols)
+    if conf.aem_line_segmentation == 'attributes' and not has_attributes:
+        raise ValueError(f"aem data has no {line_attribute_cols} columns to segment lines by")
+    return has_attributes and conf.aem_line_segmentation in {'auto', 'attributes'}
 
+
+def _label_flight_lines(values: np.ndarray, use_attributes: bool, eps: float) -> np.ndarray:
+    if use_attributes:
+        return pd.DataFrame(values).groupby(list(range(values.shape[1])), sort=False, dropna=False).ngroup().to_numpy()
+    return grid_connected_components(values, eps)
+
+
+def grid_connected_components(xy: np.ndarray, eps: float) -> np.ndarray:
+    """
+    Labels the connected components of the points that are within eps of each other, i.e. single linkage
+    clustering at distance eps, numbered in order of the first point of each component like DBSCAN.
+
+    The points are hashed into square cells with a diagonal of eps, so the points in a cell are all connected. Two
+    nearby cells are connected when their closest pair of points is within eps, found with a nearest neighbour
+    query of one cell's points against the other's KDTree. Each point takes part in a bounded number of such
+    queries, so the cost is linear in the number of points rather than in the number of neighbours within eps.
+    """
+    n = xy.shape[0]
+    if not n:
+        return np.zeros(0, dtype=np.int64)
+    cell_size = eps / np.sqrt(2)
+    ij = np.floor((xy - xy.min(axis=0)) / cell_size).astype(np.int64)
+    cells, cell_of_point = np.unique(ij, axis=0, return_inverse=True)
+    cell_of_point = cell_of_point.ravel()
+    order = np.argsort(cell_of_point, kind='stable')
+    bounds = np.r_[0, np.cumsum(np.bincount(cell_of_point, minlength=cells.shape[0]))]
+    cell_index = {(i, j): c for c, (i, j) in enumerate(cells.tolist())}
+    trees = {}
+
+    parent = np.arange(cells.shape[0])
+
+    def find(c):
+        while parent[c] != c:
+            parent[c] = parent[parent[c]]
+            c = parent[c]
+        return c
+
+    def points(c):
+        return xy[order[bounds[c]: bounds[c + 1]]]
+
+    for c, (i, j) in enumerate(cells.tolist()):
+        for di, dj in _neighbour_cell_offsets:
+            other = cell_index.get((i + di, j + dj))
+            if other is None or find(c) == find(other):
+                continue
+            if other not in trees:
+                trees[other] = KDTree(points(other))
+            dist, _ = trees[other].query(points(c), k=1)
+            if dist.min() <= eps:
+                parent[find(c)] = find(other)
+
+    components = np.array([find(c) for c in range(cells.shape[0])])[cell_of_point]
+    # number components in order of their first point
+    _, first, inverse = np.unique(components, return_index=True, return_inverse=True)
+    return np.argsort(np.argsort(first))[inverse]
+
+
+def data_cache_key(conf: Config) -> str:
+    """
+    Content address of the covariates/targets matrix built by load_data. It covers every config field that goes
+    into building the matrix and the fingerprints of the aem and target input files.
+    :param conf: Config class instance
+    """
+    aem_files = conf.oos_validation_data if conf.oos_validation else conf.aem_train_data
+    interp_files = conf.oos_interp_data if conf.oos_validation else conf.interp_data
+    fields = {
+        'version': cache_version,
+        'oos_validation': conf.oos_validation,
+        'aem_files': [shapefile_fingerprint(f) for f in aem_files],
+        'interp_files': [shapefile_fingerprint(f) for f in interp_files],
+        'rows': conf.shapefile_rows,
+        'train_data_weights': conf.train_data_weights,
+        'weighted_model': conf.weighted_model,
+        'weights_map': conf.weights_map if conf.weighted_model else None,
+        'weight_col': conf.weight_col if conf.weighted_model else None,
+        'target_col': conf.target_col,
+        'target_type_col': conf.target_type_col,
+        'included_target_type_categories': conf.included_target_type_categories,
+        'target_class_indicator_col': conf.target_class_indicator_col,
+        'cutoff_radius': conf.cutoff_radius,
+        'aem_line_scan_eps': conf.aem_line_scan_eps,
+        'aem_line_segmentation': conf.aem_line_segmentation,
+        'aem_line_splits': conf.aem_line_splits,
+        'smooth_twod_covariates': conf.smooth_twod_covariates,
+        'smooth_covariates_kernel_size': conf.smooth_covariates_kernel_size,
+        'conductivity_columns_prefix': conf.conductivity_columns_prefix,
+        'thickness_columns_prefix': conf.thickness_columns_prefix,
+        'aem_covariate_cols': conf.aem_covariate_cols,
+        'include_aem_covariates': conf.include_aem_covariates,
+        'include_thickness': conf.include_thickness,
+        'include_conductivity_derivatives': conf.include_conductivity_derivatives,
+        'group_col': conf.group_col,
+    }
+    return hash_key(fields)
+
+
+@profiled('load')
+def load_data(conf: Config) -> Tuple[pd.DataFrame, pd.Series, pd.Series]:
+    """
+    Loads covariates specified in the config file
+    :param conf: Config class instance
+    """
+    cache, key, data = None, None, None
+    if conf.cache_data:
+        cache = ColumnarCache(conf.cache_dir, max_entries=conf.cache_max_entries, max_bytes=conf.cache_max_bytes)
+        key = data_cache_key(conf)
+        data = cache.get(key)
+
+    if data is None:
+        original_aem_data = load_covariates(is_train=True, conf=conf)
         aem_xy_and_other_covs = utils.prepare_aem_data(conf, original_aem_data)[utils.select_required_data_cols(conf)]
-        data = utils.convert_to_xy(conf, aem_xy_and_other_covs, interp_data)
-        log.info("saving data on disc for future use")
-        if not conf.oos_validation:  # only during training
-            joblib.dump(data, open(data_path, 'wb'))
+        index = TargetIndex.load(conf)
+        # only the targets near the aem data are read from the memory mapped index, the persisted tree is queried
+        # with the soundings and its hits mapped to their rows
+        near = np.flatnonzero(index.within(aem_xy_and_other_covs[utils.twod_coords].to_numpy(), conf.cutoff_radius))
+        log.info(f"{near.shape[0]} of {index.targets.shape[0]} targets are near the aem data")
+        data = utils.convert_to_xy(conf, aem_xy_and_other_covs, index.targets.iloc[near], tree=index.tree,
+                                   tree_positions=near)
+        X, y, w = data['covariates'], data['targets'], data['weights']
+        if conf.cache_data:
+            log.info("saving data on disc for future use")
+            cache.put(key, X.assign(**{target_col: y, weight_col: w}))
     else:
         log.warning("Reusing data from disc!!!")
-        data = joblib.load(open(data_path, 'rb'))
+        X = data.drop(columns=[target_col, weight_col])
+        y = data[target_col].rename('target')
+        w = data[weight_col].rename('weight')
 
-    X = data['covariates']
-    y = data['targets']
-    if conf.weighted_model:
-        w = data['weights']
-    else:
+    if not conf.weighted_model:
         w = np.ones_like(y)
     return X, y, w
 
@@ -127,6 +301,5 @@ def load_covariates(is_train: bool, conf: Config):
     # TODO: True probabilistic models (gaussian process/GPs, tensorflow/pytorch probability model classes)
     # TODO: move segmenting flight line after interpretation point intersection/interpolation
     original_aem_datasets = [gpd.GeoDataFrame.from_file(i, rows=conf.shapefile_rows) for i in aem_files]
-    aem_data = pd.concat(original_aem_datasets, axis=0)
-    aem_data = split_flight_lines_into_multiple_segments(aem_data, is_train, conf)
+    aem_data = split_flight_lines_into_multiple_segments(original_aem_datasets, is_train, conf)
     return aem_data
@@ -0,0 +1,114 @@
+import shutil
+import tempfile
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from aem.config import Config
+from aem.cache import feature_store_prefix, remove_stale_feature_stores, write_owner
+from aem.logger import aemlogger as log
+
+Fold = Tuple[np.ndarray, np.ndarray]
+
+
+class FeatureStore:
+    """Model matrix, targets, weights and cross validation folds as memory mapped arrays
+
+    The model columns of X are written once to a contiguous float64 .npy file in the cache directory and reopened
+    read only with mmap_mode='r'. joblib passes memory mapped arrays to its workers by file name rather than by
+    pickling their contents, so every fold and hyperopt trial worker reads views of the same pages instead of a
+    private copy of the covariates. The folds are computed once and stored the same way.
+
+    Used as a context manager, the files are removed on exit.
+
+    Parameters
+    ----------
+    directory : Path
+        The directory holding the arrays.
+    random_state : int, optional
+        Seed of the random ranks of the rows within their groups used by stratified_subset.
+    """
+
+    def __init__(self, directory: Path, random_state: Optional[int] = None):
+        self.directory = Path(directory)
+        self.random_state = random_state
+        self.X = self._load('X')
+        self.y = self._load('y')
+        self.w = self._load('w')
+        self.groups = self._load('groups')
+        n_folds = len(list(self.directory.glob('train_*.npy')))
+        self.folds: List[Fold] = [(self._load(f'train_{i}'), self._load(f'test_{i}')) for i in range(n_folds)]
+        self._priority = None
+
+    @classmethod
+    def create(cls, conf: Config, X: pd.DataFrame, y, w, groups, cv, chunk_rows: int = 100000,
+               random_state: Optional[int] = None) -> 'FeatureStore':
+        """
+        Materialises X, y, w and the folds of cv in a new directory under conf.cache_dir.
+
+        :param conf: Config instance
+        :param X: model columns of the covariates
+        :param y: targets
+        :param w: weights
+        :param groups: group of each row, passed to cv.split
+        :param cv: cross validation splitter
+        :param chunk_rows: rows of X copied at a time, bounds the memory used while writing
+        :param random_state: seed of the stratified subsets
+        """
+        Path(conf.cache_dir).mkdir(exist_ok=True, parents=True)
+        remove_stale_feature_stores(conf.cache_dir)
+        directory = Path(tempfile.mkdtemp(prefix=feature_store_prefix, dir=conf.cache_dir))
+        try:
+            write_owner(directory)
+            X_mm = np.lib.format.open_memmap(directory.joinpath('X.npy'), mode='w+', dtype=np.float64,
+                                             shape=X.shape)
+            for start in range(0, X.shape[0], chunk_rows):
+                X_mm[start: start + chunk_rows] = X.iloc[start: start + chunk_rows].to_numpy(dtype=np.float64)
+            X_mm.flush()
+            del X_mm
+            np.save(directory.joinpath('y.npy'), np.asarray(y, dtype=np.float64))
+            np.save(directory.joinpath('w.npy'), np.asarray(w, dtype=np.float64))
+            np.save(directory.joinpath('groups.npy'), np.asarray(groups))
+            for i, (train, test) in enumerate(cv.split(np.zeros((X.shape[0], 1)), y, groups)):
+                np.save(directory.joinpath(f'train_{i}.npy'), train)
+                np.save(directory.joinpath(f'test_{i}.npy'), test)
+        except BaseException:
+            shutil.rmtree(directory, ignore_errors=True)
+            raise
+        log.info(f"Wrote feature store of shape {X.shape} in {directory}")
+        return cls(directory, random_state)
+
+    def stratified_subset(self, indices: np.ndarray, fraction: float) -> np.ndarray:
+        """
+        The rows of indices that are in the group stratified subset of fraction of the rows. Every group keeps
+        about fraction of its rows, and at least one, and the subset of a smaller fraction is contained in that
+        of a larger one.
+        """
+        if fraction >= 1:
+            return indices
+        if self._priority is None:
+            # random rank of each row within its group, divided by the group size
+            groups = np.asarray(self.groups)
+            order = np.lexsort((np.random.RandomState(self.random_state).rand(groups.shape[0]), groups))
+            sorted_groups = groups[order]
+            starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+            sizes = np.diff(np.r_[starts, groups.shape[0]])
+            group_of = np.cumsum(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]]) - 1
+            self._priority = np.empty(groups.shape[0])
+            self._priority[order] = (np.arange(groups.shape[0]) - starts[group_of]) / sizes[group_of]
+        return indices[self._priority[indices] < fraction]
+
+    def _load(self, name: str) -> np.ndarray:
+        return np.load(self.directory.joinpath(name + '.npy'), mmap_mode='r')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.X = self.y = self.w = self.groups = None
+        self.folds = []
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -1,37 +1,146 @@
 import json
+import time
+import itertools
 import logging
-import pickle
 from pathlib import Path
+from collections import defaultdict
+from copy import deepcopy
+from typing import Dict, List, Callable, Optional, Tuple
 
+import joblib
 import numpy as np
 import pandas as pd
 from sklearn.utils import shuffle
-from sklearn.model_selection import cross_val_score, GroupKFold, KFold, cross_validate, GroupShuffleSplit
+from sklearn.model_selection import cross_val_score, GroupKFold, KFold, GroupShuffleSplit
 from sklearn.metrics import check_scoring
-from hyperopt import fmin, tpe, anneal, Trials, space_eval
+from hyperopt import fmin, tpe, anneal, Trials, space_eval, STATUS_OK, JOB_STATE_DONE
+from hyperopt.base import Domain
 from hyperopt.hp import uniform, randint, choice, loguniform, quniform
 from aem import utils
-from aem.config import Config, cluster_line_segment_id, cluster_line_no
+from aem.config import Config, ConfigException, cluster_line_segment_id, cluster_line_no
 from aem.models import modelmaps
 from aem.logger import aemlogger as log
 from aem.training import setup_validation_data
+from aem.features import FeatureStore
 
 hp_algo = {
     'bayes': tpe.suggest,
     'anneal': anneal.suggest
 }
 
+# hyperopt.fmin arguments fmin_parallel supports, verbose and show_progressbar only change what is logged
+fmin_parallel_params = {'timeout', 'loss_threshold', 'early_stop_fn', 'verbose', 'show_progressbar'}
 
-def optimise_model(X: pd.DataFrame, y: pd.Series, w: pd.Series, groups: pd.Series, conf: Config):
+# boosting algorithms and the model params holding their number of boosting rounds, the last key of a path is a
+# tuple of the aliases of the param when the model accepts several of them
+boosting_rounds_params = {
+    'xgboost': [['n_estimators']],
+    'gradientboost': [['n_estimators']],
+    'quantilegb': [['n_estimators']],
+    'catboost': [[('iterations', 'n_estimators')]],
+    'quantilexgb': [[p, 'n_estimators'] for p in ['mean_model_params', 'upper_quantile_params',
+                                                  'lower_quantile_params']],
+}
+
+
+class SuccessiveHalving:
+    """Asynchronous successive halving (ASHA) scheduler over the number of boosting rounds and the data fraction
+
+    A trial is first cross validated at a low fidelity, min_rounds boosting rounds and/or min_fraction of the
+    training rows of each fold, then at eta times as many rounds and as large a fraction and so on, up to its own
+    number of rounds and all the rows. After each rung the trial continues only when its loss is in the best 1/eta
+    of the losses recorded at that rung by all trials so far, otherwise it stops and its loss at that rung is its
+    result, marked as not complete so that it is never chosen as the best trial.
+
+    Parameters
+    ----------
+    algorithm : str
+        The model algorithm, the rounds are only scheduled for those in boosting_rounds_params.
+    min_rounds : int, optional
+        Boosting rounds of the first rung, None to always use the trial's own number of rounds.
+    min_fraction : float, optional
+        Fraction of the training rows of the first rung, None to always use all rows.
+    eta : int
+        Growth factor of the fidelity between rungs, and the inverse of the fraction of trials promoted.
+    """
+
+    def __init__(self, algorithm: str, min_rounds: Optional[int] = None, min_fraction: Optional[float] = None,
+                 eta: int = 3):
+        self.paths = boosting_rounds_params[algorithm] if algorithm in boosting_rounds_params else None
+        if min_rounds is not None and self.paths is None:
+            log.warning(f"{algorithm} has no boosting rounds, its trials are only stopped early on the data fraction")
+        self.min_rounds = min_rounds if self.paths is not None else None
+        self.min_fraction = min_fraction
+        self.eta = eta
+        self.rung_losses = defaultdict(list)
+        self._warned = False
+
+    @staticmethod
+    def _rounds_key(params: Dict, last) -> str:
+        if not isinstance(last, tuple):
+            return last
+        return next((k for k in last if k in params), last[0])
+
+    def boosting_rounds(self, params: Dict) -> Optional[int]:
+        if self.paths is None:
+            return None
+        *keys, last = self.paths[0]
+        for k in keys:
+            params = params[k]
+        return params.get(self._rounds_key(params, last))
+
+    def rungs(self, params: Dict) -> List[Tuple[Dict, float]]:
+        """
+        params and data fraction of each rung of a trial, the last rung is params itself with all the data.
+        """
+        max_rounds = self.boosting_rounds(params) if self.min_rounds is not None else None
+        if self.min_rounds is not None and max_rounds is None and not self._warned:
+            log.warning("Early stopping is configured but the model params do not set the number of boosting rounds, "
+                        "trials are only stopped early on the data fraction")
+            self._warned = True
+        rungs = []
+        for k in itertools.count():
+            rounds = None if max_rounds is None else min(self.min_rounds * self.eta ** k, max_rounds)
+            fraction = 1.0 if self.min_fraction is None else min(self.min_fraction * self.eta ** k, 1.0)
+            if rounds == max_rounds and fraction == 1.0:
+                return rungs + [(params, 1.0)]
+            rung = deepcopy(params)
+            for *keys, last in self.paths if rounds is not None else []:
+                p = rung
+                for key in keys:
+                    p = p[key]
+                p[self._rounds_key(p, last)] = rounds
+            rungs.append((rung, fraction))
+
+    def promote(self, rung: int, loss: float) -> bool:
+        """
+        Records the loss of a trial at a rung and returns whether the trial continues to the next rung.
+        """
+        losses = self.rung_losses[rung]
+        losses.append(loss)
+        return sorted(losses).index(loss) < max(len(losses) // self.eta, 1)
+
+
+def optimise_model(X: pd.DataFrame, y: pd.Series, w: pd.Series, groups: pd.Series, conf: Config,
+                   resume: bool = False):
     """
     :param X: covaraite matrix
     :param y: targets
     :param w: weights for each target
     :param groups: group number for each target
     :param conf:
+    :param resume: continue from the trials in conf.optimisation_trials_log
     :return:
     """
-    trials = Trials()
+    trials = load_trials(conf.optimisation_trials_log) if resume else Trials()
+    if resume:
+        log.info(f"Resuming optimisation from {len(trials.trials)} trials in {conf.optimisation_trials_log}")
+    elif conf.optimisation_trials_log.exists():
+        conf.optimisation_trials_log.unlink()
+    # loss of every parameter set evaluated so far, and whether it was at full fidelity, so that no parameter set is
+    # cross validated twice
+    memo = {_params_key(t['result']['params']): (t['result']['loss'], _is_complete(t))
+            for t in trials.trials if 'params' in t['result']}
     search_space = {k: eval(v) for k, v in conf.hp_params_space.items()}
 
     reg = modelmaps[conf.algorithm]
@@ -54,52 +163,103 @@ def optimise_model(X: pd.DataFrame, y: pd.Series, w: pd.Series, groups: pd.Serie
 
     log.info(f"shape of optimization data {X.shape}")
 
-    def objective(params, random_state=random_state, cv=cv, X=X[model_cols], y=y):
+    # trials evaluated concurrently, their fold fits share one pool of n_jobs workers
+    parallel_trials = conf.hyperopt_params.pop('parallel_trials') if 'parallel_trials' in conf.hyperopt_params \
+        else 1
+    n_jobs = joblib.effective_n_jobs(conf.hyperopt_params.pop('n_jobs') if 'n_jobs' in conf.hyperopt_params else -1)
+    early_stopping = conf.hyperopt_params.pop('early_stopping') if 'early_stopping' in conf.hyperopt_params else None
+    scheduler = None
+    if early_stopping is not None:
+        scheduler = SuccessiveHalving(conf.algorithm, **early_stopping)
+        log.info(f"Stopping poor trials early from {scheduler.min_rounds} boosting rounds and "
+                 f"{scheduler.min_fraction} of the data with eta {scheduler.eta}")
+
+    def trial_params(params):
         # the function gets a set of variable parameters in "param"
         all_params = {**conf.model_params}
         if has_random_state_arg:
             all_params.update(**params, random_state=random_state)
-            model = reg(** all_params)
         else:
             all_params.update(** params)
-            model = reg(** all_params)
-        print("="*50)
-        params_str = ''
-        for k, v in all_params.items():
-            params_str += f"{k}: {v}\n"
-        log.info(f"Cross-validating param combination:\n{params_str}")
-        cv_results = cross_validate(model, X, y,
-                                    fit_params={'sample_weight': w},
-                                    groups=le_groups, cv=cv, scoring={'score': scorer}, n_jobs=-1)
-        score = 1 - cv_results['test_score'].mean()
-        log.info(f"Loss: {score}")
-        return score
+        return all_params
+
+    def evaluate(batch: List[Dict]) -> List[Dict]:
+        all_params = [trial_params(p) for p in batch]
+        keys = [_params_key(p) for p in all_params]
+        new = {k: p for k, p in zip(keys, all_params) if k not in memo}
+        for p in all_params:
+            params_str = ''.join(f"{k}: {v}\n" for k, v in p.items())
+            log.info(f"{'Reusing loss of' if _params_key(p) not in new else 'Cross-validating'} "
+                     f"param combination:\n{params_str}")
+        # params and data fraction of each rung of the new trials, a single full rung without early stopping
+        active = {k: scheduler.rungs(p) if scheduler else [(p, 1.0)] for k, p in new.items()}
+        n_folds = len(store.folds)
+        rung = 0
+        while active:
+            n_tasks = len(active) * n_folds
+            # cores left over when there are fewer fold fits than workers go to the models' own threads
+            fit_n_jobs = max(n_jobs // n_tasks, 1)
+            scores = joblib.Parallel(n_jobs=min(n_jobs, n_tasks))(
+                joblib.delayed(_fit_and_score)(reg, rungs[rung][0], store.X, store.y, store.w,
+                                               store.stratified_subset(train, rungs[rung][1]), test, scorer,
+                                               fit_n_jobs)
+                for rungs in active.values() for train, test in store.folds
+            )
+            for i, (k, rungs) in enumerate(list(active.items())):
+                loss = 1 - np.mean(scores[i * n_folds: (i + 1) * n_folds])
+                if rung == len(rungs) - 1 or not scheduler.promote(rung, loss):
+                    if rung < len(rungs) - 1:
+                        log.info(f"Stopped trial early at {scheduler.boosting_rounds(rungs[rung][0])} boosting rounds "
+                                 f"and {rungs[rung][1]:.1%} of the data")
+                    log.info(f"Loss: {loss}")
+                    memo[k] = (loss, rung == len(rungs) - 1)
+                    del active[k]
+            rung += 1
+        return [{'loss': memo[k][0], 'complete': memo[k][1], 'status': STATUS_OK, 'params': p}
+                for k, p in zip(keys, all_params)]
+
+    def objective(params):
+        return evaluate([params])[0]
 
     step = conf.hyperopt_params.pop('step') if 'step' in conf.hyperopt_params else 10
     max_evals = conf.hyperopt_params.pop('max_evals') if 'max_evals' in conf.hyperopt_params else 50
 
-    log.info(f"Optimising params using Hyperopt {algo}")
-
-    for i in range(0, max_evals + 1, step):
-        # fmin runs until the trials object has max_evals elements in it, so it can do evaluations in chunks like this
-        best = fmin(
-            objective, search_space,
-            ** conf.hyperopt_params,
-            algo=algo,
-            trials=trials,
-            max_evals=i + step,
-            rstate=rstate
-        )
-        # each step 'best' will be the best trial so far
-        # params_str = ''
-        # best = space_eval(search_space, best)
-        # for k, v in best.items():
-        #     params_str += f"{k}: {v}\n"
-        log.info(f"Saving params after {i + step} trials best config: \n")
-        # each step 'trials' will be updated to contain every result
-        # you can save it to reload later in case of a crash, or you decide to kill the script
-        pickle.dump(trials, open(Path(conf.output_dir).joinpath(f"hpopt_{i + step}.pkl"), "wb"))
-        save_optimal(best, random_state, trials, objective, conf)
+    unsupported = set(conf.hyperopt_params) - fmin_parallel_params
+    if parallel_trials > 1 and unsupported:
+        raise ConfigException(f"hyperopt_params {sorted(unsupported)} are not supported with parallel_trials, only "
+                              f"{sorted(fmin_parallel_params)} are")
+
+    log.info(f"Optimising params using Hyperopt {algo}, {parallel_trials} trials at a time on {n_jobs} workers")
+    logged = len(trials.trials)
+
+    # the store's memory mapped files are removed even when the search fails or is interrupted
+    # the data fraction subsets of the rungs are drawn with the seed of the search, so they are reproducible
+    subset_seed = random_state if random_state is not None else conf.numpy_seed
+    with FeatureStore.create(conf, X[model_cols], y, w, le_groups, cv, random_state=subset_seed) as store:
+        for i in range(len(trials.trials) // step * step, max_evals + 1, step):
+            # fmin runs until the trials object has max_evals elements in it, so it can do evaluations in chunks
+            if parallel_trials > 1:
+                fmin_parallel(evaluate, search_space, algo=algo, trials=trials, max_evals=i + step,
+                              parallel_trials=parallel_trials, rstate=rstate, ** conf.hyperopt_params)
+            else:
+                fmin(
+                    objective, search_space,
+                    ** conf.hyperopt_params,
+                    algo=algo,
+                    trials=trials,
+                    max_evals=i + step,
+                    rstate=rstate
+                )
+            # each step 'best' will be the best trial so far that was evaluated at full fidelity
+            best = _trial_vals(best_complete_trial(trials))
+            # params_str = ''
+            # best = space_eval(search_space, best)
+            # for k, v in best.items():
+            #     params_str += f"{k}: {v}\n"
+            log.info(f"Saving params after {i + step} trials best config: \n")
+            # each step the new trials are appended to the trials log, which optimise --resume reloads after a crash
+            logged = append_trials(trials, conf.optimisation_trials_log, logged)
+            save_optimal(best, random_state, trials, conf)
 
     log.info(f"Finished param optimisation using Hyperopt")
     all_params = {** conf.model_params}
@@ -113,7 +273,87 @@ def optimise_model(X: pd.DataFrame, y: pd.Series, w: pd.Series, groups: pd.Serie
     return opt_model
 
 
-def save_optimal(best, random_state, trials, objective, conf: Config):
+def fmin_parallel(evaluate: Callable[[List[Dict]], List[Dict]], space, algo, trials: Trials, max_evals: int,
+                  parallel_trials: int, rstate: np.random.RandomState, timeout: Optional[float] = None,
+                  loss_threshold: Optional[float] = None, early_stop_fn: Optional[Callable] = None,
+                  verbose: bool = True, show_progressbar: bool = False):
+    """
+    Like hyperopt.fmin, but asks algo for parallel_trials suggestions at a time and evaluates them together. The
+    stopping conditions are checked between batches.
+
+    :param evaluate: returns the hyperopt results of a batch of parameter sets
+    :param space: hyperopt search space
+    :param algo: hyperopt suggest algorithm
+    :param trials: Trials the new trials are added to
+    :param max_evals: stop when trials has this many trials
+    :param parallel_trials: number of suggestions evaluated together
+    :param rstate: random state the suggestion seeds are drawn from
+    :param timeout: stop after this many seconds, as fmin
+    :param loss_threshold: stop once the best loss is at most this, as fmin
+    :param early_stop_fn: called as early_stop_fn(trials, *args) after each batch, stops when it returns True, as fmin
+    :param verbose: log the best loss after each batch
+    :param show_progressbar: accepted for compatibility with fmin, progress is logged instead
+    :return: the vals of the best trial, as fmin
+    """
+    domain = Domain(lambda params: None, space)
+    start = time.time()
+    early_stop_args = []
+    while len(trials.trials) < max_evals:
+        if timeout is not None and time.time() - start >= timeout:
+            break
+        if loss_threshold is not None and trials.trials and trials.best_trial['result']['loss'] <= loss_threshold:
+            break
+        trials.refresh()
+        n = min(parallel_trials, max_evals - len(trials.trials))
+        docs = algo(trials.new_trial_ids(n), domain, trials, rstate.randint(2 ** 31 - 1))
+        if not docs:
+            break
+        batch = [space_eval(space, {k: v[0] for k, v in d['misc']['vals'].items() if v}) for d in docs]
+        for d, result in zip(docs, evaluate(batch)):
+            d['result'] = result
+            d['state'] = JOB_STATE_DONE
+        trials.insert_trial_docs(docs)
+        trials.refresh()
+        if verbose:
+            log.info(f"{len(trials.trials)} trials, best loss {trials.best_trial['result']['loss']}")
+        if early_stop_fn is not None:
+            stop, early_stop_args = early_stop_fn(trials, *early_stop_args)
+            if stop:
+                break
+    return trials.argmin
+
+
+def _is_complete(trial: Dict) -> bool:
+    # trials logged before early stopping marked the fidelity of their results were all complete
+    return trial['result'].get('complete', True)
+
+
+def _trial_vals(trial: Dict) -> Dict:
+    return {k: v[0] for k, v in trial['misc']['vals'].items() if v}
+
+
+def best_complete_trial(trials: Trials) -> Dict:
+    """
+    The trial of lowest loss among those evaluated at full fidelity, i.e. not stopped early, like trials.best_trial.
+    """
+    complete = [t for t in trials.trials if t['result'].get('status') == STATUS_OK and _is_complete(t)]
+    if not complete:
+        log.warning("No trial was evaluated at full fidelity, the best trial is one stopped early")
+        return trials.best_trial
+    return min(complete, key=lambda t: t['result']['loss'])
+
+
+def _fit_and_score(reg, params: Dict, X: np.ndarray, y: np.ndarray, w: np.ndarray, train: np.ndarray,
+                   test: np.ndarray, scorer, n_jobs: int) -> float:
+    model = reg(** params)
+    # the share of the workers is only a default, an n_jobs set in the model params is kept
+    if 'n_jobs' in model.get_params() and 'n_jobs' not in params:
+        model.set_params(n_jobs=n_jobs)
+    model.fit(X[train], y[train], sample_weight=w[train])
+    return scorer(model, X[test], y[test])
+
+
+def save_optimal(best, random_state, trials, conf: Config):
 
     with open(conf.optimised_model_params, 'w') as f:
         all_params = {**conf.model_params, 'random_state': random_state}
@@ -134,10 +374,48 @@ def save_optimal(best, random_state, trials, objective, conf: Config):
     results = pd.DataFrame.from_dict(params_space, orient='columns')
     loss = [x['result']['loss'] for x in trials.trials]
     results.insert(0, 'loss', loss)
-    log.info("Best Loss {:.3f} params {}".format(objective(best), best))
+    # trials stopped early have the loss of a lower fidelity, not comparable with that of the complete trials
+    results.insert(1, 'complete', [_is_complete(x) for x in trials.trials])
+    log.info("Best Loss {:.3f} params {}".format(best_complete_trial(trials)['result']['loss'], best))
     results.sort_values(by='loss').to_csv(conf.optimisation_output_hpopt)
 
 
+def _params_key(params: Dict) -> str:
+    return json.dumps(params, sort_keys=True, cls=NpEncoder)
+
+
+def append_trials(trials: Trials, trials_log: Path, start: int) -> int:
+    """
+    Appends the finished trials from position start onwards to the trials log, one json line per trial.
+    :return: number of trials in the log
+    """
+    with open(trials_log, 'a') as f:
+        for t in trials.trials[start:]:
+            record = {'vals': t['misc']['vals'], 'result': t['result']}
+            f.write(json.dumps(record, cls=NpEncoder) + '\n')
+    return len(trials.trials)
+
+
+def load_trials(trials_log: Path) -> Trials:
+    """
+    Rebuilds a hyperopt Trials from the trials log written by append_trials.
+    """
+    trials = Trials()
+    if not trials_log.exists():
+        return trials
+    with open(trials_log) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    for r in records:
+        tid, = trials.new_trial_ids(1)
+        misc = {'tid': tid, 'cmd': ('domain_attachment', 'FMinIter_Domain'), 'workdir': None,
+                'idxs': {k: [tid] if v else [] for k, v in r['vals'].items()}, 'vals': r['vals']}
+        doc, = trials.new_trial_docs([tid], [None], [r['result']], [misc])
+        doc['state'] = JOB_STATE_DONE
+        trials.insert_trial_docs([doc])
+    trials.refresh()
+    return trials
+
+
 class NpEncoder(json.JSONEncoder):
     """
     see https://stackoverflow.com/a/57915246/3321542
@@ -1,4 +1,6 @@
+import joblib
 import numpy as np
+import xgboost
 from functools import partial
 from scipy.stats import norm
 from sklearn.ensemble import GradientBoostingRegressor, RandomForestRegressor
@@ -9,7 +11,18 @@ from catboost import CatBoostRegressor
 from aem.logger import aemlogger as log
 
 
+# xgboost >= 2.0 has a native quantile objective that fits several quantiles in one booster
+native_quantile_objective = int(xgboost.__version__.split('.')[0]) >= 2
+# XGBQuantileRegressor params that may differ between the quantiles fitted in one booster
+native_unused_params = {'alpha', 'delta', 'thresh', 'variance'}
+
+
 class XGBQuantileRegressor(XGBRegressor):
+    """
+    Quantile xgboost model. alpha is a quantile, or with xgboost >= 2.0 a list of quantiles fitted in one booster
+    with the native 'reg:quantileerror' objective, in which case delta, thresh and variance are not used. Older
+    xgboost versions train with the smoothed quantile_loss objective.
+    """
     def __init__(self,
                  alpha, delta, thresh, variance,
                  **kwargs
@@ -21,11 +34,19 @@ class XGBQuantileRegressor(XGBRegressor):
 
         super(XGBQuantileRegressor, self).__init__(**kwargs)
 
-    def fit(self, X, y, **kwargs):
-        objective = partial(XGBQuantileRegressor.quantile_loss, alpha=self.alpha, delta=self.delta,
-                            threshold=self.thresh, var=self.variance)
-        super().set_params(objective=objective)
-        super().fit(X, y)
+    def fit(self, X, y, sample_weight=None, **kwargs):
+        if native_quantile_objective:
+            super().set_params(objective='reg:quantileerror', quantile_alpha=self.alpha)
+        elif np.ndim(self.alpha):
+            raise ValueError(f"Fitting the quantiles {self.alpha} in one model needs xgboost >= 2.0")
+        else:
+            # custom objectives get no weights from xgboost, they are applied to the gradients instead
+            objective = partial(XGBQuantileRegressor.quantile_loss, alpha=self.alpha, delta=self.delta,
+                                threshold=self.thresh, var=self.variance,
+                                weight=None if sample_weight is None else np.asarray(sample_weight, dtype=np.float64),
+                                random_state=np.random.RandomState(self.random_state))
+            super().set_params(objective=objective)
+        super().fit(X, y, sample_weight=sample_weight)
         return self
 
     def predict(self, X, **kwargs):
@@ -33,21 +54,27 @@ class XGBQuantileRegressor(XGBRegressor):
 
     def score(self, X, y, **kwargs):
         y_pred = super().predict(X)
-        score = self.quantile_score(y, y_pred, self.alpha)
+        y = np.asarray(y)
+        if y_pred.ndim > 1:  # a column per quantile
+            y = y[:, np.newaxis]
+        score = self.quantile_score(y, y_pred, np.asarray(self.alpha))
         score = 1. / score
         return score
 
     @staticmethod
-    def quantile_loss(y_true, y_pred, alpha, delta, threshold, var):
+    def quantile_loss(y_true, y_pred, alpha, delta, threshold, var, weight=None, random_state=np.random):
         x = y_true - y_pred
-        grad = (x < (alpha - 1.0) * delta) * (1.0 - alpha) - \
-               ((x >= (alpha - 1.0) * delta) & (x < alpha * delta)) * x / delta - \
-               alpha * (x > alpha * delta)
-        hess = ((x >= (alpha - 1.0) * delta) & (x < alpha * delta)) / delta
-
-        grad = (np.abs(x) < threshold) * grad - (np.abs(x) >= threshold) * (
-            2 * np.random.randint(2, size=len(y_true)) - 1.0) * var
-        hess = (np.abs(x) < threshold) * hess + (np.abs(x) >= threshold)
+        lower, upper = (alpha - 1.0) * delta, alpha * delta
+        grad = np.select([x < lower, x < upper, x > upper], [1.0 - alpha, -x / delta, -alpha], 0.0)
+        hess = ((x >= lower) & (x < upper)) / delta
+
+        # random gradients of size var away from the quantile, only drawn for the rows beyond the threshold
+        far = np.abs(x) >= threshold
+        grad[far] = -(2 * random_state.randint(2, size=np.count_nonzero(far)) - 1.0) * var
+        hess[far] = 1.0
+        if weight is not None:
+            grad *= weight
+            hess *= weight
         return grad, hess
 
     # @staticmethod
@@ -79,20 +106,43 @@ class XGBQuantileRegressor(XGBRegressor):
 
 
 class QuantileXGB(BaseEstimator, RegressorMixin):
+    """
+    Mean and quantile xgboost models, fitted and predicted concurrently. With xgboost >= 2.0, and lower and upper
+    quantile params that only differ in alpha and the smoothed loss params it does not use, the lower and upper
+    quantiles are fitted in one booster, otherwise in a booster each. n_jobs is the thread budget of the models,
+    shared equally by their boosters.
+    """
     def __init__(
         self,
         mean_model_params,
         upper_quantile_params,
-        lower_quantile_params
+        lower_quantile_params,
+        n_jobs=-1
     ):
         self.mean_model_params = mean_model_params
         self.upper_quantile_params = upper_quantile_params
         self.lower_quantile_params = lower_quantile_params
+        self.n_jobs = n_jobs
         self.gb = XGBRegressor(**mean_model_params)
-        self.gb_quantile_upper = XGBQuantileRegressor(**upper_quantile_params)
-        self.gb_quantile_lower = XGBQuantileRegressor(**lower_quantile_params)
         self.upper_alpha = upper_quantile_params['alpha']
         self.lower_alpha = lower_quantile_params['alpha']
+        shared = all(lower_quantile_params.get(k) == upper_quantile_params.get(k)
+                     for k in set(lower_quantile_params) | set(upper_quantile_params) if k not in native_unused_params)
+        if native_quantile_objective and shared:
+            # one booster for both quantiles, the params are those of either quantile model
+            self.quantile_models = [
+                XGBQuantileRegressor(**{**upper_quantile_params, 'alpha': [self.lower_alpha, self.upper_alpha]})
+            ]
+        else:
+            self.quantile_models = [XGBQuantileRegressor(**lower_quantile_params),
+                                    XGBQuantileRegressor(**upper_quantile_params)]
+
+    def __setstate__(self, state):
+        # models pickled before the quantile models were fitted together keep a lower and an upper quantile model
+        if 'quantile_models' not in state:
+            state['quantile_models'] = [state.pop('gb_quantile_lower'), state.pop('gb_quantile_upper')]
+        state.setdefault('n_jobs', -1)
+        super().__setstate__(state)
 
     @staticmethod
     def collect_prediction(regressor, X_test):
@@ -100,33 +150,28 @@ class QuantileXGB(BaseEstimator, RegressorMixin):
         return y_pred
 
     def fit(self, X, y, **kwargs):
-        log.info('Fitting xgb base model')
-        self.gb.fit(X, y, **kwargs)
-        log.info('Fitting xgb upper quantile model')
-        self.gb_quantile_upper.fit(X, y, **kwargs)
-        log.info('Fitting xgb lower quantile model')
-        self.gb_quantile_lower.fit(X, y, **kwargs)
+        models = [self.gb] + self.quantile_models
+        n_jobs = joblib.effective_n_jobs(self.n_jobs)
+        for m in models:
+            m.set_params(n_jobs=max(n_jobs // len(models), 1))
+        log.info('Fitting xgb base and quantile models')
+        fit_sub_models(models, X, y, n_jobs, **kwargs)
+        return self
 
     def predict(self, X, *args, **kwargs):
         return self.predict_dist(X, *args, **kwargs)[0]
 
     def predict_dist(self, X, interval=0.95):
-        Ey = self.gb.predict(X)
-
-        ql_ = self.collect_prediction(self.gb_quantile_lower, X)
-        qu_ = self.collect_prediction(self.gb_quantile_upper, X)
-        # divide qu - ql by the normal distribution Z value diff between the quantiles, square for variance
-        Vy = ((qu_ - ql_) / (norm.ppf(self.upper_alpha) - norm.ppf(self.lower_alpha))) ** 2
-
-        # to make gbm quantile model consistent with other quantile based models
-        ql, qu = norm.interval(interval, loc=Ey, scale=np.sqrt(Vy))
-
-        return Ey, Vy, ql, qu
+        Ey, *quantiles = predict_sub_models([self.gb] + self.quantile_models, X, joblib.effective_n_jobs(self.n_jobs))
+        ql_, qu_ = np.column_stack(quantiles).T
+        return dist_from_quantiles(Ey, ql_, qu_, self.lower_alpha, self.upper_alpha, interval)
 
 
 class QuantileGradientBoosting(BaseEstimator, RegressorMixin):
     """
     Bespoke Quantile Gradient Boosting Regression implementation.
+
+    The median, upper and lower quantile models are fitted and predicted concurrently on up to n_jobs threads.
     """
     def __init__(self, loss='quantile',
                  alpha=0.5, upper_alpha=0.95, lower_alpha=0.05,
@@ -138,7 +183,8 @@ class QuantileGradientBoosting(BaseEstimator, RegressorMixin):
                  max_features=None, verbose=0, max_leaf_nodes=None,
                  warm_start=False,
                  validation_fraction=0.1,
-                 n_iter_no_change=None, tol=1e-4, ccp_alpha=0.0
+                 n_iter_no_change=None, tol=1e-4, ccp_alpha=0.0,
+                 n_jobs=-1
                  ):
         if loss != "quantile":
             st = f"loss: {loss}"
@@ -173,6 +219,7 @@ class QuantileGradientBoosting(BaseEstimator, RegressorMixin):
         self.n_iter_no_change = n_iter_no_change
         self.tol = tol
         self.ccp_alpha = ccp_alpha
+        self.n_jobs = n_jobs
 
         self.gb = GradientBoostingRegressor(
             learning_rate=learning_rate, n_estimators=n_estimators,
@@ -222,34 +269,58 @@ class QuantileGradientBoosting(BaseEstimator, RegressorMixin):
         self.upper_alpha = upper_alpha
         self.lower_alpha = lower_alpha
 
+    def __setstate__(self, state):
+        # models pickled before the sub models were fitted concurrently have no n_jobs
+        state.setdefault('n_jobs', -1)
+        super().__setstate__(state)
+
     @staticmethod
     def collect_prediction(regressor, X_test):
         y_pred = regressor.predict(X_test)
         return y_pred
 
     def fit(self, X, y, *args, **kwargs):
-        log.info('Fitting gb base model')
-        self.gb.fit(X, y, sample_weight=kwargs['sample_weight'])
-        log.info('Fitting gb upper quantile model')
-        self.gb_quantile_upper.fit(X, y, sample_weight=kwargs['sample_weight'])
-        log.info('Fitting gb lower quantile model')
-        self.gb_quantile_lower.fit(X, y, sample_weight=kwargs['sample_weight'])
+        log.info('Fitting gb base, upper and lower quantile models')
+        fit_sub_models([self.gb, self.gb_quantile_upper, self.gb_quantile_lower], X, y,
+                       joblib.effective_n_jobs(self.n_jobs), sample_weight=kwargs.get('sample_weight'))
+        return self
 
     def predict(self, X, *args, **kwargs):
         return self.predict_dist(X, *args, **kwargs)[0]
 
     def predict_dist(self, X, interval=0.95, *args, ** kwargs):
-        Ey = self.gb.predict(X)
+        Ey, ql_, qu_ = predict_sub_models([self.gb, self.gb_quantile_lower, self.gb_quantile_upper], X,
+                                          joblib.effective_n_jobs(self.n_jobs))
+        return dist_from_quantiles(Ey, ql_, qu_, self.lower_alpha, self.upper_alpha, interval)
 
-        ql_ = self.collect_prediction(self.gb_quantile_lower, X)
-        qu_ = self.collect_prediction(self.gb_quantile_upper, X)
-        # divide qu - ql by the normal distribution Z value diff between the quantiles, square for variance
-        Vy = ((qu_ - ql_) / (norm.ppf(self.upper_alpha) - norm.ppf(self.lower_alpha))) ** 2
 
-        # to make gbm quantile model consistent with other quantile based models
-        ql, qu = norm.interval(interval, loc=Ey, scale=np.sqrt(Vy))
+def fit_sub_models(models, X, y, n_jobs, **kwargs):
+    """
+    Fits the sub models of a composite estimator on up to n_jobs threads. Tree building and xgboost training
+    release the GIL, so the models train in parallel without copying X into other processes.
+    """
+    return joblib.Parallel(n_jobs=min(len(models), n_jobs), prefer='threads')(
+        joblib.delayed(m.fit)(X, y, **kwargs) for m in models
+    )
 
-        return Ey, Vy, ql, qu
+
+def dist_from_quantiles(Ey, ql_, qu_, lower_alpha, upper_alpha, interval):
+    """
+    Variance and interval quantiles of a prediction from the predictions of its lower and upper quantile models.
+    """
+    # divide qu - ql by the normal distribution Z value diff between the quantiles, square for variance
+    Vy = ((qu_ - ql_) / (norm.ppf(upper_alpha) - norm.ppf(lower_alpha))) ** 2
+
+    # to make gbm quantile model consistent with other quantile based models
+    ql, qu = norm.interval(interval, loc=Ey, scale=np.sqrt(Vy))
+
+    return Ey, Vy, ql, qu
+
+
+def predict_sub_models(models, X, n_jobs):
+    return joblib.Parallel(n_jobs=min(len(models), n_jobs), prefer='threads')(
+        joblib.delayed(m.predict)(X) for m in models
+    )
 
 
 class QuantileRandomForestRegressor(RandomForestRegressor):
@@ -258,19 +329,127 @@ class QuantileRandomForestRegressor(RandomForestRegressor):
     decision tree estimator ouputs.
     """
 
-    def predict_dist(self, X, interval=0.95):
-        Ey = self.predict(X)
-        Vy = np.zeros_like(Ey)
-        for dt in self.estimators_:
-            Vy += (dt.predict(X) - Ey) ** 2
-
-        Vy /= len(self.estimators_)
+    def predict_dist(self, X, interval=0.95, chunk_rows=10000):
+        """
+        Mean and variance of the tree predictions in one pass over the forest. Rows are predicted in chunks of
+        chunk_rows across n_jobs threads, each chunk accumulating the moments tree by tree with Welford's update, so
+        memory is bounded by the chunk size rather than by the number of trees.
+        """
+        X = self._validate_X_predict(X)
+        moments = joblib.Parallel(n_jobs=self.n_jobs, prefer='threads')(
+            joblib.delayed(_tree_moments)(self.estimators_, X[start: start + chunk_rows])
+            for start in range(0, X.shape[0], chunk_rows)
+        )
+        Ey = np.concatenate([m for m, _ in moments]) if moments else np.zeros(0)
+        Vy = np.concatenate([v for _, v in moments]) if moments else np.zeros(0)
         # FIXME what if elements of Vy are zero?
         ql, qu = norm.interval(interval, loc=Ey, scale=np.sqrt(Vy))
 
         return Ey, Vy, ql, qu
 
 
+def _tree_moments(estimators, X):
+    mean = np.zeros(X.shape[0])
+    m2 = np.zeros(X.shape[0])
+    for i, dt in enumerate(estimators, start=1):
+        p = dt.predict(X, check_input=False)
+        delta = p - mean
+        mean += delta / i
+        m2 += delta * (p - mean)
+    return mean, m2 / len(estimators)
+
+
+class QuantileRegressionForest(RandomForestRegressor):
+    """
+    Quantile regression forest (Meinshausen, 2006). The conditional distribution of y at a point is the training
+    targets weighted by how often, and in how small a leaf, they share a leaf with the point across the trees.
+
+    At fit time the training rows of each leaf are stored sorted by target, as ranks into the sorted training
+    targets with their weights normalised within the leaf, so any number of quantiles comes out of one apply of
+    the forest.
+    """
+
+    def fit(self, X, y, sample_weight=None):
+        super().fit(X, y, sample_weight=sample_weight)
+        X = self._validate_X_predict(X)
+        y = np.asarray(y, dtype=np.float64).ravel()
+        w = np.ones(y.shape[0]) if sample_weight is None else np.asarray(sample_weight, dtype=np.float64)
+        order = np.argsort(y, kind='stable')
+        self.y_sorted_ = y[order]
+        w = w[order]
+        n = y.shape[0]
+        ranks, weights, offsets = [], [], []
+        for t, dt in enumerate(self.estimators_):
+            leaf = dt.apply(X[order], check_input=False)
+            node_count = dt.tree_.node_count
+            # stable sort by leaf of the rows in target order, the rows of each leaf stay sorted by target
+            r = np.argsort(leaf, kind='stable')
+            leaf_weight = np.bincount(leaf, weights=w, minlength=node_count)
+            leaf_weight[leaf_weight == 0] = 1
+            ranks.append(r.astype(np.int32))
+            weights.append((w[r] / leaf_weight[leaf[r]]).astype(np.float32))
+            offsets.append(t * n + np.r_[0, np.cumsum(np.bincount(leaf, minlength=node_count))])
+        self.leaf_ranks_ = np.concatenate(ranks)
+        self.leaf_weights_ = np.concatenate(weights)
+        self.leaf_offsets_ = np.concatenate(offsets)
+        # position in leaf_offsets_ of the offsets of each tree
+        self.tree_offsets_ = np.r_[0, np.cumsum([len(o) for o in offsets])[:-1]]
+        return self
+
+    def predict_quantiles(self, X, quantiles, chunk_rows=1000):
+        """
+        Quantiles of the conditional distribution of y at the rows of X, an array of shape (rows, len(quantiles)).
+        """
+        return self._predict_leaf_distribution(X, quantiles, chunk_rows)[2]
+
+    def predict_dist(self, X, interval=0.95, chunk_rows=1000):
+        """
+        Mean, variance and the quantiles bounding interval of the conditional distribution of y, from one apply of
+        the forest per chunk of chunk_rows rows.
+        """
+        quantiles = [(1 - interval) / 2, (1 + interval) / 2]
+        Ey, Vy, q = self._predict_leaf_distribution(X, quantiles, chunk_rows)
+        return Ey, Vy, q[:, 0], q[:, 1]
+
+    def _predict_leaf_distribution(self, X, quantiles, chunk_rows):
+        X = self._validate_X_predict(X)
+        quantiles = np.atleast_1d(quantiles)
+        dists = joblib.Parallel(n_jobs=self.n_jobs, prefer='threads')(
+            joblib.delayed(self._leaf_distribution)(X[start: start + chunk_rows], quantiles)
+            for start in range(0, X.shape[0], chunk_rows)
+        )
+        if not dists:
+            return np.zeros(0), np.zeros(0), np.zeros((0, quantiles.shape[0]))
+        return tuple(np.concatenate(d) for d in zip(*dists))
+
+    def _leaf_distribution(self, X, quantiles):
+        n_rows, n_trees = X.shape[0], len(self.estimators_)
+        leaves = np.column_stack([dt.apply(X, check_input=False) for dt in self.estimators_])
+        nodes = (self.tree_offsets_[np.newaxis, :] + leaves).ravel()  # row major, grouped by row
+        starts, ends = self.leaf_offsets_[nodes], self.leaf_offsets_[nodes + 1]
+        lengths = ends - starts
+        # gather the training rows of the leaf of each row in each tree
+        pos = np.repeat(starts - np.r_[0, np.cumsum(lengths)[:-1]], lengths) + np.arange(lengths.sum())
+        rows = np.repeat(np.repeat(np.arange(n_rows), n_trees), lengths)
+        ranks = self.leaf_ranks_[pos].astype(np.int64)
+        order = np.argsort(rows * self.y_sorted_.shape[0] + ranks)
+        ranks, weights = ranks[order], self.leaf_weights_[pos][order].astype(np.float64) / n_trees
+        values = self.y_sorted_[ranks]
+        row_starts = np.r_[0, np.cumsum(lengths.reshape(n_rows, n_trees).sum(axis=1))[:-1]]
+        row_ends = np.r_[row_starts[1:], values.shape[0]]
+
+        Ey = np.add.reduceat(weights * values, row_starts)
+        Vy = np.add.reduceat(weights * (values - np.repeat(Ey, row_ends - row_starts)) ** 2, row_starts)
+        cum_weights = np.cumsum(weights)
+        cdf = cum_weights - np.repeat(cum_weights[row_starts] - weights[row_starts], row_ends - row_starts)
+        q = np.empty((n_rows, quantiles.shape[0]))
+        for j, alpha in enumerate(quantiles):
+            # first value of each row at which the weighted cdf reaches alpha
+            below = np.add.reduceat((cdf < alpha).astype(np.int64), row_starts)
+            q[:, j] = values[np.minimum(row_starts + below, row_ends - 1)]
+        return Ey, Vy, q
+
+
 class CatBoostWrapper(CatBoostRegressor):
 
     def __init__(self,  **kwargs):
@@ -299,6 +478,7 @@ modelmaps = {
     'gradientboost': GradientBoostingRegressor,
     'quantilegb': QuantileGradientBoosting,
     'randomforest': QuantileRandomForestRegressor,
+    'quantileforest': QuantileRegressionForest,
     'quantilexgb': QuantileXGB,
     'catboost': CatBoostWrapper,
 }
@@ -1,9 +1,28 @@
+import os
+import json
+import shutil
+import time
+from copy import copy
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Optional, Dict
+import numpy as np
 import pandas as pd
+import geopandas as gpd
+from threadpoolctl import threadpool_limits
 from aem import utils
-from aem.config import Config
-from aem.logger import aemlogger as log
+from aem.config import Config, read_dbf_header
+from aem.data import split_flight_lines_into_multiple_segments, wait_for_diagnostics
+from aem.profiling import profiled, stage
+from aem.logger import configure_logging, aemlogger as log
+from aem.writers import write_output, concat_outputs
 
+tile_row_col = '__row__'
+# model loaded once in each prediction worker process by _init_prediction_worker, on its first file
+_worker_model = None
 
+
+@profiled('predict')
 def add_pred_to_data(X: pd.DataFrame, conf: Config, model, oos: bool = False) -> pd.DataFrame:
     model_cols = utils.select_cols_used_in_model(conf)
     prefix = 'oos_' if oos else ''
@@ -23,3 +42,159 @@ def add_pred_to_data(X: pd.DataFrame, conf: Config, model, oos: bool = False) ->
     X = pd.concat((X, pred), axis=1)
 
     return X
+
+
+def predict_aem_file(conf: Config, model, aem_file: Path, output_file: Path):
+    """
+    Segments, prepares and predicts a whole aem shapefile in memory and writes the predictions to output_file.
+    """
+    with stage('load'):
+        aem_data = gpd.GeoDataFrame.from_file(aem_file, rows=conf.shapefile_rows)
+    pred_aem_data = split_flight_lines_into_multiple_segments(aem_data, is_train=False, conf=conf)
+    X = utils.prepare_aem_data(conf, pred_aem_data)[utils.select_required_data_cols(conf)]
+    X = add_pred_to_data(X, conf, model)
+    write_output(X, conf, output_file, crs=aem_data.crs)
+
+
+def predict_aem_file_in_tiles(conf: Config, model, aem_file: Path, output_file: Path, tile_rows: int,
+                              halo_rows: int):
+    """
+    Predicts an aem shapefile a tile of rows at a time so that memory use is bounded by the tile size. Each tile is
+    read with halo_rows extra rows on either side, which take part in line segmentation and the along line smoothing
+    but are not predicted, so results at tile edges are consistent with their neighbours. Predictions of each tile
+    are written to a part file in a directory next to output_file and the completed tiles are recorded in a progress
+    file, so a killed job resumes from the first incomplete tile. The parts are concatenated into output_file once
+    every tile is predicted, with the columns of predict_aem_file. cluster_line_no is numbered per tile. The survey
+    lines are not plotted, as each tile would overwrite the plot of the previous one.
+
+    :param conf: Config instance
+    :param model: trained model
+    :param aem_file: aem shapefile to predict
+    :param output_file: file the predictions are written to
+    :param tile_rows: number of rows predicted per tile
+    :param halo_rows: number of rows read either side of a tile
+    """
+    if conf.plot_survey_lines:
+        log.info("Survey lines are not plotted when predicting in tiles")
+        conf = copy(conf)
+        conf.plot_survey_lines = False
+    n_rows, _ = read_dbf_header(aem_file)
+    if conf.shapefile_rows is not None and conf.shapefile_rows > 0:
+        n_rows = min(n_rows, conf.shapefile_rows)
+    n_tiles = int(np.ceil(n_rows / tile_rows))
+
+    parts_dir = Path(output_file.as_posix() + '.tiles')
+    parts_dir.mkdir(exist_ok=True, parents=True)
+    parts = [parts_dir.joinpath(f"tile_{t:06d}{output_file.suffix}") for t in range(n_tiles)]
+    progress_file = parts_dir.joinpath('progress.json')
+    progress = {'aem_file': Path(aem_file).as_posix(), 'tile_rows': tile_rows, 'halo_rows': halo_rows,
+                'output_format': conf.output_format, 'output_columns': conf.output_columns, 'completed_tiles': 0}
+    if progress_file.exists():
+        previous = json.loads(progress_file.read_text())
+        if all(previous[k] == progress[k] for k in progress if k != 'completed_tiles'):
+            progress = previous
+            log.info(f"Resuming prediction of {aem_file} from tile {progress['completed_tiles']} of {n_tiles}")
+
+    crs = gpd.GeoDataFrame.from_file(aem_file, rows=1).crs
+    for tile in range(progress['completed_tiles'], n_tiles):
+        start, stop = tile * tile_rows, min((tile + 1) * tile_rows, n_rows)
+        lo, hi = max(start - halo_rows, 0), min(stop + halo_rows, n_rows)
+        log.info(f"Predicting tile {tile + 1} of {n_tiles}, rows {start} to {stop} of {aem_file}")
+        with stage('load'):
+            aem_data = gpd.GeoDataFrame.from_file(aem_file, rows=slice(lo, hi))
+        aem_data[tile_row_col] = np.arange(lo, lo + aem_data.shape[0])
+        pred_aem_data = split_flight_lines_into_multiple_segments(aem_data, is_train=False, conf=conf)
+        pred_aem_data = utils.prepare_aem_data(conf, pred_aem_data)
+        in_tile = (pred_aem_data[tile_row_col] >= start) & (pred_aem_data[tile_row_col] < stop)
+        X = pred_aem_data.loc[in_tile, utils.select_required_data_cols(conf)]
+        X = add_pred_to_data(X, conf, model)
+        write_output(X, conf, parts[tile], crs=crs)
+        progress['completed_tiles'] = tile + 1
+        progress_file.write_text(json.dumps(progress, indent=4))
+
+    log.info(f"Concatenating {n_tiles} tiles into {output_file}")
+    concat_outputs(conf, parts, output_file, crs=crs)
+    shutil.rmtree(parts_dir)
+
+
+def predict_file(conf: Config, model, aem_file: Path, output_file: Path, tile_rows: Optional[int] = None,
+                 halo_rows: int = 0):
+    if tile_rows is None:
+        predict_aem_file(conf, model, aem_file, output_file)
+    else:
+        predict_aem_file_in_tiles(conf, model, aem_file, output_file, tile_rows=tile_rows, halo_rows=halo_rows)
+
+
+def _init_prediction_worker(conf: Config, model_type: str, verbosity: int, jobs: int):
+    global _worker_model
+    if not log.handlers:
+        configure_logging(verbosity)
+    # the workers share the cores, so the joblib pools, model threads and compiled models of each worker, which
+    # default to all cores, use their share of them
+    threads = max(os.cpu_count() // jobs, 1)
+    os.environ['LOKY_MAX_CPU_COUNT'] = str(threads)  # bounds joblib.cpu_count and so n_jobs=-1
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    threadpool_limits(limits=threads)  # the OpenMP and BLAS runtimes already loaded when the worker was forked
+    _worker_model, _ = utils.import_model(conf, model_type)
+
+
+def _predict_file_in_worker(conf: Config, model_type: str, verbosity: int, jobs: int, aem_file: Path,
+                            output_file: Path, tile_rows: Optional[int], halo_rows: int) -> float:
+    # ProcessPoolExecutor takes an initializer from python 3.7 on only
+    if _worker_model is None:
+        _init_prediction_worker(conf, model_type, verbosity, jobs)
+    t0 = time.perf_counter()
+    predict_file(conf, _worker_model, aem_file, output_file, tile_rows, halo_rows)
+    wait_for_diagnostics()  # the pool may stop the worker before its plots are saved
+    return time.perf_counter() - t0
+
+
+def predict_aem_files(conf: Config, model_type: str, jobs: int = 1, tile_rows: Optional[int] = None,
+                      halo_rows: int = 0) -> Dict[Path, Exception]:
+    """
+    Predicts every apply_model file of the config, spreading the files over a pool of jobs worker processes. Each
+    worker loads the model once and writes its own output files. A failing file is logged and reported without
+    stopping the other files.
+
+    :param conf: Config instance
+    :param model_type: 'learn' or 'optimised'
+    :param jobs: number of worker processes, -1 to use all cores
+    :param tile_rows: predict in tiles of this many rows, see predict_aem_file_in_tiles
+    :param halo_rows: rows read either side of a tile
+    :return: the files that failed mapped to their exception
+    """
+    files = list(zip(conf.aem_pred_data, conf.pred_data))
+    jobs = os.cpu_count() if jobs == -1 else jobs
+    jobs = max(min(jobs, len(files)), 1)
+    failures = {}
+
+    if jobs == 1:
+        model, _ = utils.import_model(conf, model_type)
+        for p, r in files:
+            log.info(f"Predicting {p} using {conf.algorithm} model")
+            t0 = time.perf_counter()
+            try:
+                predict_file(conf, model, p, r, tile_rows, halo_rows)
+            except Exception as e:
+                log.exception(f"Failed predicting {p}")
+                failures[p] = e
+                continue
+            log.info(f"Finished predicting {p} in {time.perf_counter() - t0:.1f}s, saved prediction at {r}")
+        return failures
+
+    log.info(f"Predicting {len(files)} files using {jobs} processes")
+    verbosity = log.getEffectiveLevel()
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(_predict_file_in_worker, conf, model_type, verbosity, jobs, p, r, tile_rows,
+                                   halo_rows): (p, r)
+                   for p, r in files}
+        for future in as_completed(futures):
+            p, r = futures[future]
+            try:
+                elapsed = future.result()
+            except Exception as e:
+                log.error(f"Failed predicting {p}: {e!r}")
+                failures[p] = e
+                continue
+            log.info(f"Finished predicting {p} in {elapsed:.1f}s, saved prediction at {r}")
+    return failures
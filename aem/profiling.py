@@ -0,0 +1,195 @@
+import cProfile
+import functools
+import io
+import pstats
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Dict, List, Union
+
+from aem.logger import aemlogger as log
+
+# the profiler of the run, None unless the aem command was given --profile
+_profiler = None
+
+
+class _NoStage:
+    """Context of a stage when profiling is off, entering and leaving it does nothing"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_no_stage = _NoStage()
+
+
+class _StageRecord:
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.seconds = 0.0
+        self.peak_bytes = 0
+        self.cpu = cProfile.Profile()
+        # net bytes and blocks allocated by each source line during the stage and not freed by its end
+        self.allocations = {}
+
+    def add_allocations(self, diffs: List[tracemalloc.StatisticDiff]):
+        for d in diffs:
+            size, count = self.allocations.get(d.traceback, (0, 0))
+            self.allocations[d.traceback] = (size + d.size_diff, count + d.count_diff)
+
+
+class _Stage:
+
+    def __init__(self, profiler: 'StageProfiler', name: str):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler.enter(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.exit()
+        return False
+
+
+class StageProfiler:
+    """Cpu profiles and allocation snapshots of the stages of an aem run
+
+    Each stage has its own cProfile profile, accumulated over all of its calls. Stages nest, the cpu time of an inner
+    stage is attributed to it alone while its allocations and peak memory also count towards the stages around it.
+    Only the calling thread is profiled, work of joblib and prediction worker processes shows as waiting on them.
+
+    Parameters
+    ----------
+    top_n : int
+        Number of functions and allocation sites listed in the summary of each stage.
+    """
+
+    def __init__(self, top_n: int = 30):
+        self.top_n = top_n
+        self.directory = Path('profile')
+        self.records: Dict[str, _StageRecord] = {}
+        self.stack: List[tuple] = []
+        self.filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stage(self, name: str) -> _Stage:
+        return _Stage(self, name)
+
+    def _snapshot(self) -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces(self.filters)
+
+    def _update_outer_peak(self, peak: int):
+        if self.stack:
+            outer = self.records[self.stack[-1][0]]
+            outer.peak_bytes = max(outer.peak_bytes, peak)
+
+    def enter(self, name: str):
+        if self.stack:
+            self.records[self.stack[-1][0]].cpu.disable()
+        self._update_outer_peak(tracemalloc.get_traced_memory()[1])
+        if hasattr(tracemalloc, 'reset_peak'):  # python 3.9 onwards, the peak is of the whole run before that
+            tracemalloc.reset_peak()
+        if name not in self.records:
+            self.records[name] = _StageRecord(name)
+        record = self.records[name]
+        record.calls += 1
+        self.stack.append((name, self._snapshot(), time.perf_counter()))
+        record.cpu.enable()
+
+    def exit(self):
+        name, start, t0 = self.stack[-1]
+        record = self.records[name]
+        record.cpu.disable()
+        record.seconds += time.perf_counter() - t0
+        peak = tracemalloc.get_traced_memory()[1]
+        record.peak_bytes = max(record.peak_bytes, peak)
+        record.add_allocations(self._snapshot().compare_to(start, 'lineno'))
+        self.stack.pop()
+        self._update_outer_peak(peak)
+        if self.stack:
+            self.records[self.stack[-1][0]].cpu.enable()
+
+    def summary(self, record: _StageRecord) -> str:
+        s = io.StringIO()
+        s.write(f"stage {record.name}: {record.calls} calls, {record.seconds:.3f}s, "
+                f"peak traced memory {record.peak_bytes / 1024 ** 2:.1f}MB\n\n")
+        s.write(f"top {self.top_n} functions by cumulative time\n")
+        pstats.Stats(record.cpu, stream=s).sort_stats('cumulative').print_stats(self.top_n)
+        s.write(f"top {self.top_n} allocation sites by memory held at the end of the stage\n")
+        allocations = sorted(record.allocations.items(), key=lambda a: a[1][0], reverse=True)[:self.top_n]
+        for traceback, (size, count) in allocations:
+            frame = traceback[0]
+            s.write(f"{size / 1024 ** 2:12.3f}MB {count:10d} blocks  {frame.filename}:{frame.lineno}\n")
+        return s.getvalue()
+
+    def write(self):
+        """
+        Writes a <stage>.prof cProfile file, readable by pstats or snakeviz, and a <stage>.txt summary of each stage
+        to the directory, with a summary.txt of all the stages.
+        """
+        if not self.records:
+            return
+        self.directory.mkdir(exist_ok=True, parents=True)
+        lines = [f"{'stage':<20} {'calls':>8} {'seconds':>12} {'peak MB':>12}"]
+        for name, record in self.records.items():
+            record.cpu.dump_stats(self.directory.joinpath(name + '.prof').as_posix())
+            self.directory.joinpath(name + '.txt').write_text(self.summary(record))
+            lines.append(f"{name:<20} {record.calls:>8d} {record.seconds:>12.3f} "
+                         f"{record.peak_bytes / 1024 ** 2:>12.1f}")
+        self.directory.joinpath('summary.txt').write_text('\n'.join(lines) + '\n')
+        log.info(f"Wrote the profiles of {len(self.records)} stages to {self.directory}")
+
+
+def enable_profiling(top_n: int = 30) -> StageProfiler:
+    global _profiler
+    _profiler = StageProfiler(top_n)
+    return _profiler
+
+
+def disable_profiling():
+    global _profiler
+    _profiler = None
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def is_enabled() -> bool:
+    return _profiler is not None
+
+
+def profile_to(output_dir: Union[str, Path]):
+    """
+    Sets the directory the profiles are written to, the profile directory of output_dir, when profiling is on.
+    """
+    if _profiler is not None:
+        _profiler.directory = Path(output_dir).joinpath('profile')
+
+
+def stage(name: str):
+    """
+    Context of a pipeline stage, profiled when profiling is on, otherwise a shared context that does nothing.
+    """
+    return _no_stage if _profiler is None else _profiler.stage(name)
+
+
+def profiled(name: str):
+    """
+    Decorator profiling each call of a function as stage name, a single attribute lookup when profiling is off.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return f(*args, **kwargs)
+            with _profiler.stage(name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,201 @@
+import json
+import queue
+import socketserver
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from aem import utils
+from aem.config import Config
+from aem.prediction import add_pred_to_data
+from aem.writers import prediction_cols
+from aem.logger import aemlogger as log
+
+Request = Tuple[pd.DataFrame, Future, float]
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    """http.server.ThreadingHTTPServer, which python 3.6 does not have"""
+    daemon_threads = True
+
+
+class ServiceStats:
+    """Request, row and batch counts of a PredictionService, and the latencies of its last window requests"""
+
+    def __init__(self, window: int = 10000):
+        self.started = time.perf_counter()
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.rows = 0
+        self.batches = 0
+        self.lock = threading.Lock()
+
+    def record_batch(self, latencies: List[float], rows: int):
+        with self.lock:
+            self.latencies.extend(latencies)
+            self.requests += len(latencies)
+            self.rows += rows
+            self.batches += 1
+
+    def summary(self) -> Dict:
+        with self.lock:
+            elapsed = time.perf_counter() - self.started
+            latencies = np.array(self.latencies) * 1000
+            return {
+                'requests': self.requests,
+                'rows': self.rows,
+                'batches': self.batches,
+                'requests_per_batch': self.requests / max(self.batches, 1),
+                'requests_per_second': self.requests / elapsed,
+                'rows_per_second': self.rows / elapsed,
+                'latency_ms': {f'p{q}': float(np.percentile(latencies, q)) for q in (50, 95, 99)}
+                if latencies.shape[0] else {},
+            }
+
+
+class PredictionService:
+    """Keeps a model resident and predicts feature batches, coalescing concurrent requests
+
+    Requests are queued and a single batching thread takes the first waiting request together with the requests
+    that arrive within max_wait seconds, up to max_batch_rows rows, and predicts them with one vectorised
+    predict_dist (or predict) call of the model. Each request gets back its own rows of the predictions.
+
+    Parameters
+    ----------
+    conf : Config
+        Config the model was trained with, selects the model columns and the prediction interval.
+    model :
+        Trained model, as returned by utils.import_model.
+    max_batch_rows : int
+        Rows above which no more requests are added to a batch.
+    max_wait : float
+        Seconds a batch waits for more requests after its first one.
+    """
+
+    def __init__(self, conf: Config, model, max_batch_rows: int = 100000, max_wait: float = 0.005):
+        self.conf = conf
+        self.model = model
+        self.model_cols = utils.select_cols_used_in_model(conf)
+        self.max_batch_rows = max_batch_rows
+        self.max_wait = max_wait
+        self.stats = ServiceStats()
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name='aem-prediction-batcher', daemon=True)
+        self.thread.start()
+
+    def predict(self, X: pd.DataFrame) -> pd.DataFrame:
+        """
+        The prediction, variance and quantile columns for the rows of X, which must have the model columns.
+        """
+        missing = [c for c in self.model_cols if c not in X.columns]
+        if missing:
+            raise KeyError(f"Features are missing the model columns {missing}")
+        future = Future()
+        self.requests.put((X[self.model_cols].reset_index(drop=True), future, time.perf_counter()))
+        return future.result()
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+
+    def _next_batch(self) -> Optional[List[Request]]:
+        first = self.requests.get()
+        if first is None:
+            return None
+        batch, rows = [first], first[0].shape[0]
+        deadline = time.perf_counter() + self.max_wait
+        while rows < self.max_batch_rows:
+            try:
+                request = self.requests.get(timeout=max(deadline - time.perf_counter(), 0))
+            except queue.Empty:
+                break
+            if request is None:  # close after this batch
+                self.requests.put(None)
+                break
+            batch.append(request)
+            rows += request[0].shape[0]
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                X = add_pred_to_data(pd.concat([X for X, _, _ in batch], ignore_index=True), self.conf, self.model)
+                pred = X[[c for c in prediction_cols if c in X.columns]]
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            start = 0
+            for X, future, _ in batch:
+                future.set_result(pred.iloc[start: start + X.shape[0]].reset_index(drop=True))
+                start += X.shape[0]
+            done = time.perf_counter()
+            self.stats.record_batch([done - t for _, _, t in batch], start)
+
+
+def make_server(service: PredictionService, host: str, port: int) -> ThreadingHTTPServer:
+    """
+    HTTP server of a PredictionService, one thread per connection.
+
+    POST /predict with a json body {"features": {column: [values]}} returns {column: [values]} of the predictions.
+    GET /stats returns the latency and throughput statistics of the service.
+    """
+
+    class PredictionHandler(BaseHTTPRequestHandler):
+
+        def do_POST(self):
+            if self.path != '/predict':
+                return self._send(404, {'error': f"Unknown path {self.path}"})
+            try:
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                X = pd.DataFrame(body['features'])
+                pred = service.predict(X)
+            except (KeyError, ValueError, TypeError) as e:
+                return self._send(400, {'error': str(e)})
+            except Exception as e:
+                log.exception("Prediction failed")
+                return self._send(500, {'error': str(e)})
+            self._send(200, pred.to_dict(orient='list'))
+
+        def do_GET(self):
+            if self.path != '/stats':
+                return self._send(404, {'error': f"Unknown path {self.path}"})
+            self._send(200, service.stats.summary())
+
+        def _send(self, status: int, payload: Dict):
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            log.debug(format % args)
+
+    return ThreadingHTTPServer((host, port), PredictionHandler)
+
+
+def serve_model(conf: Config, model, host: str, port: int, max_batch_rows: int, max_wait: float):
+    """
+    Serves predictions of model on host:port until interrupted, then logs the service statistics.
+    """
+    service = PredictionService(conf, model, max_batch_rows=max_batch_rows, max_wait=max_wait)
+    server = make_server(service, host, port)
+    log.info(f"Serving {conf.algorithm} model predictions on http://{host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.info("Stopping prediction service")
+    finally:
+        server.server_close()
+        service.close()
+        log.info(f"Prediction service statistics: {json.dumps(service.stats.summary())}")
@@ -0,0 +1,148 @@
+import os
+from pathlib import Path
+
+import joblib
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from sklearn.neighbors import KDTree
+from aem import utils
+from aem.config import Config, twod_coords
+from aem.cache import shapefile_fingerprint, hash_key
+from aem.logger import aemlogger as log
+
+# bump when the way the targets are built changes, so stale indices are not reused
+index_version = 1
+
+
+class TargetIndex:
+    """Spatial index over the interpretation/drillhole targets
+
+    Holds the targets with their coordinates, depth ('Z_coor'), weight and class columns as built by
+    utils.create_interp_data, and a KDTree over their coordinates. The index is persisted in the cache directory,
+    keyed on the target file fingerprints and the config fields used to build it, and memory mapped on load, so the
+    target shapefiles are only read when they or those fields change.
+
+    Parameters
+    ----------
+    targets : pd.DataFrame
+        The targets, in the order of the points of tree.
+    tree : KDTree
+        KDTree built on the targets twod_coords.
+    """
+
+    prefix = 'targets_'
+    suffix = '.joblib'
+
+    def __init__(self, targets: pd.DataFrame, tree: KDTree):
+        self.targets = targets
+        self.tree = tree
+
+    @classmethod
+    def build(cls, conf: Config) -> 'TargetIndex':
+        targets = load_interp_data(conf)
+        return cls(targets, KDTree(targets[twod_coords]))
+
+    @classmethod
+    def load(cls, conf: Config) -> 'TargetIndex':
+        """
+        Loads the persisted index of the targets of conf, building and persisting it first if needed.
+        """
+        if not conf.cache_data:
+            return cls.build(conf)
+        path = Path(conf.cache_dir).joinpath(cls.prefix + target_index_key(conf) + cls.suffix)
+        if path.exists():
+            os.utime(path)  # mark as recently used
+            state = joblib.load(path, mmap_mode='r')
+            log.info(f"Loaded target index from {path}")
+            return cls(state['targets'], state['tree'])
+        index = cls.build(conf)
+        index.save(path, conf.cache_max_entries)
+        return index
+
+    def save(self, path: Path, max_entries: int):
+        path.parent.mkdir(exist_ok=True, parents=True)
+        tmp = path.with_suffix('.tmp')
+        joblib.dump({'targets': self.targets, 'tree': self.tree}, tmp)  # uncompressed, so it can be memory mapped
+        os.replace(tmp, path)
+        log.info(f"Saved target index in {path}")
+        # keep the most recently used indices only
+        indices = sorted(path.parent.glob(self.prefix + '*' + self.suffix), key=lambda p: p.stat().st_mtime_ns,
+                         reverse=True)
+        for p in indices[max(max_entries, 1):]:
+            p.unlink()
+
+    def query_bbox(self, x_min: float, y_min: float, x_max: float, y_max: float) -> np.ndarray:
+        """
+        Positions of the targets inside the bounding box, only the tree nodes near the box are visited.
+        """
+        centre = np.array([[(x_min + x_max) / 2, (y_min + y_max) / 2]])
+        radius = np.hypot(x_max - x_min, y_max - y_min) / 2
+        ind = self.tree.query_radius(centre, r=radius)[0]
+        xy = np.asarray(self.targets[twod_coords].to_numpy()[ind])
+        inside = (xy[:, 0] >= x_min) & (xy[:, 0] <= x_max) & (xy[:, 1] >= y_min) & (xy[:, 1] <= y_max)
+        return np.sort(ind[inside])
+
+    def within(self, xy: np.ndarray, margin: float) -> np.ndarray:
+        """
+        Boolean mask of the targets within margin of the bounding box of xy, found with a radius query of the
+        persisted tree, so no tree is built for the subset.
+        """
+        mask = np.zeros(self.targets.shape[0], dtype=bool)
+        if not len(xy):
+            return mask
+        (x_min, y_min), (x_max, y_max) = xy.min(axis=0), xy.max(axis=0)
+        mask[self.query_bbox(x_min - margin, y_min - margin, x_max + margin, y_max + margin)] = True
+        return mask
+
+
+def target_index_key(conf: Config) -> str:
+    """
+    Content address of the target index. It covers the config fields that go into building the targets and the
+    fingerprints of the target files.
+    """
+    interp_files = conf.oos_interp_data if conf.oos_validation else conf.interp_data
+    fields = {
+        'version': index_version,
+        'interp_files': [shapefile_fingerprint(f) for f in interp_files],
+        'rows': conf.shapefile_rows,
+        'train_data_weights': conf.train_data_weights,
+        'weighted_model': conf.weighted_model,
+        'weights_map': conf.weights_map if conf.weighted_model else None,
+        'weight_col': conf.weight_col if conf.weighted_model else None,
+        'target_col': conf.target_col,
+        'target_type_col': conf.target_type_col,
+        'included_target_type_categories': conf.included_target_type_categories,
+        'target_class_indicator_col': conf.target_class_indicator_col,
+    }
+    return hash_key(fields)
+
+
+def load_interp_data(conf: Config) -> pd.DataFrame:
+    """
+    Reads the target shapefiles of conf, applies the target weights and selects the target columns.
+    :param conf: Config class instance
+    """
+    log.info("reading interp data...")
+    if conf.oos_validation:
+        all_interp_training_datasets = [gpd.GeoDataFrame.from_file(i, rows=conf.shapefile_rows) for i in
+                                        conf.oos_interp_data]
+    else:
+        all_interp_training_datasets = [gpd.GeoDataFrame.from_file(i, rows=conf.shapefile_rows) for i in
+                                        conf.interp_data]
+
+    train_weights = conf.train_data_weights
+
+    # apply the weights due to confidence levels assigned by the interpreter on the interpretation/target values
+    # plus the weights due to the datasets themselves
+    if conf.weighted_model:
+        for a, w in zip(all_interp_training_datasets, train_weights):
+            if conf.weight_col not in a.columns:
+                a[conf.weight_col] = 1  # this takes care of the drillhole files
+            if conf.weights_map:
+                a['weight'] = a[conf.weight_col].map(conf.weights_map) * w
+            else:
+                a['weight'] = a[conf.weight_col] * w
+
+    all_interp_training_data = pd.concat(all_interp_training_datasets, axis=0, ignore_index=True)
+    return pd.DataFrame(utils.create_interp_data(conf, all_interp_training_data)).reset_index(drop=True)
@@ -1,3 +1,4 @@
+import subprocess
 import joblib
 from pathlib import Path
 from typing import Tuple, Optional, List, Union
@@ -6,7 +7,11 @@ import numpy as np
 from scipy.signal import medfilt2d
 import pandas as pd
 from sklearn.neighbors import KDTree
-from aem.config import twod_coords, threed_coords, Config, additional_cols_for_tracking, cluster_line_segment_id
+from aem.config import twod_coords, threed_coords, Config, additional_cols_for_tracking, cluster_line_segment_id, \
+    cluster_line_no
+from aem.artefacts import dump_model_state, load_model_state
+from aem.compiled import compile_model, load_compiled_model
+from aem.profiling import profiled
 from aem.logger import aemlogger as log
 
 # distance within which an interpretation point is considered to contribute to target values
@@ -25,6 +30,7 @@ def determine_and_sort_by_dominant_line_direction(line_data, sort_by_col: Option
     return line_data
 
 
+@profiled('prepare')
 def prepare_aem_data(conf: Config, aem_data: pd.DataFrame):
     """
     :param conf:
@@ -36,13 +42,7 @@ def prepare_aem_data(conf: Config, aem_data: pd.DataFrame):
     """
     aem_data.reset_index(drop=True, inplace=True)
     if conf.smooth_twod_covariates:
-        for line in np.unique(aem_data.cluster_line_no):
-            line_indices = aem_data.cluster_line_no == line
-            row_loc = aem_data.index[line_indices]
-            aem_line_data = aem_data[line_indices]
-            aem_data.loc[row_loc, :] = determine_and_sort_by_dominant_line_direction(aem_line_data)
-            aem_line_cond_data = aem_data[line_indices][conf.conductivity_cols]
-            aem_data.loc[row_loc, conf.conductivity_cols] = apply_twod_median_filter(conf, aem_line_cond_data)
+        aem_data.loc[:, conf.conductivity_cols] = smooth_conductivities_along_lines(conf, aem_data)
 
     aem_data.loc[:, conf.thickness_cols] = aem_data[conf.thickness_cols].cumsum(axis=1)
     conductivity_copy = aem_data[conf.conductivity_cols].copy()
@@ -53,20 +53,47 @@ def prepare_aem_data(conf: Config, aem_data: pd.DataFrame):
     return aem_data
 
 
-def apply_twod_median_filter(conf: Config, aem_conductivities: pd.DataFrame):
+def smooth_conductivities_along_lines(conf: Config, aem_data: pd.DataFrame, n_jobs: int = -1) -> np.ndarray:
+    """
+    Median filters the conductivities of each cluster_line_no with scipy.signal.medfilt2d. Rows are stably sorted
+    by line once, so each line keeps its along line order, and the contiguous per line slices are filtered in
+    batches across n_jobs workers. The smoothed conductivities are returned in the row order of aem_data.
+    """
     kernel_size = conf.smooth_covariates_kernel_size
     log.info(f"smooth conductivity data using scipy.signal.medfilt2d using kernel size {kernel_size}")
-    aem_data = aem_conductivities.to_numpy()
-    aem_data = medfilt2d(aem_data, kernel_size=kernel_size)
-    df = pd.DataFrame(aem_data, columns=aem_conductivities.columns, index=aem_conductivities.index)
-    return df
+    lines = aem_data[cluster_line_no].to_numpy()
+    if not len(lines):
+        return aem_data[conf.conductivity_cols].to_numpy()
+    order = np.argsort(lines, kind='stable')
+    conductivities = aem_data[conf.conductivity_cols].to_numpy()[order]
+    bounds = np.flatnonzero(lines[order][1:] != lines[order][:-1]) + 1
+    starts, stops = np.r_[0, bounds], np.r_[bounds, len(lines)]
+    n_batches = min(joblib.effective_n_jobs(n_jobs), len(starts))
+    # each job filters a batch of consecutive lines holding roughly the same number of rows
+    batch_of_line = starts * n_batches // len(lines)
+    smoothed = joblib.Parallel(n_jobs=n_batches)(
+        joblib.delayed(_median_filter_slices)(
+            conductivities, list(zip(starts[batch_of_line == b], stops[batch_of_line == b])), kernel_size
+        )
+        for b in np.unique(batch_of_line)
+    )
+    smoothed = np.concatenate(smoothed)
+    result = np.empty_like(smoothed)
+    result[order] = smoothed
+    return result
+
+
+def _median_filter_slices(conductivities: np.ndarray, slices: List[Tuple[int, int]], kernel_size) -> np.ndarray:
+    return np.concatenate([medfilt2d(conductivities[start: stop], kernel_size=kernel_size)
+                           for start, stop in slices])
 
 
 def select_required_data_cols(conf: Config):
     cols = select_cols_used_in_model(conf)[:]
     if not conf.predict:
         cols.append(conf.group_col)
-    return cols + twod_coords + additional_cols_for_tracking
+    # group_col is usually one of the tracking cols, keep each column only once
+    return list(dict.fromkeys(cols + twod_coords + additional_cols_for_tracking))
 
 
 def select_cols_used_in_model(conf: Config):
@@ -86,68 +113,77 @@ def extent_of_data(data: pd.DataFrame) -> Tuple[float, float, float, float]:
     return x_max, x_min, y_max, y_min
 
 
-def weighted_target(interp_data: pd.DataFrame, tree: KDTree, covariates_including_xy: pd.Series, weighted_model,
-                    conf: Config):
-    x = covariates_including_xy[twod_coords].values.reshape(1, -1)
-    ind, dist = tree.query_radius(x, r=conf.cutoff_radius, return_distance=True)
-    ind, dist = ind[0], dist[0]
-    if len(dist):
-        dist += 1e-6  # add just in case of we have a zero distance
-        df = interp_data.iloc[ind]
-        class_association_num = covariates_including_xy[conf.target_class_indicator_col] if \
-            conf.target_class_indicator_col is not None else None
-        if class_association_num is not None:
-            boolean_multiplier_based_on_class_association = \
-                df[conf.target_class_indicator_col].values == class_association_num
-            # if there are no observations with the cutoff_radius in the same/class_association we dont want the
-            # weighted_depth and weighted_weight to be zero
-            log.debug(f"boolean nultiplier {boolean_multiplier_based_on_class_association}")
-            if np.any(boolean_multiplier_based_on_class_association) == 0:
-                log.debug("All targets with cutoff radius are in the different ero_dep region!")
-                return None, None
-            else:
-                log.debug("Some targets with cutoff radius are in the same ero_dep region!")
-        else:
-            boolean_multiplier_based_on_class_association = np.ones_like(dist, dtype=np.bool)
-        depths = df.Z_coor.values[boolean_multiplier_based_on_class_association]
-        dist = dist[boolean_multiplier_based_on_class_association]
-        weighted_depth = np.sum(depths * (1 / dist) ** 2) / np.sum((1 / dist) ** 2)
-        weights = df.weight.values[boolean_multiplier_based_on_class_association]
-        if weighted_model:
-            weighted_weight = np.sum(weights * (1 / dist) ** 2) / np.sum((1 / dist) ** 2)
-        else:
-            weighted_weight = None
+def weighted_targets(interp_data: pd.DataFrame, tree: KDTree, aem_data: pd.DataFrame, conf: Config,
+                     batch_size: int = 100000, tree_positions: Optional[np.ndarray] = None):
+    """
+    Inverse distance squared weighted targets (and target weights) for every aem sounding, computed in batches
+    with a single multi-point radius query per batch.
+
+    :param interp_data: interpretation data with POINT_X, POINT_Y, Z_coor and optionally weight and class columns
+    :param tree: KDTree built on the interp_data twod_coords
+    :param aem_data: aem data with twod_coords and optionally the target_class_indicator_col
+    :param conf: Config instance
+    :param batch_size: number of aem soundings queried at a time, bounds the memory used by the neighbour arrays
+    :param tree_positions: sorted positions in tree of the rows of interp_data, when interp_data is the subset of the
+        targets of tree that holds every target within cutoff_radius of the aem soundings
+    :return: selected (boolean mask of soundings with a target), weighted depths and weighted weights
+    """
+    weighted_model = conf.weighted_model
+    class_col = conf.target_class_indicator_col
+    n = aem_data.shape[0]
+    xy = aem_data[twod_coords].to_numpy(dtype=np.float64)
+    interp_depths = interp_data['Z_coor'].to_numpy(dtype=np.float64)
+    interp_weights = interp_data['weight'].to_numpy(dtype=np.float64) if weighted_model else None
+    interp_classes = interp_data[class_col].to_numpy() if class_col is not None else None
+    aem_classes = aem_data[class_col].to_numpy() if class_col is not None else None
+
+    selected = np.zeros(n, dtype=bool)
+    depths = np.full(n, np.nan)
+    weights = np.ones(n)
+
+    for start in range(0, n, batch_size):
+        stop = min(start + batch_size, n)
+        ind, dist = tree.query_radius(xy[start:stop], r=conf.cutoff_radius, return_distance=True)
+        counts = np.fromiter((len(i) for i in ind), dtype=np.int64, count=stop - start)
+        if not counts.sum():
+            continue
+        rows = np.repeat(np.arange(stop - start), counts)
+        ind = np.concatenate(ind).astype(np.int64)
+        if tree_positions is not None:
+            ind = np.searchsorted(tree_positions, ind)
+        dist = np.concatenate(dist) + 1e-6  # add just in case of we have a zero distance
+        if class_col is not None:
+            # only targets in the same class as the sounding contribute, soundings with no such target are dropped
+            same_class = interp_classes[ind] == aem_classes[start:stop][rows]
+            rows, ind, dist = rows[same_class], ind[same_class], dist[same_class]
+        inv_dist_sq = (1 / dist) ** 2
+        sum_inv_dist_sq = np.bincount(rows, weights=inv_dist_sq, minlength=stop - start)
+        has_target = np.bincount(rows, minlength=stop - start) > 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            batch_depths = np.bincount(rows, weights=interp_depths[ind] * inv_dist_sq,
+                                       minlength=stop - start) / sum_inv_dist_sq
+            if weighted_model:
+                batch_weights = np.bincount(rows, weights=interp_weights[ind] * inv_dist_sq,
+                                            minlength=stop - start) / sum_inv_dist_sq
+                weights[start:stop] = batch_weights
+        selected[start:stop] = has_target
+        depths[start:stop] = batch_depths
 
-        return weighted_depth, weighted_weight
-    else:
-        return None, None
+    return selected, depths[selected], weights[selected]
 
 
-def convert_to_xy(conf: Config, aem_data, interp_data):
+@profiled('convert_to_xy')
+def convert_to_xy(conf: Config, aem_data, interp_data, tree: Optional[KDTree] = None,
+                  tree_positions: Optional[np.ndarray] = None):
     log.info("convert to xy and target values...")
-    weighted_model = conf.weighted_model
-
-    selected = []
-    tree = KDTree(interp_data[twod_coords])
-    target_depths = []
-    target_weights = []
-    for xy in aem_data.iterrows():
-        i, covariates_including_xy_ = xy
-
-        y, w = weighted_target(interp_data, tree, covariates_including_xy_, weighted_model, conf)
-        if y is not None:
-            if weighted_model:
-                if w is not None:
-                    selected.append(covariates_including_xy_)  # in 2d conductivities are already in xy
-                    target_depths.append(y)
-                    target_weights.append(w)
-            else:
-                selected.append(covariates_including_xy_)  # in 2d conductivities are already in xy
-                target_depths.append(y)
-                target_weights.append(1.0)
-    X = pd.DataFrame(selected)
+    if tree is None:
+        tree = KDTree(interp_data[twod_coords])
+    selected, target_depths, target_weights = weighted_targets(interp_data, tree, aem_data, conf,
+                                                               tree_positions=tree_positions)
+    X = aem_data[selected]
     y = pd.Series(target_depths, name='target', index=X.index)
     w = pd.Series(target_weights, name='weight', index=X.index)
+    log.info(f"Found targets for {X.shape[0]} of {aem_data.shape[0]} aem soundings")
 
     return {'covariates': X, 'targets': y, 'weights': w}
 
@@ -180,33 +216,41 @@ def __add_x_y(line: pd.DataFrame):
     return line
 
 
-def add_delta(line: pd.DataFrame, conf: Config, origin=None):
+def add_line_distance_and_segments(aem_data: pd.DataFrame, conf: Config) -> pd.DataFrame:
     """
-    :param line:
-    :param origin: origin of flight line, if not provided assumed ot be the at the lowest y value
-    :return:
+    Sorts the aem data by cluster_line_no and POINT_X within each line, and adds the distance along the line 'd',
+    measured from the first sounding of the line, and the cluster_line_segment_id of every sounding. Each line is
+    split into max(rows // aem_line_splits, 1) segments of consecutive soundings of near equal size, numbered like
+    numpy.array_split, with ids of the form '<cluster_line_no>_<segment>'.
+
+    :param aem_data: aem data with POINT_X, POINT_Y and cluster_line_no
+    :param conf: Config instance
+    :return: sorted aem_data with d and cluster_line_segment_id added
     """
-    line = determine_and_sort_by_dominant_line_direction(line)
-    line_cols = list(line.columns)
-    line['POINT_X_diff'] = line['POINT_X'].diff()
-    line['POINT_Y_diff'] = line['POINT_Y'].diff()
-    line['delta'] = np.sqrt(line.POINT_X_diff ** 2 + line.POINT_Y_diff ** 2)
-    line['delta'] = line['delta'].fillna(value=0.0)
-    if origin is not None:
-        line['delta'].iat[0] = np.sqrt(
-            (line.POINT_X.iat[0] - origin[0]) ** 2 +
-            (line.POINT_Y.iat[0] - origin[1]) ** 2
-        )
-    line['d'] = line['delta'].cumsum()
-    line = line.sort_values(by=['d'], ascending=True)  # must sort by distance from origin of flight line
-    cluster_id = str(np.unique(line.cluster_line_no)[0]) + '_'
-    arrs = np.array_split(range(line.shape[0]), max(line.shape[0] // conf.aem_line_splits, 1))
-    for i, a in enumerate(arrs):
-        arrs[i] = np.ones_like(a) * i
-    arr = np.concatenate(arrs).ravel().astype(str)
-    line[cluster_line_segment_id] = pd.Series([cluster_id + b for b in arr], index=line.index)
-
-    return line[line_cols + ['d', cluster_line_segment_id]]
+    lines = aem_data[cluster_line_no].to_numpy()
+    x, y = aem_data['POINT_X'].to_numpy(), aem_data['POINT_Y'].to_numpy()
+    order = np.lexsort((x, lines))
+    aem_data = aem_data.iloc[order]
+    lines, x, y = lines[order], x[order], y[order]
+
+    n = lines.shape[0]
+    line_start = np.r_[True, lines[1:] != lines[:-1]] if n else np.zeros(0, dtype=bool)
+    delta = np.sqrt(np.diff(x, prepend=x[:1]) ** 2 + np.diff(y, prepend=y[:1]) ** 2)
+    delta[line_start] = 0.0
+    line_id = np.cumsum(line_start) - 1
+    d = pd.Series(delta).groupby(line_id).cumsum().to_numpy()
+
+    # position of each sounding in its line, and the numpy.array_split segment it falls in
+    starts = np.flatnonzero(line_start)
+    rows = np.diff(np.r_[starts, n])[line_id]
+    position = np.arange(n) - starts[line_id]
+    splits = np.maximum(rows // conf.aem_line_splits, 1)
+    size, larger = rows // splits, rows % splits
+    segment = np.where(position < larger * (size + 1), position // (size + 1),
+                       larger + (position - larger * (size + 1)) // np.maximum(size, 1))
+
+    segment_id = pd.Series(lines).astype(str) + '_' + pd.Series(segment).astype(str)
+    return aem_data.assign(d=d, **{cluster_line_segment_id: segment_id.to_numpy()})
 
 
 def plot_2d_section_paper(
@@ -453,10 +497,20 @@ def export_model(model, conf: Config, model_type: str = 'learn'):
         raise AttributeError("Model type must be one of 'learn' or 'optimise'")
     learned_model = model_type == 'learn'  # as opposed to optimised_model
     model_file = conf.model_file if learned_model else conf.optimised_model_file
-    state_dict = {"model": model, "config": conf}
-    with open(model_file, 'wb') as f:
-        joblib.dump(state_dict, f)
-        log.info(f"Wrote model on disc {model_file}")
+    state_dict = {"model": model, "config": conf, "schema": conf.schema}
+    dump_model_state(state_dict, model_file)
+    library = compiled_model_file(model_file)
+    if library.exists():  # compiled from a previous model
+        library.unlink()
+    if conf.compile_model:
+        try:
+            compile_model(model, len(select_cols_used_in_model(conf)), library)
+        except (TypeError, ValueError, OSError, subprocess.CalledProcessError) as e:
+            log.warning(f"Could not compile the model, predictions will use the python model: {e}")
+
+
+def compiled_model_file(model_file: Path) -> Path:
+    return model_file.with_suffix('.so')
 
 
 def import_model(conf: Config, model_type: str = 'learn'):
@@ -464,11 +518,21 @@ def import_model(conf: Config, model_type: str = 'learn'):
     model_file = conf.model_file if learned_model else conf.optimised_model_file
     if not model_file.exists():
         raise FileExistsError(f"Model file {model_file.as_posix()} does not exist. Train or optimise model first!!")
-    with open(model_file, 'rb') as f:
-        state_dict = joblib.load(f)
-        log.info(f"loaded trained model from location {conf.model_file}")
-    model, conf = state_dict["model"], state_dict['config']
-    return model, conf
+    state_dict = load_model_state(model_file)
+    log.info(f"loaded trained model from location {conf.model_file}")
+    model, model_conf = state_dict["model"], state_dict['config']
+    # use the columns the model was trained with, so the training data need not be available
+    if 'schema' in state_dict:
+        conf.schema = state_dict['schema']
+    else:  # model files written before the schema was stored hold the columns as attributes of their config
+        conf.schema = {'conductivity_cols': model_conf.__dict__['conductivity_cols'],
+                       'thickness_cols': model_conf.__dict__['thickness_cols']}
+    model_conf.schema = conf.schema
+    library = compiled_model_file(model_file)
+    if library.exists() and library.stat().st_mtime_ns >= model_file.stat().st_mtime_ns:
+        model = load_compiled_model(model, library)
+        log.info(f"Predicting with the compiled model {library}")
+    return model, model_conf
 
 
 def plot_cond_mesh(X, conf):
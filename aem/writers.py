@@ -0,0 +1,255 @@
+import abc
+from pathlib import Path
+from typing import List, Optional, Union
+
+import pandas as pd
+import geopandas as gpd
+from geopandas.io.file import infer_schema
+import pyarrow as pa
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+from aem.config import Config, twod_coords, additional_cols_for_tracking
+from aem.profiling import profiled
+from aem.logger import aemlogger as log
+
+prediction_cols = ['pred', 'variance', 'lower_quantile', 'upper_quantile']
+# columns added to the aem covariates by learn, optimise, validate and predict
+result_cols = ['cv_pred'] + prediction_cols + ['oos_' + c for c in prediction_cols] + ['target', 'weights']
+
+
+def project_output_columns(X: pd.DataFrame, conf: Config) -> pd.DataFrame:
+    """
+    Selects the columns of X written to the outputs as configured by output: columns. 'all' keeps every column,
+    'predictions' keeps the coordinates, tracking columns and results, a list keeps the listed columns in addition to
+    those of 'predictions'.
+    """
+    if conf.output_columns == 'all':
+        return X
+    cols = twod_coords + additional_cols_for_tracking + result_cols
+    if isinstance(conf.output_columns, list):
+        cols = conf.output_columns + cols
+    return X[[c for c in dict.fromkeys(cols) if c in X.columns]]
+
+
+def cast_to_schema(table: pa.Table, schema: pa.Schema) -> pa.Table:
+    """
+    Casts a chunk to the schema of its file. Column types inferred from a chunk can differ from those of the other
+    chunks, e.g. a string column is null in the chunks where it only has missing values.
+    """
+    if table.schema.equals(schema, check_metadata=False):
+        return table
+    return table.cast(schema)
+
+
+def promote_null_fields(schema: pa.Schema, other: pa.Schema) -> pa.Schema:
+    """
+    schema with the type of the fields that are null in it, i.e. only had missing values, taken from other.
+    """
+    other_types = {f.name: f.type for f in other}
+    fields = [f.with_type(other_types[f.name]) if pa.types.is_null(f.type) and f.name in other_types else f
+              for f in schema]
+    return pa.schema(fields, metadata=schema.metadata)
+
+
+class OutputWriter(abc.ABC):
+    """Writes a dataframe to a file a chunk of rows at a time
+
+    Used as a context manager, each call of write appends a chunk to the file that is finalised on exit.
+
+    Parameters
+    ----------
+    path : Path
+        The output file.
+    compression : str, optional
+        Compression codec, None for the format default.
+    crs : optional
+        Coordinate reference system of the POINT_X/POINT_Y columns, only used by formats with a geometry.
+    schema : pa.Schema, optional
+        Arrow schema of the whole output, the chunks are cast to it. Only used by the arrow formats, which otherwise
+        take the schema of the first chunk.
+    """
+
+    default_compression = None
+    arrow = False
+
+    def __init__(self, path: Union[str, Path], compression: Optional[str] = None, crs=None,
+                 schema: Optional[pa.Schema] = None):
+        self.path = Path(path)
+        self.compression = compression if compression is not None else self.default_compression
+        self.crs = crs
+        self.schema = schema
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @abc.abstractmethod
+    def write(self, df: pd.DataFrame):
+        """
+        Appends the rows of df to the file.
+        """
+
+    def close(self):
+        pass
+
+    @classmethod
+    @abc.abstractmethod
+    def read(cls, path: Union[str, Path], compression: Optional[str] = None) -> pd.DataFrame:
+        """
+        Reads a file written by the writer with compression.
+        """
+
+    @classmethod
+    def read_schema(cls, path: Union[str, Path]) -> pa.Schema:
+        """
+        Arrow schema of a file written by the writer, only the arrow formats have one.
+        """
+        raise NotImplementedError
+
+
+class CsvWriter(OutputWriter):
+
+    def __init__(self, path: Union[str, Path], compression: Optional[str] = None, crs=None,
+                 schema: Optional[pa.Schema] = None):
+        super().__init__(path, compression, crs, schema)
+        self.header = True
+
+    def write(self, df: pd.DataFrame):
+        df.to_csv(self.path, mode='w' if self.header else 'a', header=self.header, index=False,
+                  compression=self.compression)
+        self.header = False
+
+    @classmethod
+    def read(cls, path: Union[str, Path], compression: Optional[str] = None) -> pd.DataFrame:
+        # the codec can not be inferred from the names of the tile parts
+        return pd.read_csv(path, compression=compression if compression is not None else 'infer')
+
+
+class ParquetWriter(OutputWriter):
+    default_compression = 'zstd'
+    arrow = True
+
+    def __init__(self, path: Union[str, Path], compression: Optional[str] = None, crs=None,
+                 schema: Optional[pa.Schema] = None):
+        super().__init__(path, compression, crs, schema)
+        self.writer = None
+
+    def write(self, df: pd.DataFrame):
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self.writer is None:
+            if self.schema is None:
+                self.schema = table.schema
+            self.writer = pq.ParquetWriter(self.path.as_posix(), self.schema, compression=self.compression)
+        self.writer.write_table(cast_to_schema(table, self.schema))  # each chunk is a row group
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+    @classmethod
+    def read(cls, path: Union[str, Path], compression: Optional[str] = None) -> pd.DataFrame:
+        return pd.read_parquet(path)
+
+    @classmethod
+    def read_schema(cls, path: Union[str, Path]) -> pa.Schema:
+        return pq.read_schema(Path(path).as_posix())
+
+
+class FeatherWriter(OutputWriter):
+    default_compression = 'zstd'
+    arrow = True
+
+    def __init__(self, path: Union[str, Path], compression: Optional[str] = None, crs=None,
+                 schema: Optional[pa.Schema] = None):
+        super().__init__(path, compression, crs, schema)
+        self.writer = None
+
+    def write(self, df: pd.DataFrame):
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self.writer is None:
+            if self.schema is None:
+                self.schema = table.schema
+            options = ipc.IpcWriteOptions(compression=self.compression)
+            self.writer = ipc.new_file(self.path.as_posix(), self.schema, options=options)
+        self.writer.write_table(cast_to_schema(table, self.schema))  # each chunk is a record batch
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+    @classmethod
+    def read(cls, path: Union[str, Path], compression: Optional[str] = None) -> pd.DataFrame:
+        return pd.read_feather(path)
+
+    @classmethod
+    def read_schema(cls, path: Union[str, Path]) -> pa.Schema:
+        with pa.memory_map(Path(path).as_posix()) as source:
+            return ipc.open_file(source).schema
+
+
+class GeoPackageWriter(OutputWriter):
+
+    def __init__(self, path: Union[str, Path], compression: Optional[str] = None, crs=None,
+                 schema: Optional[pa.Schema] = None):
+        super().__init__(path, compression, crs)
+        self.schema = None  # the fiona schema
+
+    def write(self, df: pd.DataFrame):
+        geometry = gpd.points_from_xy(df[twod_coords[0]], df[twod_coords[1]], crs=self.crs)
+        gdf = gpd.GeoDataFrame(df, geometry=geometry)
+        if self.schema is None:
+            # fiona appends to the layer with the schema it was created with, keep that of the first chunk
+            self.schema = infer_schema(gdf)
+            gdf.to_file(self.path, driver='GPKG', schema=self.schema, mode='w')
+        else:
+            gdf.to_file(self.path, driver='GPKG', schema=self.schema, mode='a')
+
+    @classmethod
+    def read(cls, path: Union[str, Path], compression: Optional[str] = None) -> pd.DataFrame:
+        return pd.DataFrame(gpd.read_file(path).drop(columns='geometry'))
+
+
+writers = {
+    'csv': CsvWriter,
+    'parquet': ParquetWriter,
+    'feather': FeatherWriter,
+    'gpkg': GeoPackageWriter,
+}
+
+
+def output_writer(conf: Config, path: Union[str, Path], crs=None, schema: Optional[pa.Schema] = None) -> OutputWriter:
+    return writers[conf.output_format](path, compression=conf.output_compression, crs=crs, schema=schema)
+
+
+@profiled('write')
+def write_output(X: pd.DataFrame, conf: Config, path: Union[str, Path], crs=None):
+    """
+    Writes the configured projection of X to path in the configured output format, conf.output_chunk_rows rows
+    at a time.
+    """
+    X = project_output_columns(X, conf)
+    # the types of the whole output, a column with only missing values in the first chunk would be null otherwise
+    schema = pa.Schema.from_pandas(X, preserve_index=False) if writers[conf.output_format].arrow else None
+    with output_writer(conf, path, crs, schema) as writer:
+        for start in range(0, max(X.shape[0], 1), conf.output_chunk_rows):
+            writer.write(X.iloc[start: start + conf.output_chunk_rows])
+    log.info(f"Wrote {X.shape[0]} rows and {X.shape[1]} columns to {path}")
+
+
+@profiled('write')
+def concat_outputs(conf: Config, parts: List[Path], path: Union[str, Path], crs=None):
+    """
+    Concatenates output files written by write_output into a single output, one part in memory at a time.
+    """
+    reader = writers[conf.output_format]
+    schema = None
+    if reader.arrow:
+        # the types of the parts, a column with only missing values in the first part would be null otherwise
+        for p in parts:
+            part_schema = reader.read_schema(p)
+            schema = part_schema if schema is None else promote_null_fields(schema, part_schema)
+    with output_writer(conf, path, crs, schema) as writer:
+        for p in parts:
+            writer.write(reader.read(p, compression=conf.output_compression))
@@ -0,0 +1,162 @@
+"""Times and measures the peak memory of the aem pipeline stages on synthetic surveys of several sizes.
+
+    python -m benchmarks.run --scales small medium --output results.json --baseline benchmarks/baseline.json
+
+Each stage is timed without tracing, the best of --repeat runs, then run once more under tracemalloc for its peak
+memory, which covers the allocations of this process, numpy arrays included, but not those of joblib worker
+processes. The results are written as json and, given a baseline written by --save-baseline, compared with it: a
+stage regresses when it is more than --tolerance slower or uses that much more memory, and the exit status is
+then 1. A --baseline that does not exist is an error, exit status 2, so that a comparison is never skipped silently.
+Baselines depend on the machine, write one on the machine the comparisons run on:
+
+    python -m benchmarks.run --scales small medium --baseline benchmarks/baseline.json --save-baseline
+"""
+import argparse
+import json
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable, Dict, List
+
+import numpy as np
+from aem import __version__, utils
+from aem.data import split_flight_lines_into_multiple_segments
+from aem.models import modelmaps
+from aem.prediction import add_pred_to_data
+from benchmarks.synthetic import synthetic_survey, synthetic_config
+
+# n_lines, soundings_per_line, n_layers and interp_density of each scale
+scales = {
+    'small': (10, 500, 30, 0.02),
+    'medium': (40, 2500, 30, 0.02),
+    'large': (100, 10000, 50, 0.01),
+}
+
+benchmark_model_params = {
+    'xgboost': {'n_estimators': 50, 'max_depth': 6, 'n_jobs': -1},
+    'gradientboost': {'n_estimators': 50, 'max_depth': 3},
+    'quantilegb': {'n_estimators': 50, 'max_depth': 3, 'upper_alpha': 0.95, 'lower_alpha': 0.05},
+    'randomforest': {'n_estimators': 50, 'max_depth': 15, 'min_samples_leaf': 2, 'n_jobs': -1},
+    'quantileforest': {'n_estimators': 50, 'max_depth': 15, 'min_samples_leaf': 2, 'n_jobs': -1},
+    'quantilexgb': {
+        'mean_model_params': {'n_estimators': 50, 'max_depth': 6},
+        'upper_quantile_params': {'alpha': 0.95, 'delta': 1.0, 'thresh': 1.0, 'variance': 1.0, 'n_estimators': 50,
+                                  'max_depth': 6},
+        'lower_quantile_params': {'alpha': 0.05, 'delta': 1.0, 'thresh': 1.0, 'variance': 1.0, 'n_estimators': 50,
+                                  'max_depth': 6},
+    },
+    'catboost': {'iterations': 50, 'depth': 6, 'verbose': False},
+}
+
+
+def measure(stage: Callable[[], object], repeat: int) -> Dict:
+    """
+    Best time of repeat runs of stage, and the peak traced memory of one more run.
+    """
+    seconds = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        stage()
+        seconds.append(time.perf_counter() - t0)
+    tracemalloc.start()
+    try:
+        stage()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'seconds': min(seconds), 'peak_mb': peak / 1024 ** 2}
+
+
+def run_scale(scale: str, algorithms: List[str], repeat: int) -> List[Dict]:
+    n_lines, soundings_per_line, n_layers, interp_density = scales[scale]
+    aem_data, interp_data = synthetic_survey(n_lines, soundings_per_line, n_layers, interp_density)
+    results = []
+
+    def record(stage: str, fn: Callable[[], object], rows: int):
+        result = {'scale': scale, 'stage': stage, 'rows': rows, **measure(fn, repeat)}
+        print(f"{scale:>8} {stage:<32} {result['seconds']:10.3f}s {result['peak_mb']:10.1f}MB", flush=True)
+        results.append(result)
+
+    with tempfile.TemporaryDirectory() as d:
+        for segmentation in ['attributes', 'grid']:
+            conf = synthetic_config(Path(d), aem_data, segmentation=segmentation)
+            record(f'split_flight_lines.{segmentation}',
+                   lambda: split_flight_lines_into_multiple_segments(aem_data.copy(), True, conf), aem_data.shape[0])
+        segmented = split_flight_lines_into_multiple_segments(aem_data.copy(), True, conf)
+        record('prepare_aem_data', lambda: utils.prepare_aem_data(conf, segmented.copy()), segmented.shape[0])
+        prepared = utils.prepare_aem_data(conf, segmented.copy())[utils.select_required_data_cols(conf)]
+        record('convert_to_xy', lambda: utils.convert_to_xy(conf, prepared, interp_data), prepared.shape[0])
+        data = utils.convert_to_xy(conf, prepared, interp_data)
+        X, y, w = data['covariates'], data['targets'], data['weights']
+        model_cols = utils.select_cols_used_in_model(conf)
+
+        for algorithm in algorithms:
+            model = modelmaps[algorithm](**benchmark_model_params[algorithm])
+            record(f'{algorithm}.fit', lambda: model.fit(X[model_cols], y, sample_weight=w), X.shape[0])
+            predict = model.predict_dist if hasattr(model, 'predict_dist') else model.predict
+            record(f'{algorithm}.predict', lambda: predict(prepared[model_cols]), prepared.shape[0])
+            if algorithm == algorithms[0]:
+                record('add_pred_to_data', lambda: add_pred_to_data(prepared, conf, model), prepared.shape[0])
+    return results
+
+
+def compare(results: List[Dict], baseline: List[Dict], tolerance: float) -> List[str]:
+    """
+    The stages of results more than tolerance slower, or using that much more memory, than in baseline.
+    """
+    base = {(r['scale'], r['stage']): r for r in baseline}
+    regressions = []
+    for r in results:
+        b = base.get((r['scale'], r['stage']))
+        if b is None:
+            continue
+        for key in ['seconds', 'peak_mb']:
+            if r[key] > b[key] * (1 + tolerance):
+                regressions.append(f"{r['scale']} {r['stage']} {key}: {r[key]:.3f} against a baseline of "
+                                   f"{b[key]:.3f}")
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', nargs='+', choices=list(scales), default=['small'])
+    parser.add_argument('--algorithms', nargs='+', choices=list(benchmark_model_params),
+                        default=list(benchmark_model_params))
+    parser.add_argument('--repeat', type=int, default=3, help="timed runs of each stage, the best is reported")
+    parser.add_argument('--output', type=Path, default=Path('benchmark_results.json'))
+    parser.add_argument('--baseline', type=Path, default=None, help="results to compare with")
+    parser.add_argument('--save-baseline', action='store_true', help="write the results to --baseline")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="fraction a stage may be slower or use more memory than the baseline")
+    args = parser.parse_args(argv)
+
+    np.random.seed(0)
+    results = [r for scale in args.scales for r in run_scale(scale, args.algorithms, args.repeat)]
+    report = {
+        'meta': {'aem': __version__, 'python': platform.python_version(), 'platform': platform.platform(),
+                 'processor': platform.processor(), 'repeat': args.repeat},
+        'results': results,
+    }
+    args.output.write_text(json.dumps(report, indent=4))
+    print(f"Wrote {len(results)} results to {args.output}")
+
+    if args.baseline is None:
+        return 0
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(report, indent=4))
+        print(f"Saved baseline {args.baseline}")
+        return 0
+    if not args.baseline.exists():
+        print(f"No baseline at {args.baseline}, write one with --save-baseline", file=sys.stderr)
+        return 2
+    regressions = compare(results, json.loads(args.baseline.read_text())['results'], args.tolerance)
+    for r in regressions:
+        print(f"REGRESSION {r}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
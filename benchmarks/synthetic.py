@@ -0,0 +1,118 @@
+from pathlib import Path
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+import yaml
+from aem.config import Config
+
+covariate_cols = ['elevation', 'tx_height']
+# distance between flight lines and between soundings along a line, meters
+line_spacing = 1000.0
+sounding_spacing = 25.0
+
+
+def synthetic_survey(n_lines: int, soundings_per_line: int, n_layers: int, interp_density: float,
+                     seed: int = 0) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    A synthetic aem survey of n_lines parallel east-west flight lines of soundings_per_line soundings each, with
+    n_layers conductivity and thickness columns, and the interpretation targets of interp_density of the soundings.
+
+    The conductivities are smooth along the lines with a conductive layer at a depth that varies smoothly across the
+    survey, the targets are that depth at jittered sounding locations.
+
+    :return: the aem data, with the columns of an aem shapefile, and the targets, with the columns of
+        utils.create_interp_data
+    """
+    rng = np.random.RandomState(seed)
+    n = n_lines * soundings_per_line
+    line = np.repeat(np.arange(n_lines), soundings_per_line)
+    along = np.tile(np.arange(soundings_per_line), n_lines)
+    x = along * sounding_spacing + rng.normal(0, 2, n)
+    y = line * line_spacing + rng.normal(0, 5, n)
+    depth = 50 + 30 * np.sin(x / 5000) * np.cos(y / 7000)
+
+    thickness = np.geomspace(2, 40, n_layers)
+    layer_top = np.r_[0, np.cumsum(thickness)[:-1]]
+    conductive = np.abs(layer_top[np.newaxis, :] - depth[:, np.newaxis]) < thickness[np.newaxis, :] * 2
+    conductivity = np.exp(rng.normal(-4, 0.2, (n, n_layers)) + 2 * conductive)
+
+    aem_data = pd.DataFrame({
+        'POINT_X': x,
+        'POINT_Y': y,
+        'fiducial': np.arange(n),
+        'uniqueid': np.arange(n),
+        'flight': line // 10,
+        'line': line,
+        'elevation': 200 + y / 1000 + rng.normal(0, 1, n),
+        'tx_height': rng.normal(35, 3, n),
+    })
+    width = len(str(n_layers))
+    aem_data = pd.concat([
+        aem_data,
+        pd.DataFrame(conductivity, columns=[f'cond_{i:0{width}d}' for i in range(n_layers)]),
+        pd.DataFrame(np.tile(thickness, (n, 1)), columns=[f'thick_{i:0{width}d}' for i in range(n_layers)]),
+    ], axis=1)
+
+    targets = rng.choice(n, size=max(int(n * interp_density), 1), replace=False)
+    interp_data = pd.DataFrame({
+        'POINT_X': x[targets] + rng.normal(0, 10, targets.shape[0]),
+        'POINT_Y': y[targets] + rng.normal(0, 10, targets.shape[0]),
+        'Z_coor': depth[targets] + rng.normal(0, 2, targets.shape[0]),
+        'weight': rng.choice([0.5, 1.0, 2.0], size=targets.shape[0]),
+    })
+    return aem_data, interp_data
+
+
+def synthetic_config(directory: Path, aem_data: pd.DataFrame, algorithm: str = 'randomforest',
+                     segmentation: str = 'auto') -> Config:
+    """
+    Config for the synthetic survey aem_data with its outputs in directory. The data files it names do not exist,
+    the schema is set from the columns of aem_data.
+    """
+    settings = {
+        'data': {
+            'aem_folder': directory.as_posix(),
+            'train_data': {'aem_train_data': ['synthetic.shp'], 'targets': ['synthetic_targets.shp'], 'weights': [1]},
+            'apply_model': ['synthetic.shp'],
+            'oos_validation': {'aem_validation_data': ['synthetic.shp'], 'targets': ['synthetic_targets.shp']},
+            'rows': -1,
+            'aem_line_scan_radius': 100,
+            'aem_line_segmentation': segmentation,
+            'aem_line_splits': 1000,
+            'cutoff_radius': 500,
+            'cache': {'enabled': False},
+            'weight_col': 'weight',
+            'target_col': 'Z_coor',
+            'target_type_col': None,
+            'included_target_type_categories': None,
+            'conductivity_columns_prefix': 'cond',
+            'thickness_columns_prefix': 'thick',
+            'aem_covariate_cols': covariate_cols,
+            'test_train_split': {'train': 0.6, 'val': 0.2, 'test': 0.2},
+        },
+        'learning': {
+            'algorithm': algorithm,
+            'params': {},
+            'weighted_model': {},
+            'numpy_seed': 10,
+            'include_aem_covariates': True,
+            'include_thickness': True,
+            'include_conductivity_derivatives': True,
+            'smooth_twod_covariates': True,
+            'smooth_covariates_kernel_size': '(21, 3)',
+        },
+        'output': {
+            'directory': directory.joinpath('out').as_posix(),
+            'plot_survey_lines': False,
+            'pred': {'quantiles': 0.95},
+        },
+    }
+    config_file = directory.joinpath('synthetic.yaml')
+    config_file.write_text(yaml.safe_dump(settings))
+    conf = Config(config_file)
+    conf.schema = {
+        'conductivity_cols': [c for c in aem_data.columns if c.startswith('cond')],
+        'thickness_cols': [c for c in aem_data.columns if c.startswith('thick')],
+    }
+    return conf
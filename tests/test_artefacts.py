@@ -0,0 +1,57 @@
+import joblib
+import numpy as np
+import pytest
+
+from aem.artefacts import dump_model_state, load_model_state, model_arrays_dir
+from aem.models import QuantileRegressionForest
+
+
+def test_model_state_arrays_are_memory_mapped(tmp_path):
+    rng = np.random.RandomState(1)
+    X, y = rng.rand(200, 3), rng.rand(200)
+    model = QuantileRegressionForest(n_estimators=5, random_state=0).fit(X, y)
+    big = rng.rand(1000, 3)
+    state = {'model': model, 'big': big, 'same': big, 'small': np.arange(3), 'config': {'name': 'test'}}
+    model_file = tmp_path.joinpath('test.model')
+    dump_model_state(state, model_file, min_bytes=1000)
+    loaded = load_model_state(model_file)
+
+    assert isinstance(loaded['big'], np.memmap) and not loaded['big'].flags.writeable
+    assert loaded['same'] is loaded['big']
+    assert not isinstance(loaded['small'], np.memmap)
+    assert isinstance(loaded['model'].leaf_ranks_, np.memmap)
+    np.testing.assert_array_equal(loaded['big'], big)
+    assert loaded['config'] == {'name': 'test'}
+    np.testing.assert_allclose(loaded['model'].predict_quantiles(X, [0.1, 0.9]), model.predict_quantiles(X, [0.1, 0.9]))
+    # the data of every array file is aligned for memory mapping
+    for f in model_arrays_dir(model_file).rglob('*.npy'):
+        assert np.load(f, mmap_mode='r').offset % 64 == 0
+
+    # a second dump replaces the arrays of the first, and leaves no temporary files
+    dump_model_state({'small': np.arange(3)}, model_file, min_bytes=1000)
+    assert not list(model_arrays_dir(model_file).rglob('*.npy'))
+    assert len(list(model_arrays_dir(model_file).iterdir())) == 1
+    assert [p.name for p in tmp_path.iterdir() if p.is_file()] == ['test.model']
+    assert load_model_state(model_file)['small'].tolist() == [0, 1, 2]
+
+
+def test_interrupted_dump_keeps_previous_model(tmp_path):
+    model_file = tmp_path.joinpath('test.model')
+    big = np.random.RandomState(2).rand(1000, 3)
+    dump_model_state({'big': big}, model_file, min_bytes=1000)
+
+    class Unpicklable:
+        def __reduce__(self):
+            raise RuntimeError('interrupted')
+
+    with pytest.raises(RuntimeError):
+        dump_model_state({'big': big * 2, 'bad': Unpicklable()}, model_file, min_bytes=1000)
+    np.testing.assert_array_equal(load_model_state(model_file)['big'], big)
+    assert [p.name for p in tmp_path.iterdir() if p.is_file()] == ['test.model']
+
+
+def test_load_joblib_model_file(tmp_path):
+    model_file = tmp_path.joinpath('test.model')
+    with open(model_file, 'wb') as f:
+        joblib.dump({'model': np.arange(5)}, f)
+    np.testing.assert_array_equal(load_model_state(model_file)['model'], np.arange(5))
@@ -0,0 +1,49 @@
+import json
+
+from benchmarks import run
+from benchmarks.run import compare
+from benchmarks.synthetic import synthetic_survey
+
+
+def test_synthetic_survey():
+    aem_data, interp_data = synthetic_survey(n_lines=4, soundings_per_line=50, n_layers=12, interp_density=0.1)
+    assert aem_data.shape[0] == 200
+    assert len([c for c in aem_data.columns if c.startswith('cond_')]) == 12
+    assert len([c for c in aem_data.columns if c.startswith('thick_')]) == 12
+    assert aem_data.groupby('line').size().tolist() == [50] * 4
+    assert interp_data.shape[0] == 20
+    assert list(interp_data.columns) == ['POINT_X', 'POINT_Y', 'Z_coor', 'weight']
+
+
+def test_compare_with_baseline():
+    baseline = [{'scale': 'small', 'stage': 'fit', 'seconds': 1.0, 'peak_mb': 100.0},
+                {'scale': 'small', 'stage': 'predict', 'seconds': 1.0, 'peak_mb': 100.0}]
+    results = [{'scale': 'small', 'stage': 'fit', 'seconds': 1.2, 'peak_mb': 140.0},
+               {'scale': 'small', 'stage': 'predict', 'seconds': 1.5, 'peak_mb': 90.0},
+               {'scale': 'medium', 'stage': 'fit', 'seconds': 9.0, 'peak_mb': 900.0}]
+    regressions = compare(results, baseline, tolerance=0.25)
+    assert len(regressions) == 2
+    assert regressions[0].startswith('small fit peak_mb')
+    assert regressions[1].startswith('small predict seconds')
+
+
+def test_run_smoke(tmp_path, monkeypatch):
+    # 4 lines of 50 soundings
+    monkeypatch.setitem(run.scales, 'tiny', (4, 50, 5, 0.1))
+    output = tmp_path.joinpath('results.json')
+    assert run.main(['--scales', 'tiny', '--algorithms', 'gradientboost', '--repeat', '1',
+                     '--output', str(output)]) == 0
+    results = json.loads(output.read_text())['results']
+    stages = ['split_flight_lines.attributes', 'split_flight_lines.grid', 'prepare_aem_data', 'convert_to_xy',
+              'gradientboost.fit', 'gradientboost.predict', 'add_pred_to_data']
+    assert [r['stage'] for r in results] == stages
+    for r in results:
+        assert r['scale'] == 'tiny'
+        assert r['seconds'] >= 0 and r['peak_mb'] > 0
+
+    # a missing baseline fails rather than skipping the comparison
+    args = ['--scales', 'tiny', '--algorithms', 'gradientboost', '--repeat', '1', '--output', str(output),
+            '--baseline', str(tmp_path.joinpath('baseline.json'))]
+    assert run.main(args) == 2
+    assert run.main(args + ['--save-baseline']) == 0
+    assert json.loads(tmp_path.joinpath('baseline.json').read_text())['results']
@@ -0,0 +1,65 @@
+import os
+import json
+import socket
+
+import numpy as np
+import pandas as pd
+
+from aem.cache import ColumnarCache, hash_key, shapefile_fingerprint, owner_file, write_owner
+
+
+def _frame(n=100):
+    rng = np.random.RandomState(1)
+    return pd.DataFrame({
+        'cond_1': rng.rand(n),
+        'fiducial': np.arange(n),
+        'cluster_line_segment_id': [f'{i // 10}_{i % 3}' for i in range(n)],
+    }, index=rng.permutation(n) * 2)
+
+
+def test_cache_round_trip(tmp_path):
+    cache = ColumnarCache(tmp_path)
+    df = _frame()
+    assert cache.get('a') is None
+    cache.put('a', df)
+    pd.testing.assert_frame_equal(cache.get('a'), df, check_index_type=False)
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = ColumnarCache(tmp_path, max_entries=2)
+    df = _frame()
+    for i, k in enumerate(['a', 'b']):
+        cache.put(k, df)
+        os.utime(cache.path(k), ns=(i * 10 ** 9, i * 10 ** 9))
+    cache.get('a')  # a is now more recently used than b
+    cache.put('c', df)
+    assert cache.path('a').exists()
+    assert not cache.path('b').exists()
+    assert cache.path('c').exists()
+
+
+def test_key_changes_with_input_files(tmp_path):
+    shp = tmp_path.joinpath('survey.shp')
+    shp.write_bytes(b'0' * 10)
+    key = hash_key({'cutoff_radius': 500}, shapefile_fingerprint(shp))
+    assert key == hash_key({'cutoff_radius': 500}, shapefile_fingerprint(shp))
+    assert key != hash_key({'cutoff_radius': 400}, shapefile_fingerprint(shp))
+    tmp_path.joinpath('survey.dbf').write_bytes(b'1')
+    assert key != hash_key({'cutoff_radius': 500}, shapefile_fingerprint(shp))
+
+
+def test_cache_removes_abandoned_feature_stores(tmp_path):
+    live = tmp_path.joinpath('features_live')
+    live.mkdir()
+    write_owner(live)
+    exited = tmp_path.joinpath('features_exited')
+    exited.mkdir()
+    # pids are below 2 ** 22 on linux, so no process has this one
+    exited.joinpath(owner_file).write_text(json.dumps({'pid': 2 ** 22 + 1, 'host': socket.gethostname()}))
+    recent, old = tmp_path.joinpath('features_recent'), tmp_path.joinpath('features_old')
+    for d in [recent, old]:
+        d.mkdir()
+    os.utime(old, (0, 0))
+    ColumnarCache(tmp_path)
+    assert live.exists() and recent.exists()
+    assert not exited.exists() and not old.exists()
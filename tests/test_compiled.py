@@ -0,0 +1,52 @@
+import os
+import pickle
+import shutil
+
+import numpy as np
+import pytest
+from sklearn.ensemble import GradientBoostingRegressor
+from xgboost.sklearn import XGBRegressor
+
+from aem.compiled import compile_model, load_compiled_model, CompiledDistRegressor
+from aem.models import QuantileRandomForestRegressor, QuantileGradientBoosting, QuantileRegressionForest
+
+pytestmark = pytest.mark.skipif(shutil.which(os.environ.get('CC', 'cc')) is None, reason="needs a C compiler")
+
+
+@pytest.fixture
+def regression_data():
+    rng = np.random.RandomState(5)
+    X = rng.rand(400, 5)
+    y = X[:, 0] * 10 + np.sin(X[:, 1] * 6) + rng.normal(0, 0.5, 400)
+    return X, y
+
+
+@pytest.mark.parametrize('model', [
+    QuantileRandomForestRegressor(n_estimators=15, min_samples_leaf=2, random_state=1),
+    QuantileGradientBoosting(n_estimators=30, max_depth=3, random_state=1, upper_alpha=0.9, lower_alpha=0.1),
+    GradientBoostingRegressor(n_estimators=30, random_state=1),
+    XGBRegressor(n_estimators=30, max_depth=4),
+])
+def test_compiled_model_predictions(tmp_path, regression_data, model):
+    X, y = regression_data
+    model.fit(X[:300], y[:300], sample_weight=np.ones(300))
+    compiled = load_compiled_model(model, compile_model(model, X.shape[1], tmp_path.joinpath('model.so')))
+    X_test = X[300:].copy()
+    if isinstance(model, XGBRegressor):  # missing values go the default direction of the split
+        X_test[::7, 2] = np.nan
+    np.testing.assert_allclose(compiled.predict(X_test), model.predict(X_test), rtol=1e-5, atol=1e-5)
+    if hasattr(model, 'predict_dist'):
+        assert isinstance(compiled, CompiledDistRegressor)
+        for a, b in zip(compiled.predict_dist(X_test, interval=0.8), model.predict_dist(X_test, interval=0.8)):
+            np.testing.assert_allclose(a, b, rtol=1e-5, atol=1e-6)
+    # the library is loaded again when unpickled
+    np.testing.assert_allclose(pickle.loads(pickle.dumps(compiled)).predict(X_test), compiled.predict(X_test))
+    with pytest.raises(ValueError):
+        compiled.predict(X_test[:, :3])
+
+
+def test_compile_unsupported_model(tmp_path, regression_data):
+    X, y = regression_data
+    model = QuantileRegressionForest(n_estimators=3).fit(X, y)
+    with pytest.raises(TypeError):
+        compile_model(model, X.shape[1], tmp_path.joinpath('model.so'))
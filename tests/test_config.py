@@ -0,0 +1,13 @@
+import geopandas as gpd
+from shapely.geometry import Point
+
+from aem.config import read_dbf_header
+
+
+def test_read_dbf_header(tmp_path):
+    shp = tmp_path.joinpath('aem.shp')
+    cols = {'cond_1': [0.1, 0.2], 'cond_2': [0.3, 0.4], 'thick_1': [1.0, 2.0], 'fiducial': [1, 2], 'line': ['a', 'b']}
+    gpd.GeoDataFrame(cols, geometry=[Point(0, 0), Point(1, 1)]).to_file(shp)
+    n_records, fields = read_dbf_header(shp)
+    assert n_records == 2
+    assert fields == list(gpd.read_file(shp).drop(columns='geometry').columns)
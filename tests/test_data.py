@@ -0,0 +1,54 @@
+from types import SimpleNamespace
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from scipy.sparse.csgraph import connected_components
+from sklearn.neighbors import radius_neighbors_graph
+
+from aem.data import grid_connected_components, find_flight_lines, plot_survey_lines, survey_lines_raster, \
+    wait_for_diagnostics
+
+
+def test_grid_connected_components_is_single_linkage():
+    rng = np.random.RandomState(4)
+    # a few noisy lines and scattered points
+    xy = np.concatenate([
+        np.c_[np.linspace(0, 5000, 300), rng.normal(y, 20, 300)] for y in [0, 700, 1500]
+    ] + [rng.uniform(0, 5000, (100, 2))])
+    xy = xy[rng.permutation(xy.shape[0])]
+    for eps in [100, 250, 600]:
+        labels = grid_connected_components(xy, eps)
+        _, expected = connected_components(radius_neighbors_graph(xy, eps), directed=False)
+        # same partition, numbered in order of first appearance
+        _, first = np.unique(expected, return_index=True)
+        expected = np.argsort(np.argsort(first))[expected]
+        np.testing.assert_array_equal(labels, expected)
+
+
+def test_find_flight_lines_offsets_labels_per_dataset():
+    conf = SimpleNamespace(aem_line_segmentation='auto', aem_line_scan_eps=10)
+    with_attributes = pd.DataFrame({'POINT_X': [0, 1, 2, 3], 'POINT_Y': [0, 0, 0, 0],
+                                    'flight': [1, 1, 2, 1], 'line': [10, 20, 10, 10]})
+    without_attributes = pd.DataFrame({'POINT_X': [0, 5, 1000, 1005], 'POINT_Y': [0, 0, 0, 0]})
+    line_no = find_flight_lines([with_attributes, without_attributes], conf, n_jobs=1)
+    np.testing.assert_array_equal(line_no, [0, 1, 2, 0, 3, 3, 4, 4])
+
+
+def test_survey_lines_raster():
+    xy = np.array([[0., 0.], [10., 0.], [0., 10.], [10., 10.], [5., 5.]])
+    raster, extent = survey_lines_raster(xy, np.array([0, 0, 1, 1, 2]), bins=(4, 2))
+    np.testing.assert_array_equal(raster, [[0, -1, -1, 0],
+                                           [1, -1, 2, 1]])
+    assert extent == (0, 10, 0, 10)
+
+
+def test_wait_for_diagnostics_saves_plot(tmp_path):
+    rng = np.random.RandomState(5)
+    xy = np.c_[rng.uniform(0, 1000, 200), np.repeat([0., 500.], 100)]
+    fig_file = tmp_path.joinpath('lines.png')
+    plot_survey_lines(xy, np.repeat([0, 1], 100), fig_file, bins=(80, 50))
+    wait_for_diagnostics()
+    assert fig_file.stat().st_size > 0
+    # rendered on a figure of its own, not through pyplot
+    assert not plt.get_fignums()
@@ -0,0 +1,59 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import GroupKFold
+
+from aem.features import FeatureStore
+
+
+def test_feature_store_round_trip(tmp_path):
+    rng = np.random.RandomState(7)
+    n = 1000
+    X = pd.DataFrame({'cond_1': rng.rand(n), 'cond_2': rng.rand(n), 'elevation': rng.randint(0, 100, n)})
+    y, w, groups = rng.rand(n), rng.choice([1., 2.], n), rng.randint(0, 20, n)
+    cv = GroupKFold(n_splits=4)
+    conf = SimpleNamespace(cache_dir=tmp_path)
+    with FeatureStore.create(conf, X, y, w, groups, cv, chunk_rows=300) as store:
+        assert isinstance(store.X, np.memmap)
+        assert store.X.flags['C_CONTIGUOUS']
+        np.testing.assert_array_equal(store.X, X.to_numpy(dtype=np.float64))
+        np.testing.assert_array_equal(store.y, y)
+        np.testing.assert_array_equal(store.w, w)
+        for (train, test), (e_train, e_test) in zip(store.folds, cv.split(X, y, groups)):
+            np.testing.assert_array_equal(train, e_train)
+            np.testing.assert_array_equal(test, e_test)
+        directory = store.directory
+    assert not directory.exists()
+
+
+def test_stratified_subsets_are_nested_and_keep_every_group(tmp_path):
+    rng = np.random.RandomState(8)
+    n = 2000
+    X = pd.DataFrame({'cond_1': rng.rand(n)})
+    groups = rng.randint(0, 40, n)
+    conf = SimpleNamespace(cache_dir=tmp_path)
+    with FeatureStore.create(conf, X, rng.rand(n), np.ones(n), groups, GroupKFold(n_splits=2)) as store:
+        train, _ = store.folds[0]
+        small, large = store.stratified_subset(train, 0.1), store.stratified_subset(train, 0.3)
+        assert set(small) <= set(large)
+        assert set(groups[small]) == set(groups[train])
+        assert abs(len(large) - 0.3 * len(train)) < 0.05 * len(train)
+        assert store.stratified_subset(train, 1.0) is train
+
+
+def test_stratified_subsets_follow_the_seed(tmp_path):
+    rng = np.random.RandomState(9)
+    n = 1000
+    X = pd.DataFrame({'cond_1': rng.rand(n)})
+    groups = rng.randint(0, 20, n)
+    conf = SimpleNamespace(cache_dir=tmp_path)
+
+    def subset(seed):
+        with FeatureStore.create(conf, X, rng.rand(n), np.ones(n), groups, GroupKFold(n_splits=2),
+                                 random_state=seed) as store:
+            train, _ = store.folds[0]
+            return store.stratified_subset(train, 0.3)
+
+    np.testing.assert_array_equal(subset(1), subset(1))
+    assert not np.array_equal(subset(1), subset(2))
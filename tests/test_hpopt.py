@@ -0,0 +1,107 @@
+import numpy as np
+from hyperopt import fmin, tpe, Trials, STATUS_OK
+from hyperopt.hp import uniform, choice
+
+from aem.hpopt import append_trials, load_trials, fmin_parallel, SuccessiveHalving, best_complete_trial
+
+
+def _objective(params):
+    return {'loss': (params['x'] - 1) ** 2 + params['c'], 'status': STATUS_OK, 'params': params}
+
+
+def test_trials_log_round_trip_and_resume(tmp_path):
+    space = {'x': uniform('x', -5, 5), 'c': choice('c', [0, 1])}
+    trials_log = tmp_path.joinpath('trials.jsonl')
+    trials = Trials()
+    fmin(_objective, space, algo=tpe.suggest, trials=trials, max_evals=6, rstate=np.random.RandomState(1))
+    logged = append_trials(trials, trials_log, 0)
+    fmin(_objective, space, algo=tpe.suggest, trials=trials, max_evals=10, rstate=np.random.RandomState(2))
+    assert append_trials(trials, trials_log, logged) == 10
+
+    resumed = load_trials(trials_log)
+    assert resumed.losses() == trials.losses()
+    assert resumed.vals == trials.vals
+    # hyperopt continues from the reloaded history
+    fmin(_objective, space, algo=tpe.suggest, trials=resumed, max_evals=12, rstate=np.random.RandomState(3))
+    assert len(resumed.trials) == 12
+
+
+def test_fmin_parallel_evaluates_batches():
+    space = {'x': uniform('x', -5, 5), 'c': choice('c', [0, 1])}
+    batches = []
+
+    def evaluate(batch):
+        batches.append(len(batch))
+        return [_objective(p) for p in batch]
+
+    trials = Trials()
+    best = fmin_parallel(evaluate, space, algo=tpe.suggest, trials=trials, max_evals=10, parallel_trials=4,
+                         rstate=np.random.RandomState(1))
+    assert batches == [4, 4, 2]
+    assert len(trials.trials) == 10
+    assert best == trials.argmin
+    for t in trials.trials:
+        assert t['result']['loss'] == (t['result']['params']['x'] - 1) ** 2 + t['result']['params']['c']
+
+
+def test_successive_halving_rungs():
+    scheduler = SuccessiveHalving('quantilexgb', min_rounds=5, eta=3)
+    params = {k: {'n_estimators': 50, 'max_depth': 3} for k in
+              ['mean_model_params', 'upper_quantile_params', 'lower_quantile_params']}
+    rungs = scheduler.rungs(params)
+    assert [scheduler.boosting_rounds(r) for r, _ in rungs] == [5, 15, 45, 50]
+    assert [f for _, f in rungs] == [1.0] * 4
+    assert all(rungs[1][0][k]['n_estimators'] == 15 for k in params)
+    assert rungs[-1][0] is params and params['mean_model_params']['n_estimators'] == 50
+    assert SuccessiveHalving('xgboost', min_rounds=10).rungs({'max_depth': 3}) == [({'max_depth': 3}, 1.0)]
+
+
+def test_successive_halving_data_fraction_rungs():
+    params = {'n_estimators': 20}
+    rungs = SuccessiveHalving('randomforest', min_rounds=5, min_fraction=0.05, eta=3).rungs(params)
+    assert rungs == [(params, 0.05), (params, 0.15000000000000002), (params, 0.45), (params, 1.0)]
+    rungs = SuccessiveHalving('xgboost', min_rounds=5, min_fraction=0.5, eta=3).rungs(params)
+    assert rungs == [({'n_estimators': 5}, 0.5), ({'n_estimators': 15}, 1.0), (params, 1.0)]
+
+
+def test_successive_halving_promotes_best_third():
+    scheduler = SuccessiveHalving('xgboost', min_rounds=10, eta=3)
+    assert scheduler.promote(0, 0.5)  # the first trial always continues
+    assert not scheduler.promote(0, 0.6)
+    assert scheduler.promote(0, 0.1)
+    assert not scheduler.promote(0, 0.3)
+    assert [scheduler.promote(0, loss) for loss in [0.9, 0.05]] == [False, True]
+
+
+def test_successive_halving_catboost_rounds_aliases():
+    scheduler = SuccessiveHalving('catboost', min_rounds=10, eta=3)
+    for key in ['iterations', 'n_estimators']:
+        rungs = scheduler.rungs({key: 50, 'depth': 6})
+        assert [r for r, _ in rungs] == [{key: 10, 'depth': 6}, {key: 30, 'depth': 6}, {key: 50, 'depth': 6}]
+
+
+def test_best_trial_is_evaluated_at_full_fidelity():
+    space = {'x': uniform('x', -5, 5), 'c': choice('c', [0, 1])}
+
+    def evaluate(batch):
+        # the trials of a low fidelity have the lowest losses but must never be chosen
+        results = [{**_objective(p), 'complete': p['x'] > 0} for p in batch]
+        return [{**r, 'loss': r['loss'] - (0 if r['complete'] else 100)} for r in results]
+
+    trials = Trials()
+    fmin_parallel(evaluate, space, algo=tpe.suggest, trials=trials, max_evals=20, parallel_trials=4,
+                  rstate=np.random.RandomState(1))
+    best = best_complete_trial(trials)
+    assert best['result']['complete']
+    assert best['result']['loss'] == min(t['result']['loss'] for t in trials.trials if t['result']['complete'])
+
+
+def test_fmin_parallel_stops_at_loss_threshold():
+    space = {'x': uniform('x', -5, 5), 'c': choice('c', [0, 1])}
+    trials = Trials()
+    fmin_parallel(lambda batch: [_objective(p) for p in batch], space, algo=tpe.suggest, trials=trials,
+                  max_evals=100, parallel_trials=4, rstate=np.random.RandomState(1), loss_threshold=1)
+    losses = trials.losses()
+    assert min(losses) <= 1
+    # the search stops after the first batch that reaches the threshold
+    assert all(min(losses[:k]) > 1 for k in range(4, len(losses), 4))
@@ -0,0 +1,130 @@
+import numpy as np
+import pytest
+from scipy.stats import norm
+
+from sklearn.base import clone
+from aem.models import QuantileRandomForestRegressor, QuantileRegressionForest, QuantileGradientBoosting, \
+    XGBQuantileRegressor, QuantileXGB, native_quantile_objective
+
+
+@pytest.fixture
+def regression_data():
+    rng = np.random.RandomState(9)
+    X = rng.rand(300, 4)
+    y = X[:, 0] * 10 + rng.normal(0, 1, 300)
+    return X, y
+
+
+@pytest.mark.parametrize('chunk_rows', [7, 10000])
+def test_quantile_random_forest_predict_dist(regression_data, chunk_rows):
+    X, y = regression_data
+    model = QuantileRandomForestRegressor(n_estimators=20, min_samples_leaf=3, n_jobs=2, random_state=1).fit(X, y)
+    tree_preds = np.array([dt.predict(X) for dt in model.estimators_])
+    Ey, Vy, ql, qu = model.predict_dist(X, interval=0.9, chunk_rows=chunk_rows)
+    np.testing.assert_allclose(Ey, model.predict(X))
+    np.testing.assert_allclose(Vy, tree_preds.var(axis=0), atol=1e-9)
+    expected_ql, expected_qu = norm.interval(0.9, loc=Ey, scale=np.sqrt(Vy))
+    np.testing.assert_allclose(ql, expected_ql)
+    np.testing.assert_allclose(qu, expected_qu)
+
+
+def _brute_force_leaf_distribution(model, X_train, y_train, w_train, X, alpha):
+    # the Meinshausen weights of the training rows at each row of X, tree by tree
+    weights = np.zeros((X.shape[0], X_train.shape[0]))
+    for dt in model.estimators_:
+        train_leaves, leaves = dt.apply(X_train.astype(np.float32)), dt.apply(X.astype(np.float32))
+        same_leaf = (leaves[:, np.newaxis] == train_leaves[np.newaxis, :]) * w_train
+        weights += same_leaf / same_leaf.sum(axis=1, keepdims=True)
+    weights /= len(model.estimators_)
+    Ey = weights @ y_train
+    Vy = (weights * (y_train[np.newaxis, :] - Ey[:, np.newaxis]) ** 2).sum(axis=1)
+    order = np.argsort(y_train, kind='stable')
+    cdf = np.cumsum(weights[:, order], axis=1)
+    q = y_train[order][np.minimum((cdf < alpha).sum(axis=1), len(y_train) - 1)]
+    return Ey, Vy, q
+
+
+@pytest.mark.parametrize('chunk_rows', [7, 1000])
+def test_quantile_regression_forest(regression_data, chunk_rows):
+    X, y = regression_data
+    w = np.random.RandomState(3).choice([0.5, 1, 2], size=y.shape[0])
+    model = QuantileRegressionForest(n_estimators=10, min_samples_leaf=4, n_jobs=2, random_state=1)
+    model.fit(X[:200], y[:200], sample_weight=w[:200])
+    Ey, Vy, ql, qu = model.predict_dist(X[200:], interval=0.77, chunk_rows=chunk_rows)
+    expected_Ey, expected_Vy, expected_ql = _brute_force_leaf_distribution(model, X[:200], y[:200], w[:200],
+                                                                           X[200:], (1 - 0.77) / 2)
+    np.testing.assert_allclose(Ey, expected_Ey, rtol=1e-5)
+    np.testing.assert_allclose(Vy, expected_Vy, rtol=1e-4, atol=1e-6)
+    np.testing.assert_allclose(ql, expected_ql)
+    assert np.all(ql <= qu)
+    quantiles = model.predict_quantiles(X[200:], [(1 - 0.77) / 2, 0.5, (1 + 0.77) / 2], chunk_rows=chunk_rows)
+    assert quantiles.shape == (100, 3)
+    np.testing.assert_allclose(quantiles[:, 0], ql)
+    np.testing.assert_allclose(quantiles[:, 2], qu)
+    assert np.all(np.diff(quantiles, axis=1) >= 0)
+
+
+def test_quantile_gradient_boosting_concurrent_fit(regression_data):
+    X, y = regression_data
+    w = np.random.RandomState(3).choice([0.5, 1, 2], size=y.shape[0])
+    model = QuantileGradientBoosting(n_estimators=20, max_depth=3, random_state=2, n_jobs=3)
+    assert model.fit(X, y, sample_weight=w) is model
+    Ey, Vy, ql, qu = model.predict_dist(X)
+    # each sub model is the same as when fitted on its own
+    for sub_model in [model.gb, model.gb_quantile_upper, model.gb_quantile_lower]:
+        np.testing.assert_allclose(sub_model.predict(X), clone(sub_model).fit(X, y, sample_weight=w).predict(X))
+    sequential = clone(model).set_params(n_jobs=1).fit(X, y, sample_weight=w)
+    for a, b in zip(sequential.predict_dist(X), (Ey, Vy, ql, qu)):
+        np.testing.assert_allclose(a, b)
+
+
+def _loop_quantile_loss(y_true, y_pred, alpha, delta):
+    grad, hess = np.zeros_like(y_true), np.zeros_like(y_true)
+    for i, x in enumerate(y_true - y_pred):
+        if x < (alpha - 1.0) * delta:
+            grad[i] = 1.0 - alpha
+        elif x < alpha * delta:
+            grad[i], hess[i] = -x / delta, 1.0 / delta
+        elif x > alpha * delta:
+            grad[i] = -alpha
+    return grad, hess
+
+
+def test_xgb_quantile_loss():
+    rng = np.random.RandomState(4)
+    y_true, y_pred, weight = rng.normal(0, 2, 500), rng.normal(0, 2, 500), rng.rand(500)
+    grad, hess = XGBQuantileRegressor.quantile_loss(y_true, y_pred, alpha=0.8, delta=1.5, threshold=np.inf, var=1.0,
+                                                    weight=weight)
+    expected_grad, expected_hess = _loop_quantile_loss(y_true, y_pred, alpha=0.8, delta=1.5)
+    np.testing.assert_allclose(grad, expected_grad * weight)
+    np.testing.assert_allclose(hess, expected_hess * weight)
+    # beyond the threshold the gradients are random with size var
+    grad, hess = XGBQuantileRegressor.quantile_loss(y_true, y_pred, alpha=0.8, delta=1.5, threshold=1.0, var=3.0,
+                                                    random_state=np.random.RandomState(0))
+    far = np.abs(y_true - y_pred) >= 1.0
+    np.testing.assert_allclose(np.abs(grad[far]), 3.0)
+    np.testing.assert_allclose(hess[far], 1.0)
+    np.testing.assert_allclose(grad[~far], expected_grad[~far])
+
+
+def test_quantile_xgb_pickled_before_the_quantile_models_were_combined():
+    params = {'delta': 1.0, 'thresh': 1.0, 'variance': 1.0, 'n_estimators': 5}
+    model = QuantileXGB({'n_estimators': 5}, {'alpha': 0.9, **params}, {'alpha': 0.1, **params})
+    state = model.__getstate__()
+    lower, upper = XGBQuantileRegressor(alpha=0.1, **params), XGBQuantileRegressor(alpha=0.9, **params)
+    del state['quantile_models'], state['n_jobs']
+    state.update(gb_quantile_lower=lower, gb_quantile_upper=upper)
+    legacy = QuantileXGB.__new__(QuantileXGB)
+    legacy.__setstate__(state)
+    assert legacy.quantile_models == [lower, upper]
+    assert legacy.n_jobs == -1
+
+
+def test_quantile_xgb_fits_one_booster_only_with_shared_params():
+    params = {'delta': 1.0, 'thresh': 1.0, 'variance': 1.0, 'n_estimators': 5}
+    model = QuantileXGB({'n_estimators': 5}, {'alpha': 0.9, **params}, {'alpha': 0.1, **params, 'delta': 2.0})
+    assert len(model.quantile_models) == (1 if native_quantile_objective else 2)
+    # differing lower_quantile_params are used by a booster of their own
+    model = QuantileXGB({'n_estimators': 5}, {'alpha': 0.9, **params}, {'alpha': 0.1, **params, 'max_depth': 2})
+    lower, upper = model.quantile_models
+    assert lower.max_depth == 2 and lower.alpha == 0.1 and upper.alpha == 0.9
@@ -0,0 +1,51 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+from aem.prediction import predict_aem_file, predict_aem_file_in_tiles
+from aem.utils import select_cols_used_in_model
+from benchmarks.synthetic import synthetic_survey, synthetic_config
+
+
+class SumModel:
+    def predict(self, X):
+        return X.to_numpy().sum(axis=1)
+
+
+def test_tiled_prediction_matches_whole_file(tmp_path):
+    aem_data, _ = synthetic_survey(n_lines=3, soundings_per_line=200, n_layers=5, interp_density=0.1)
+    shp = tmp_path.joinpath('synthetic.shp')
+    gpd.GeoDataFrame(aem_data, geometry=gpd.points_from_xy(aem_data.POINT_X, aem_data.POINT_Y)).to_file(shp)
+    conf = synthetic_config(tmp_path, aem_data)
+    conf.predict = True
+    conf.shapefile_rows = None
+    model = SumModel()
+    tile_rows, halo_rows = 150, 30
+
+    predict_aem_file(conf, model, shp, tmp_path.joinpath('whole.csv'))
+    predict_aem_file_in_tiles(conf, model, shp, tmp_path.joinpath('tiled.csv'), tile_rows, halo_rows)
+    whole = pd.read_csv(tmp_path.joinpath('whole.csv')).set_index('fiducial').sort_index()
+    tiled = pd.read_csv(tmp_path.joinpath('tiled.csv')).set_index('fiducial').sort_index()
+
+    assert whole.index.equals(tiled.index)
+    assert list(whole.columns) == list(tiled.columns)
+    assert not tmp_path.joinpath('tiled.csv.tiles').exists()
+    # away from the tile seams the smoothing windows, half the kernel wide, see the same soundings
+    seam_distance = np.abs((whole.index.to_numpy() + tile_rows // 2) % tile_rows - tile_rows // 2)
+    away = seam_distance >= conf.smooth_covariates_kernel_size[0] // 2
+    cols = select_cols_used_in_model(conf) + ['pred']
+    np.testing.assert_allclose(tiled.loc[away, cols], whole.loc[away, cols])
+
+
+def test_tiled_prediction_with_compressed_csv(tmp_path):
+    aem_data, _ = synthetic_survey(n_lines=2, soundings_per_line=200, n_layers=5, interp_density=0.1)
+    shp = tmp_path.joinpath('synthetic.shp')
+    gpd.GeoDataFrame(aem_data, geometry=gpd.points_from_xy(aem_data.POINT_X, aem_data.POINT_Y)).to_file(shp)
+    conf = synthetic_config(tmp_path, aem_data)
+    conf.predict = True
+    conf.shapefile_rows = None
+    conf.output_compression = 'gzip'
+
+    predict_aem_file_in_tiles(conf, SumModel(), shp, tmp_path.joinpath('tiled.csv'), tile_rows=150, halo_rows=30)
+    tiled = pd.read_csv(tmp_path.joinpath('tiled.csv'), compression='gzip')
+    assert sorted(tiled.fiducial) == sorted(aem_data.fiducial)
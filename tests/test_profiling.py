@@ -0,0 +1,51 @@
+import pstats
+
+import pytest
+
+from aem import profiling
+
+
+@pytest.fixture
+def profiler(tmp_path):
+    profiler = profiling.enable_profiling(top_n=5)
+    profiling.profile_to(tmp_path)
+    yield profiler
+    profiling.disable_profiling()
+
+
+def _allocate(n):
+    return [bytearray(1024) for _ in range(n)]
+
+
+@profiling.profiled('inner')
+def _inner(n):
+    return _allocate(n)
+
+
+def test_stages_are_no_ops_when_profiling_is_off():
+    assert not profiling.is_enabled()
+    assert profiling.stage('a') is profiling.stage('b')
+    assert len(_inner(3)) == 3
+
+
+def test_nested_stages(profiler, tmp_path):
+    with profiling.stage('outer'):
+        kept = _allocate(1000)
+        for _ in range(2):
+            kept += _inner(2000)
+    assert profiler.records['outer'].calls == 1
+    assert profiler.records['inner'].calls == 2
+    # allocations and peaks of an inner stage count towards the outer stage too
+    assert profiler.records['outer'].peak_bytes >= profiler.records['inner'].peak_bytes > 2000 * 1024
+    held = sum(s for s, _ in profiler.records['outer'].allocations.values())
+    assert held > 5000 * 1024
+
+    profiler.write()
+    directory = tmp_path.joinpath('profile')
+    assert {p.name for p in directory.iterdir()} == {'outer.prof', 'outer.txt', 'inner.prof', 'inner.txt',
+                                                     'summary.txt'}
+    # the cpu time of the inner stage is attributed to it alone
+    outer = {f[2] for f in pstats.Stats(directory.joinpath('outer.prof').as_posix()).stats}
+    inner = {f[2] for f in pstats.Stats(directory.joinpath('inner.prof').as_posix()).stats}
+    assert '_inner' in inner and '_inner' not in outer
+    assert 'functions by cumulative time' in directory.joinpath('inner.txt').read_text()
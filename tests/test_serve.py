@@ -0,0 +1,70 @@
+import json
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from aem.serve import PredictionService, make_server
+
+
+class SumModel:
+    def predict_dist(self, X, interval=0.95):
+        p = X.to_numpy().sum(axis=1)
+        return p, np.ones_like(p), p - interval, p + interval
+
+
+def _conf():
+    return SimpleNamespace(conductivity_cols=['cond_1', 'cond_2'], include_aem_covariates=False,
+                           include_conductivity_derivatives=False, include_thickness=False, quantiles=0.9)
+
+
+def _features(seed, n):
+    rng = np.random.RandomState(seed)
+    return pd.DataFrame({'cond_1': rng.rand(n), 'cond_2': rng.rand(n), 'other': rng.rand(n)})
+
+
+@pytest.fixture
+def service():
+    service = PredictionService(_conf(), SumModel(), max_batch_rows=1000, max_wait=0.05)
+    yield service
+    service.close()
+
+
+def test_concurrent_requests_are_batched(service):
+    requests = [_features(i, i + 1) for i in range(20)]
+    with ThreadPoolExecutor(max_workers=20) as pool:
+        results = list(pool.map(service.predict, requests))
+    for X, pred in zip(requests, results):
+        np.testing.assert_allclose(pred['pred'], X.cond_1 + X.cond_2)
+        np.testing.assert_allclose(pred['upper_quantile'], X.cond_1 + X.cond_2 + 0.9)
+        assert list(pred.columns) == ['pred', 'variance', 'lower_quantile', 'upper_quantile']
+    stats = service.stats.summary()
+    assert stats['requests'] == 20
+    assert stats['rows'] == sum(range(1, 21))
+    assert stats['batches'] < 20
+
+
+def test_missing_model_columns(service):
+    with pytest.raises(KeyError):
+        service.predict(_features(0, 3).drop(columns='cond_2'))
+
+
+def test_http_server(service):
+    server = make_server(service, '127.0.0.1', 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        X = _features(1, 5)
+        body = json.dumps({'features': X.to_dict(orient='list')}).encode()
+        with urllib.request.urlopen(urllib.request.Request(url + '/predict', data=body)) as r:
+            pred = json.loads(r.read())
+        np.testing.assert_allclose(pred['pred'], X.cond_1 + X.cond_2)
+        with urllib.request.urlopen(url + '/stats') as r:
+            assert json.loads(r.read())['rows'] == 5
+    finally:
+        server.shutdown()
+        server.server_close()
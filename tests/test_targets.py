@@ -0,0 +1,83 @@
+from types import SimpleNamespace
+
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import KDTree
+
+from aem import utils
+from aem.targets import TargetIndex, target_index_key
+
+
+def _index(n=500):
+    rng = np.random.RandomState(6)
+    targets = pd.DataFrame({
+        'POINT_X': rng.uniform(0, 10000, n),
+        'POINT_Y': rng.uniform(0, 10000, n),
+        'Z_coor': rng.uniform(10, 100, n),
+        'weight': rng.choice([1, 2, 3], n),
+    })
+    return TargetIndex(targets, KDTree(targets[['POINT_X', 'POINT_Y']]))
+
+
+def test_query_bbox():
+    index = _index()
+    x, y = index.targets.POINT_X, index.targets.POINT_Y
+    expected = np.flatnonzero((x >= 2000) & (x <= 3500) & (y >= 6000) & (y <= 9000))
+    np.testing.assert_array_equal(index.query_bbox(2000, 6000, 3500, 9000), expected)
+
+
+def _conf(tmp_path):
+    return SimpleNamespace(cache_data=True, cache_dir=str(tmp_path), cache_max_entries=2, oos_validation=False,
+                           interp_data=[], oos_interp_data=[], shapefile_rows=None, train_data_weights=[],
+                           weighted_model=False, target_col='Z_coor', target_type_col=[],
+                           included_target_type_categories=[], target_class_indicator_col=None)
+
+
+def test_within_masks_targets():
+    index = _index()
+    xy = np.array([[1000., 1000.], [2000., 1500.]])
+    near = index.within(xy, margin=500)
+    assert near.dtype == bool and near.shape == (index.targets.shape[0],)
+    np.testing.assert_array_equal(np.flatnonzero(near), index.query_bbox(500, 500, 2500, 2000))
+    assert index.within(np.array([[0., 0.], [10000., 10000.]]), margin=0).all()
+
+
+def test_within_empty_xy():
+    index = _index()
+    near = index.within(np.empty((0, 2)), margin=500)
+    assert near.shape == (index.targets.shape[0],) and not near.any()
+
+
+def test_within_on_loaded_tree(tmp_path):
+    index = _index()
+    conf = _conf(tmp_path)
+    index.save(tmp_path.joinpath(TargetIndex.prefix + target_index_key(conf) + TargetIndex.suffix), max_entries=2)
+    loaded = TargetIndex.load(conf)
+    xy = np.array([[4000., 7000.], [5000., 8000.]])
+    np.testing.assert_array_equal(loaded.within(xy, margin=250), index.within(xy, margin=250))
+    assert not loaded.within(np.empty((0, 2)), margin=250).any()
+
+
+def test_save_round_trip_and_eviction(tmp_path):
+    index = _index()
+    path = tmp_path.joinpath('targets_a.joblib')
+    index.save(path, max_entries=1)
+    state = joblib.load(path, mmap_mode='r')
+    pd.testing.assert_frame_equal(state['targets'], index.targets)
+    index.save(tmp_path.joinpath('targets_b.joblib'), max_entries=1)
+    assert not path.exists()
+
+
+def test_targets_near_the_aem_data_give_the_same_targets():
+    index = _index()
+    rng = np.random.RandomState(7)
+    aem_data = pd.DataFrame({'POINT_X': rng.uniform(2000, 4000, 300), 'POINT_Y': rng.uniform(1000, 3000, 300)})
+    conf = SimpleNamespace(weighted_model=True, cutoff_radius=400, target_class_indicator_col=None)
+    near = np.flatnonzero(index.within(aem_data.to_numpy(), conf.cutoff_radius))
+    assert 0 < near.shape[0] < index.targets.shape[0]
+    subset = utils.convert_to_xy(conf, aem_data, index.targets.iloc[near], tree=index.tree, tree_positions=near)
+    full = utils.convert_to_xy(conf, aem_data, index.targets, tree=index.tree)
+    pd.testing.assert_frame_equal(subset['covariates'], full['covariates'])
+    pd.testing.assert_series_equal(subset['targets'], full['targets'])
+    pd.testing.assert_series_equal(subset['weights'], full['weights'])
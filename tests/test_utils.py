@@ -0,0 +1,137 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.neighbors import KDTree
+
+from aem import utils
+
+
+def _reference_weighted_target(interp_data, tree, row, conf):
+    """row at a time implementation the batched engine must reproduce"""
+    x = row[utils.twod_coords].values.reshape(1, -1).astype(np.float64)
+    ind, dist = tree.query_radius(x, r=conf.cutoff_radius, return_distance=True)
+    ind, dist = ind[0], dist[0]
+    if not len(dist):
+        return None, None
+    dist = dist + 1e-6
+    df = interp_data.iloc[ind]
+    if conf.target_class_indicator_col is not None:
+        mask = df[conf.target_class_indicator_col].values == row[conf.target_class_indicator_col]
+        if not np.any(mask):
+            return None, None
+    else:
+        mask = np.ones_like(dist, dtype=bool)
+    dist = dist[mask]
+    depth = np.sum(df.Z_coor.values[mask] * (1 / dist) ** 2) / np.sum((1 / dist) ** 2)
+    weight = np.sum(df.weight.values[mask] * (1 / dist) ** 2) / np.sum((1 / dist) ** 2) \
+        if conf.weighted_model else 1.0
+    return depth, weight
+
+
+@pytest.fixture(params=[None, 'ero_dep'])
+def xy_data(request):
+    rng = np.random.RandomState(0)
+    n_aem, n_interp = 500, 200
+    aem_data = pd.DataFrame({
+        'POINT_X': rng.uniform(0, 5000, n_aem),
+        'POINT_Y': rng.uniform(0, 5000, n_aem),
+        'cond_1': rng.rand(n_aem),
+        'ero_dep': rng.randint(0, 3, n_aem),
+    }, index=rng.permutation(n_aem) + 10)
+    interp_data = pd.DataFrame({
+        'POINT_X': rng.uniform(0, 5000, n_interp),
+        'POINT_Y': rng.uniform(0, 5000, n_interp),
+        'Z_coor': rng.uniform(10, 100, n_interp),
+        'weight': rng.choice([0.5, 1, 2], n_interp),
+        'ero_dep': rng.randint(0, 3, n_interp),
+    })
+    conf = SimpleNamespace(weighted_model=True, cutoff_radius=300, target_class_indicator_col=request.param)
+    return conf, aem_data, interp_data
+
+
+def test_convert_to_xy_matches_row_wise_targets(xy_data):
+    conf, aem_data, interp_data = xy_data
+    tree = KDTree(interp_data[utils.twod_coords])
+    expected = {}
+    for i, row in aem_data.iterrows():
+        y, w = _reference_weighted_target(interp_data, tree, row, conf)
+        if y is not None:
+            expected[i] = (y, w)
+
+    data = utils.convert_to_xy(conf, aem_data, interp_data)
+    X, y, w = data['covariates'], data['targets'], data['weights']
+    assert list(X.index) == list(expected.keys())
+    np.testing.assert_allclose(y.to_numpy(), [v[0] for v in expected.values()])
+    np.testing.assert_allclose(w.to_numpy(), [v[1] for v in expected.values()])
+    pd.testing.assert_frame_equal(X, aem_data.loc[X.index])
+
+
+def test_weighted_targets_batching_is_invariant(xy_data):
+    conf, aem_data, interp_data = xy_data
+    tree = KDTree(interp_data[utils.twod_coords])
+    full = utils.weighted_targets(interp_data, tree, aem_data, conf)
+    batched = utils.weighted_targets(interp_data, tree, aem_data, conf, batch_size=7)
+    for a, b in zip(full, batched):
+        np.testing.assert_allclose(a, b)
+
+
+@pytest.mark.parametrize('n_jobs', [1, 2])
+def test_smooth_conductivities_matches_line_by_line_filter(n_jobs):
+    rng = np.random.RandomState(3)
+    n, n_cond = 300, 6
+    cond_cols = [f'cond_{i}' for i in range(n_cond)]
+    aem_data = pd.DataFrame(rng.rand(n, n_cond), columns=cond_cols)
+    aem_data[utils.cluster_line_no] = rng.randint(0, 7, n)
+    conf = SimpleNamespace(conductivity_cols=cond_cols, smooth_covariates_kernel_size=(5, 3))
+    expected = aem_data[cond_cols].to_numpy().copy()
+    for line in np.unique(aem_data[utils.cluster_line_no]):
+        rows = (aem_data[utils.cluster_line_no] == line).to_numpy()
+        expected[rows] = utils.medfilt2d(expected[rows], kernel_size=conf.smooth_covariates_kernel_size)
+    smoothed = utils.smooth_conductivities_along_lines(conf, aem_data, n_jobs=n_jobs)
+    np.testing.assert_array_equal(smoothed, expected)
+
+
+def _reference_add_delta(line, conf):
+    """per line implementation add_line_distance_and_segments must reproduce"""
+    line = line.sort_values(by=['POINT_X'], kind='mergesort')
+    line_cols = list(line.columns)
+    delta = np.sqrt(line['POINT_X'].diff() ** 2 + line['POINT_Y'].diff() ** 2).fillna(value=0.0)
+    line['d'] = delta.cumsum()
+    cluster_id = str(np.unique(line.cluster_line_no)[0]) + '_'
+    arrs = np.array_split(range(line.shape[0]), max(line.shape[0] // conf.aem_line_splits, 1))
+    arr = np.concatenate([np.ones_like(a) * i for i, a in enumerate(arrs)]).astype(str)
+    line[utils.cluster_line_segment_id] = [cluster_id + b for b in arr]
+    return line[line_cols + ['d', utils.cluster_line_segment_id]]
+
+
+@pytest.mark.parametrize('aem_line_splits', [1, 7, 40, 1000])
+def test_add_line_distance_and_segments_matches_per_line(aem_line_splits):
+    rng = np.random.RandomState(5)
+    n = 400
+    aem_data = pd.DataFrame({
+        'POINT_X': rng.uniform(0, 5000, n),
+        'POINT_Y': rng.uniform(0, 100, n),
+        utils.cluster_line_no: rng.choice([0, 1, 2, 3, 11], n, p=[0.5, 0.3, 0.1, 0.095, 0.005]),
+    }, index=rng.permutation(n))
+    conf = SimpleNamespace(aem_line_splits=aem_line_splits)
+    expected = pd.concat([_reference_add_delta(line.copy(), conf)
+                          for _, line in aem_data.groupby(utils.cluster_line_no)])
+    result = utils.add_line_distance_and_segments(aem_data, conf)
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_import_model_written_before_the_schema_was_stored(tmp_path):
+    import joblib
+    from aem.config import Config
+    legacy_conf = Config.__new__(Config)
+    legacy_conf.__dict__.update({'conductivity_cols': ['cond_1', 'cond_2'], 'thickness_cols': ['thick_1']})
+    model_file = tmp_path.joinpath('legacy.model')
+    joblib.dump({'model': 'model', 'config': legacy_conf}, model_file)
+
+    conf = SimpleNamespace(model_file=model_file, optimised_model_file=None)
+    model, model_conf = utils.import_model(conf, 'learn')
+    assert model == 'model'
+    assert conf.schema == {'conductivity_cols': ['cond_1', 'cond_2'], 'thickness_cols': ['thick_1']}
+    assert model_conf.conductivity_cols == ['cond_1', 'cond_2']
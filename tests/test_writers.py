@@ -0,0 +1,112 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from aem.writers import OutputWriter, writers, write_output, concat_outputs, project_output_columns
+
+
+def _frame(n=25):
+    rng = np.random.RandomState(2)
+    return pd.DataFrame({
+        'POINT_X': rng.uniform(0, 1000, n),
+        'POINT_Y': rng.uniform(0, 1000, n),
+        'cond_1': rng.rand(n),
+        'thick_1': rng.rand(n),
+        'fiducial': np.arange(n),
+        'pred': rng.rand(n),
+    })
+
+
+def _conf(output_format, columns='all'):
+    return SimpleNamespace(output_format=output_format, output_compression=None, output_columns=columns,
+                           output_chunk_rows=10)
+
+
+@pytest.mark.parametrize('output_format', ['csv', 'parquet', 'feather'])
+def test_write_output_in_chunks(tmp_path, output_format):
+    conf = _conf(output_format)
+    df = _frame()
+    path = tmp_path.joinpath('out.' + output_format)
+    write_output(df, conf, path)
+    pd.testing.assert_frame_equal(writers[output_format].read(path), df)
+
+    parts = [tmp_path.joinpath(f'part_{i}.' + output_format) for i in range(2)]
+    write_output(df.iloc[:12], conf, parts[0])
+    write_output(df.iloc[12:], conf, parts[1])
+    concat_outputs(conf, parts, path)
+    pd.testing.assert_frame_equal(writers[output_format].read(path), df)
+
+
+def test_project_output_columns():
+    df = _frame()
+    assert list(project_output_columns(df, _conf('csv')).columns) == list(df.columns)
+    assert list(project_output_columns(df, _conf('csv', 'predictions')).columns) == \
+        ['POINT_X', 'POINT_Y', 'fiducial', 'pred']
+    assert list(project_output_columns(df, _conf('csv', ['cond_1'])).columns) == \
+        ['cond_1', 'POINT_X', 'POINT_Y', 'fiducial', 'pred']
+
+
+@pytest.mark.parametrize('output_format', ['parquet', 'feather'])
+def test_concat_outputs_with_types_differing_between_parts(tmp_path, output_format):
+    conf = _conf(output_format)
+    df = _frame()
+    # integer and string columns that are all missing in the second part, so their types are inferred differently
+    first = df.iloc[:12].assign(line=np.arange(12), flight='a')
+    second = df.iloc[12:].assign(line=np.nan, flight=None)
+    parts = [tmp_path.joinpath(f'part_{i}.' + output_format) for i in range(2)]
+    write_output(first, conf, parts[0])
+    write_output(second, conf, parts[1])
+    path = tmp_path.joinpath('out.' + output_format)
+    concat_outputs(conf, parts, path)
+    pd.testing.assert_frame_equal(writers[output_format].read(path), pd.concat([first, second], ignore_index=True))
+
+
+def test_geopackage_round_trip(tmp_path):
+    conf = _conf('gpkg')
+    df = _frame()
+    # two chunks per part, the second of each appended with mode='a'
+    conf.output_chunk_rows = 7
+    parts = [tmp_path.joinpath(f'part_{i}.gpkg') for i in range(2)]
+    write_output(df.iloc[:12], conf, parts[0])
+    write_output(df.iloc[12:], conf, parts[1])
+    pd.testing.assert_frame_equal(writers['gpkg'].read(parts[1]), df.iloc[12:].reset_index(drop=True))
+    path = tmp_path.joinpath('out.gpkg')
+    concat_outputs(conf, parts, path)
+    pd.testing.assert_frame_equal(writers['gpkg'].read(path), df)
+
+
+def test_output_writer_is_abstract():
+    with pytest.raises(TypeError):
+        OutputWriter('out.csv')
+
+
+@pytest.mark.parametrize('output_format', ['parquet', 'feather'])
+def test_columns_missing_in_the_first_chunk_and_part(tmp_path, output_format):
+    conf = _conf(output_format)
+    df = _frame()
+    # only missing values in the first chunk, of 10 rows, and in the first part
+    df['flight'] = [None] * 12 + ['a'] * 13
+    path = tmp_path.joinpath('out.' + output_format)
+    write_output(df, conf, path)
+    pd.testing.assert_frame_equal(writers[output_format].read(path), df)
+
+    parts = [tmp_path.joinpath(f'part_{i}.' + output_format) for i in range(2)]
+    write_output(df.iloc[:12], conf, parts[0])
+    write_output(df.iloc[12:], conf, parts[1])
+    concat_outputs(conf, parts, path)
+    pd.testing.assert_frame_equal(writers[output_format].read(path), df)
+
+
+def test_concat_compressed_csv(tmp_path):
+    conf = _conf('csv')
+    conf.output_compression = 'gzip'
+    df = _frame()
+    # the codec is not in the names of the parts
+    parts = [tmp_path.joinpath(f'part_{i}.csv') for i in range(2)]
+    write_output(df.iloc[:12], conf, parts[0])
+    write_output(df.iloc[12:], conf, parts[1])
+    path = tmp_path.joinpath('out.csv')
+    concat_outputs(conf, parts, path)
+    pd.testing.assert_frame_equal(writers['csv'].read(path, compression='gzip'), df)